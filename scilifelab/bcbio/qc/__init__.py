@@ -10,12 +10,26 @@ import numpy as np
 import csv
 import collections
 import xml.etree.cElementTree as ET
-from bs4 import BeautifulSoup
+from HTMLParser import HTMLParser
+from htmlentitydefs import name2codepoint
 import datetime
+import time
+import zlib
+import hashlib
+import threading
+import cPickle as pickle
 
 from scilifelab.log import minimal_logger
 LOG = minimal_logger("bcbio")
 
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
 from bcbio.broad.metrics import PicardMetricsParser
 from bcbio.pipeline.qcsummary import FastQCParser
 
@@ -212,6 +226,112 @@ class RunInfoParser():
         p.CharacterDataHandler = self._char_data
         p.ParseFile(fp)
 
+class DemultiplexStatsParser(HTMLParser):
+    """Demultiplex_Stats.htm parser. The file is read in chunks and the
+    rows of its tables are yielded as they are read, without building a
+    document tree. The text of a cell is that of BeautifulSoup's
+    Tag.string: the cell's only text, or that of its only child
+    element, recursively, or None. As with BeautifulSoup, an end tag
+    closes the elements opened after its start tag, and a cell that is
+    not closed contains the following cells of its row.
+    """
+    ## Elements without an end tag
+    void_elements = set(["area", "base", "br", "col", "embed", "hr", "img", "input", "keygen", "link", "menuitem", "meta", "param", "source", "track", "wbr",
+                         "basefont", "bgsound", "command", "frame", "image", "isindex", "nextid", "spacer"])
+
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self._ntables = 0
+        self._tables = []
+        self._row = None
+        # The elements open in cells, as [tag, number of children, string
+        # of the last child, whether it is text, (cells, index) for cells]
+        self._open = []
+        self._rows = []
+
+    def rows(self, fh, chunk_size=65536):
+        """Parse a Demultiplex_Stats.htm file
+
+        :param fh: file handle
+        :param chunk_size: number of bytes read at a time
+
+        :returns: generator of (tables, th cells, td cells) of each table row, where tables are the indices of the tables containing the row, in document order
+        """
+        for chunk in iter(lambda: fh.read(chunk_size), ""):
+            self.feed(chunk)
+            for row in self._rows:
+                yield row
+            self._rows = []
+        self.close()
+        for row in self._rows:
+            yield row
+        self._rows = []
+
+    def handle_starttag(self, tag, attrs):
+        cell = None
+        if tag in ("th", "td") and self._row is not None:
+            cells = self._row[1 if tag == "th" else 2]
+            cells.append(None)
+            cell = (cells, len(cells) - 1)
+        elif not self._open:
+            if tag == "table":
+                self._tables.append(self._ntables)
+                self._ntables += 1
+            elif tag == "tr":
+                self._row = (tuple(self._tables), [], [])
+            return
+        self._child(None, False)
+        self._open.append([tag, 0, None, False, cell])
+        if tag in self.void_elements and cell is None:
+            self._close(len(self._open) - 1)
+
+    def handle_endtag(self, tag):
+        if self._open:
+            if tag in ("tr", "table"):
+                self._close(0)
+            else:
+                for i in xrange(len(self._open) - 1, -1, -1):
+                    if self._open[i][0] == tag:
+                        self._close(i)
+                        break
+                return
+        if tag == "tr" and self._row is not None:
+            self._rows.append(self._row)
+            self._row = None
+        elif tag == "table" and self._tables:
+            self._tables.pop()
+
+    def handle_data(self, data):
+        if self._open and self._open[-1][3]:
+            # Adjacent text is a single string
+            self._open[-1][2] += data
+        else:
+            self._child(data, True)
+
+    def handle_entityref(self, name):
+        self.handle_data(unichr(name2codepoint[name]) if name in name2codepoint else "&{}".format(name))
+
+    def handle_charref(self, name):
+        self.handle_data(unichr(int(name[1:], 16) if name.lower().startswith("x") else int(name)))
+
+    def _child(self, string, text):
+        """Add a child to the innermost open element in a cell"""
+        if self._open:
+            parent = self._open[-1]
+            parent[1] += 1
+            parent[2] = string
+            parent[3] = text
+
+    def _close(self, i):
+        """Close the open elements from the i:th on, setting the text of the closed cells"""
+        while len(self._open) > i:
+            tag, nchildren, string, text, cell = self._open.pop()
+            string = string if nchildren == 1 else None
+            if cell is not None:
+                cell[0][cell[1]] = str(string)
+            if self._open:
+                self._open[-1][2] = string
+
 class RunParametersParser():
     """runParameters.xml parser"""
     def __init__(self):
@@ -219,9 +339,7 @@ class RunParametersParser():
 
     def parse(self, fh):
 
-        tree = ET.parse(fh)
-        root = tree.getroot()
-        self.data = XmlToDict(root)
+        self.data = parse_xml_dict(fh)
         # If not a MiSeq run, return the contents of the Setup tag
         if 'MCSVersion' not in self.data:
             self.data = self.data['Setup']
@@ -240,9 +358,7 @@ class DemultiplexConfigParser():
             return {}
         try:
             with open(self.cfgfile) as fh:
-                tree = ET.parse(fh)
-                root = tree.getroot()
-                self.data = XmlToDict(root)
+                self.data = parse_xml_dict(fh)
         except:
             self.log.warn("Reading file {} failed".format(self.cfgfile))
             return {}
@@ -318,6 +434,46 @@ class XmlToDict(dict):
             else:
                 self.update({element.tag: element.text})
 
+def parse_xml_dict(source):
+    """Parse an xml file into the same dict as XmlToDict of its root
+    element, but incrementally. The value of each element is built when
+    the element has been read, after which the element is cleared, so
+    that the whole tree is never kept in memory.
+
+    :param source: file name or file object
+
+    :returns: dict
+    """
+    # For each open element, the (tag, dict value, list item) of its
+    # children, see XmlToDict and XmlToList
+    stack = []
+    skip = object()
+    for event, element in ET.iterparse(source, events=("start", "end")):
+        if event == "start":
+            stack.append([])
+            continue
+        children = stack.pop()
+        attrs = dict(element.items())
+        if not stack:
+            # The root is always a dict of its attributes and children
+            root = attrs
+            root.update([(tag, value) for tag, value, _ in children])
+        elif not children:
+            text = element.text
+            dict_value = dict(attrs, __Content__=text) if attrs else text
+            list_item = skip if text is not None and not text.strip() else (text.strip() if text else attrs)
+        elif len(children) == 1 or children[0][0] != children[1][0]:
+            list_item = dict(attrs)
+            list_item.update([(tag, value) for tag, value, _ in children])
+            dict_value = dict(list_item, **attrs) if any([list_item[k] is not v for k, v in attrs.iteritems()]) else list_item
+        else:
+            list_item = [item for _, _, item in children if item is not skip]
+            dict_value = dict({children[0][0]: list_item}, **attrs)
+        if stack:
+            stack[-1].append((element.tag, dict_value, list_item))
+        element.clear()
+    return root
+
 class IlluminaXMLParser():
     """Illumina xml data parser. Parses xml files in flowcell directory."""
     def __init__(self):
@@ -474,6 +630,240 @@ class ExtendedFastQCParser(FastQCParser):
 ##############################
 ##  objects
 ##############################
+def _list_dir(path):
+    """List the files and the subdirectories of path. As in os.walk,
+    symbolic links to directories are not listed as files"""
+    if scandir is not None:
+        files, dirs = [], []
+        for entry in scandir(path):
+            (dirs if entry.is_dir() else files).append(entry)
+        return [x.name for x in files], [x.name for x in dirs if not x.is_symlink()]
+    names = os.listdir(path)
+    isdir = [os.path.isdir(os.path.join(path, x)) for x in names]
+    files = [x for x, d in zip(names, isdir) if not d]
+    dirs = [x for x, d in zip(names, isdir) if d and not os.path.islink(os.path.join(path, x))]
+    return files, dirs
+
+class DirectoryIndex(object):
+    """Index of the files in a directory tree, grouped by directory.
+
+    The tree is walked once, so that the parsers of a flowcell directory
+    can share the index instead of each walking the tree.
+
+    :param path: root directory
+    :param ignore: compiled regular expression; directories whose path matches it are not indexed, nor their subdirectories
+    """
+    def __init__(self, path, ignore=None):
+        self.path = path
+        self.ignore = ignore
+        self.dirs = collections.OrderedDict()
+        self._files = {}
+        self._classifiers = {}
+        self._walk(path)
+
+    def _walk(self, root):
+        if self.ignore is not None and self.ignore.search(root):
+            return
+        try:
+            files, dirs = _list_dir(root)
+        except OSError:
+            return
+        self.dirs[root] = files
+        for d in dirs:
+            self._walk(os.path.join(root, d))
+
+    def files(self, path=None):
+        """Get the files under path, in the order os.walk lists them
+
+        :param path: directory in the tree; the root by default
+
+        :returns: list of file paths
+        """
+        path = os.path.normpath(path or self.path)
+        if path not in self._files:
+            self._files[path] = [os.path.join(root, x) for root, files in self.dirs.iteritems()
+                                 if os.path.normpath(root) == path or os.path.normpath(root).startswith(path + os.sep)
+                                 for x in files]
+        return self._files[path]
+
+    def classifier(self, path=None):
+        """Get the FileClassifier of the files under path
+
+        :param path: directory in the tree; the root by default
+        """
+        path = os.path.normpath(path or self.path)
+        if path not in self._classifiers:
+            self._classifiers[path] = FileClassifier(self.files(path))
+        return self._classifiers[path]
+
+## Kinds of metrics files, each given by a test that all file names
+## the parsers look for with that kind match
+FILE_KINDS = {'picard' : re.compile("(align|hs|insert|dup)_metrics").search,
+              'fastq_screen' : re.compile("_screen.txt").search,
+              'fastqc' : re.compile("fastqc/").search,
+              'bc_metrics' : re.compile("[\._]bc[\._]metrics").search,
+              'filter_metrics' : re.compile("filter_metrics").search,
+              'eval_metrics' : re.compile("eval_metrics").search,
+              'checkpoint' : lambda f: re.match("[0-9][0-9]_[^\/]+\.txt", os.path.basename(f)),
+              'software_versions' : re.compile("bcbb_software_versions.txt").search,
+              'project_summary' : lambda f: os.path.basename(f) == "project-summary.csv",
+              }
+
+class FileClassifier(object):
+    """Index of a list of files by kind, see FILE_KINDS, and lane.
+
+    Each file is classified once. The lanes of a file are all numbers
+    that are followed by '_' in its path, including the trailing digits
+    of longer numbers, since the parsers search the paths for patterns
+    starting with '<lane>_' or 'L0*<lane>_'. The files of a kind and lane
+    are thus all files that a pattern for that lane can match.
+
+    :param files: list of file paths
+    """
+    _lanes = re.compile("([0-9]+)_")
+
+    def __init__(self, files):
+        self.files = files
+        self._index = {}
+        for i, f in enumerate(files):
+            lanes = None
+            for kind, test in FILE_KINDS.iteritems():
+                if not test(f):
+                    continue
+                if lanes is None:
+                    lanes = set([n[j:] for n in self._lanes.findall(f) for j in range(len(n))])
+                kind_index = self._index.setdefault(kind, {None: []})
+                kind_index[None].append(f)
+                for lane in lanes:
+                    kind_index.setdefault(lane, []).append(f)
+
+    def get(self, kind, lane=None):
+        """Get the files of a kind and lane, in the order of the file list
+
+        :param kind: kind of file, a key of FILE_KINDS
+        :param lane: lane; all files of the kind if None or not a number
+
+        :returns: list of file paths
+        """
+        kind_index = self._index.get(kind, {})
+        lane = str(lane) if lane is not None and str(lane).isdigit() else None
+        return kind_index.get(lane, [])
+
+class ParseCache(object):
+    """Persistent on-disk cache of parsed metrics files.
+
+    The parsed metrics are stored with the size and modification time
+    of the files they were parsed from, so that files that did not
+    change are not read again, only stat'ed. The entries of the files
+    under a root directory, typically a flowcell directory, are kept
+    in one cache file, which is read the first time the directory is
+    looked up and written by <flush>. The values are stored pickled
+    and compressed, and a copy is returned on each lookup. Cache files
+    that have not been used for <max_age> days are removed, as are the
+    least recently used ones beyond a total of <max_size> megabytes.
+
+    :param path: cache directory
+    :param max_age: maximum age of a cache file, in days
+    :param max_size: maximum total size of the cache files, in megabytes
+    """
+    def __init__(self, path, max_age=30, max_size=256, log=None):
+        self.path = path
+        self.max_age = max_age
+        self.max_size = max_size
+        self.log = log or LOG
+        self._shards = {}
+        self._dirty = set()
+        self._lock = threading.Lock()
+
+    def get(self, root, kind, files, parse_fn):
+        """Get the metrics of files, parsing them with parse_fn if they
+        are not cached or changed since they were cached. Errors of
+        parse_fn are raised and nothing is cached.
+
+        :param root: directory containing files
+        :param kind: kind of metrics
+        :param files: list of files parse_fn reads
+        :param parse_fn: function parsing files, without arguments
+
+        :returns: parsed metrics
+        """
+        try:
+            stamp = tuple([(st.st_size, st.st_mtime) for st in [os.stat(f) for f in files]])
+        except OSError:
+            return parse_fn()
+        key = (kind, tuple(files))
+        shard = self._shard(root)
+        entry = shard.get(key)
+        if entry is not None and entry[0] == stamp:
+            return pickle.loads(zlib.decompress(entry[1]))
+        value = parse_fn()
+        with self._lock:
+            shard[key] = (stamp, zlib.compress(pickle.dumps(value, pickle.HIGHEST_PROTOCOL)))
+            self._dirty.add(root)
+        return value
+
+    def flush(self):
+        """Write the changed cache files, mark the used ones as recently
+        used and evict old cache files"""
+        with self._lock:
+            for root, shard in self._shards.iteritems():
+                fn = self._shard_file(root)
+                try:
+                    if root in self._dirty:
+                        if not os.path.exists(self.path):
+                            os.makedirs(self.path)
+                        tmp = "{}.{}".format(fn, os.getpid())
+                        with open(tmp, "wb") as fh:
+                            pickle.dump(shard, fh, pickle.HIGHEST_PROTOCOL)
+                        os.rename(tmp, fn)
+                    elif os.path.exists(fn):
+                        os.utime(fn, None)
+                except (IOError, OSError) as e:
+                    self.log.warn("could not write parse cache {}: {}".format(fn, e))
+            self._dirty = set()
+            self.evict()
+
+    def evict(self):
+        """Remove the cache files older than max_age days and the least
+        recently used ones beyond max_size megabytes"""
+        try:
+            names = [x for x in os.listdir(self.path) if x.endswith(".pickle")]
+        except OSError:
+            return
+        stats = []
+        for x in names:
+            try:
+                stats.append((os.path.join(self.path, x), os.stat(os.path.join(self.path, x))))
+            except OSError:
+                pass
+        oldest = time.time() - self.max_age * 86400
+        size = 0
+        for fn, st in sorted(stats, key=lambda x: x[1].st_mtime, reverse=True):
+            size += st.st_size
+            if st.st_mtime < oldest or size > self.max_size * 1024 * 1024:
+                self.log.debug("removing parse cache {}".format(fn))
+                try:
+                    os.unlink(fn)
+                except OSError:
+                    pass
+
+    def _shard_file(self, root):
+        return os.path.join(self.path, "{}.pickle".format(hashlib.md5(os.path.abspath(root)).hexdigest()))
+
+    def _shard(self, root):
+        with self._lock:
+            if root not in self._shards:
+                shard = {}
+                try:
+                    with open(self._shard_file(root), "rb") as fh:
+                        shard = pickle.load(fh)
+                except IOError:
+                    pass
+                except Exception as e:
+                    self.log.warn("could not read parse cache {}: {}".format(self._shard_file(root), e))
+                self._shards[root] = shard
+            return self._shards[root]
+
 class RunMetricsParser(dict):
     """Generic Run Parser class"""
     _metrics = []
@@ -485,51 +875,74 @@ class RunMetricsParser(dict):
         super(RunMetricsParser, self).__init__()
         self.files = []
         self.path=None
+        self.index=None
+        self.classifier=None
+        self.cache=None
         self.log = LOG
         if log:
             self.log = log
 
     def _collect_files(self):
+        """Collect the files under path from the index, which is created if not given"""
         if not self.path:
             return
         if not os.path.exists(self.path):
             raise IOError
-        self.files = []
-        for root, dirs, files in os.walk(self.path):
-            if re.search(self.reignore, root):
-                continue
-            self.files = self.files + [os.path.join(root, x) for x in files]
-
-    def filter_files(self, pattern, filter_fn=None):
-        """Take file list and return those files that pass the filter_fn criterium"""
-        def filter_function(f):
-            return re.search(pattern, f) != None
+        if self.index is None:
+            self.index = DirectoryIndex(self.path, ignore=self.reignore)
+        self.files = self.index.files(self.path)
+
+    def _classified_files(self, kind, lane=None):
+        """Get the files of a kind and lane, see FileClassifier"""
+        if self.classifier is None or self.classifier.files is not self.files:
+            if self.index is not None and self.index.files(self.path) is self.files:
+                self.classifier = self.index.classifier(self.path)
+            else:
+                self.classifier = FileClassifier(self.files)
+        return self.classifier.get(kind, lane)
+
+    def _parse_cached(self, kind, files, parse_fn):
+        """Parse files with parse_fn, or get the metrics from the cache if set"""
+        if self.cache is None or not files:
+            return parse_fn()
+        root = self.index.path if self.index is not None else self.path
+        return self.cache.get(root, kind, files, parse_fn)
+
+    def filter_files(self, pattern, filter_fn=None, kind=None, lane=None):
+        """Take file list and return those files that pass the filter_fn criterium.
+
+        :param pattern: regular expression the files must match, if no filter_fn
+        :param filter_fn: filtering function that returns boolean
+        :param kind: only consider the files of this kind, see FILE_KINDS
+        :param lane: only consider the files of this lane, with kind
+        """
         if not filter_fn:
-            filter_fn = filter_function
-        return filter(filter_fn, self.files)
+            filter_fn = re.compile(pattern).search
+        files = self.files if kind is None else self._classified_files(kind, lane)
+        return [f for f in files if filter_fn(f)]
 
-    def parse_json_files(self, filter_fn=None):
+    def parse_json_files(self, filter_fn=None, kind=None, lane=None):
         """Parse json files and return the corresponding dicts
         """
         def filter_function(f):
             return f is not None and f.endswith(".json")
         if not filter_fn:
             filter_fn = filter_function
-        files = self.filter_files(None,filter_fn)
+        files = self.filter_files(None,filter_fn,kind=kind,lane=lane)
         dicts = []
         for f in files:
             with open(f) as fh:
                 dicts.append(json.load(fh))
         return dicts
 
-    def parse_csv_files(self, filter_fn=None):
+    def parse_csv_files(self, filter_fn=None, kind=None):
         """Parse csv files and return a dict with filename as key and the corresponding dicts as value
         """
         def filter_function(f):
             return f is not None and f.endswith(".csv")
         if not filter_fn:
             filter_fn = filter_function
-        files = self.filter_files(None,filter_fn)
+        files = self.filter_files(None,filter_fn,kind=kind)
         dicts = {}
         for f in files:
             with open(f) as fh:
@@ -537,11 +950,18 @@ class RunMetricsParser(dict):
         return dicts
 
 class SampleRunMetricsParser(RunMetricsParser):
-    """Sample-level class for parsing run metrics data"""
+    """Sample-level class for parsing run metrics data
 
-    def __init__(self, path):
+    :param path: directory of the run
+    :param index: DirectoryIndex of a tree containing path, to share with other parsers
+    :param cache: ParseCache of the picard, fastq_screen and FastQC metrics
+    """
+
+    def __init__(self, path, index=None, cache=None):
         RunMetricsParser.__init__(self)
         self.path = path
+        self.index = index
+        self.cache = cache
         self._collect_files()
 
     def read_picard_metrics(self, barcode_name, sample_prj, lane, flowcell, barcode_id, **kw):
@@ -549,13 +969,13 @@ class SampleRunMetricsParser(RunMetricsParser):
         picard_parser = ExtendedPicardMetricsParser()
         pattern = "|".join(["{}_[0-9]+_[0-9A-Za-z]+(_nophix)?(_{})?-.*.(align|hs|insert|dup)_metrics".format(lane, barcode_id),
                             "{}_[0-9]+_[0-9A-Za-z]+(_{})?(_nophix)?-.*.(align|hs|insert|dup)_metrics".format(lane, barcode_id)])
-        files = self.filter_files(pattern)
+        files = self.filter_files(pattern, kind="picard", lane=lane)
         if len(files) == 0:
             self.log.warn("no picard metrics files for sample {}; pattern {}".format(barcode_name, pattern))
             return {}
         try:
             self.log.debug("files {}".format(",".join(files)))
-            metrics = picard_parser.extract_metrics(files)
+            metrics = self._parse_cached("picard", files, lambda: picard_parser.extract_metrics(files))
             return metrics
         except:
             self.log.warn("no picard metrics for sample {}".format(barcode_name))
@@ -567,13 +987,13 @@ class SampleRunMetricsParser(RunMetricsParser):
         pattern = "|".join(["{}_[0-9]+_[0-9A-Za-z]+(_nophix)?(_{})?_[12]_screen.txt".format(lane, barcode_id),
                             "{}_[0-9]+_[0-9A-Za-z]+(_{})?(_nophix)?_[12]_screen.txt".format(lane, barcode_id),
                             "{}_{}_L0*{}_.*_screen.txt".format(barcode_name, kw.get("sequence"), lane)])
-        files = self.filter_files(pattern)
+        files = self.filter_files(pattern, kind="fastq_screen", lane=lane)
         self.log.debug("files {}".format(",".join(files)))
+        def parse_fn():
+            with open(files[0]) as fp:
+                return parser.parse_fastq_screen_metrics(fp)
         try:
-            fp = open(files[0])
-            data = parser.parse_fastq_screen_metrics(fp)
-            fp.close()
-            return data
+            return self._parse_cached("fastq_screen", files[:1], parse_fn)
         except:
             self.log.warn("no fastq screen metrics for sample {}".format(barcode_name))
             return {}
@@ -584,7 +1004,7 @@ class SampleRunMetricsParser(RunMetricsParser):
         def filter_fn(f):
             return re.match("[0-9][0-9]_[^\/]+\.txt", os.path.basename(f)) != None
 
-        files = self.filter_files(None,filter_fn)
+        files = self.filter_files(None,filter_fn,kind="checkpoint")
         self.log.debug("files {}".format(",".join(files)))
 
         checkpoints = {}
@@ -602,7 +1022,7 @@ class SampleRunMetricsParser(RunMetricsParser):
         self.log.debug("parse_software_versions for sample {}, project {} in run {}".format(barcode_name, sample_prj, flowcell))
         parser = MetricsParser()
         pattern = "bcbb_software_versions.txt"
-        files = self.filter_files(pattern)
+        files = self.filter_files(pattern, kind="software_versions")
         self.log.debug("files {}".format(",".join(files)))
         data = {}
         try:
@@ -619,12 +1039,12 @@ class SampleRunMetricsParser(RunMetricsParser):
         if barcode_name == "unmatched":
             return
         pattern = "fastqc/{}_[0-9]+_[0-9A-Za-z]+(_nophix)?(_{})?-*".format(lane, barcode_id)
-        files = self.filter_files(pattern)
+        files = self.filter_files(pattern, kind="fastqc", lane=lane)
         self.log.debug("files {}".format(",".join(files)))
         try:
             fastqc_dir = os.path.dirname(files[0])
             fqparser = ExtendedFastQCParser(fastqc_dir)
-            stats = fqparser.get_fastqc_summary()
+            stats = self._parse_cached("fastqc", [os.path.join(fastqc_dir, "fastqc_data.txt")], fqparser.get_fastqc_summary)
             return {'stats':stats}
         except Exception as e:
             self.log.warn("Exception: {}".format(e))
@@ -637,7 +1057,7 @@ class SampleRunMetricsParser(RunMetricsParser):
         pattern = "{}_[0-9]+_[0-9A-Za-z]+(_{})?(_nophix)?.*.eval_metrics".format(lane, barcode_id)
         def filter_function(f):
             return re.search(pattern, f) != None
-        metrics = self.parse_json_files(filter_fn=filter_function)
+        metrics = self.parse_json_files(filter_fn=filter_function, kind="eval_metrics", lane=lane)
         if metrics:
             return metrics[0]
         return {}
@@ -648,7 +1068,7 @@ class SampleRunMetricsParser(RunMetricsParser):
         pattern = "project-summary.csv"
         def filter_function(f):
             return os.path.basename(f) == pattern
-        metrics = self.parse_csv_files(filter_fn=filter_function)
+        metrics = self.parse_csv_files(filter_fn=filter_function, kind="project_summary")
         if metrics:
             return metrics.values()[0][0]
         return {}
@@ -681,7 +1101,7 @@ class SampleRunMetricsParser(RunMetricsParser):
         """CASAVA: Parse filter metrics at sample level"""
         self.log.debug("parse_filter_metrics for lane {}, project {} in flowcell {}".format(lane, sample_prj, flowcell))
         pattern = "{}_[0-9]+_[0-9A-Za-z]+(_{})?(_nophix)?.filter_metrics".format(lane, barcode_id)
-        files = self.filter_files(pattern)
+        files = self.filter_files(pattern, kind="filter_metrics", lane=lane)
         self.log.debug("files {}".format(",".join(files)))
         try:
             fp = open(files[0])
@@ -709,7 +1129,7 @@ class SampleRunMetricsParser(RunMetricsParser):
                 else:
                     return reads/2
         pattern = "{}_[0-9]+_[0-9A-Za-z]+(_nophix)?[\._]bc[\._]metrics".format(lane)
-        files = self.filter_files(pattern)
+        files = self.filter_files(pattern, kind="bc_metrics", lane=lane)
         if len(files) == 0:
             self.log.debug("no bc metrics files for sample {}, lane {}; pattern {}".format(barcode_name, lane, pattern))
             return None
@@ -731,11 +1151,16 @@ class SampleRunMetricsParser(RunMetricsParser):
         return False
 
 class FlowcellRunMetricsParser(RunMetricsParser):
-    """Flowcell level class for parsing flowcell run metrics data."""
+    """Flowcell level class for parsing flowcell run metrics data.
+
+    :param path: directory of the run
+    :param index: DirectoryIndex of a tree containing path, to share with other parsers
+    """
     _lanes = range(1,9)
-    def __init__(self, path):
+    def __init__(self, path, index=None):
         RunMetricsParser.__init__(self)
         self.path = path
+        self.index = index
         self._collect_files()
 
     def parseRunInfo(self, fn="RunInfo.xml", **kw):
@@ -843,7 +1268,7 @@ class FlowcellRunMetricsParser(RunMetricsParser):
         for lane in self._lanes:
             pattern = "{}_[0-9]+_[0-9A-Za-z]+(_nophix)?.filter_metrics".format(lane)
             lanes[str(lane)]["filter_metrics"] = {"reads":None, "reads_aligned":None, "reads_fail_align":None}
-            files = self.filter_files(pattern)
+            files = self.filter_files(pattern, kind="filter_metrics", lane=lane)
             self.log.debug("filter metrics files {}".format(",".join(files)))
             try:
                 fp = open(files[0])
@@ -862,7 +1287,7 @@ class FlowcellRunMetricsParser(RunMetricsParser):
         for lane in self._lanes:
             pattern = "{}_[0-9]+_[0-9A-Za-z]+(_nophix)?[\._]bc[\._]metrics".format(lane)
             lanes[str(lane)]["bc_metrics"] = {}
-            files = self.filter_files(pattern)
+            files = self.filter_files(pattern, kind="bc_metrics", lane=lane)
             self.log.debug("bc metrics files {}".format(",".join(files)))
             try:
                 parser = MetricsParser()
@@ -921,6 +1346,41 @@ class FlowcellRunMetricsParser(RunMetricsParser):
 
         return lanes
 
+    def _read_demultiplex_stats_htm(self, fh):
+        """Read the barcode lane statistics and the sample information
+        of a Demultiplex_Stats.htm file, as they are found in its second
+        and fourth tables, with the column names given by the first and
+        second header rows.
+
+        :param fh: file handle
+
+        :returns: tuple of lists of barcode lane statistics and sample information rows, as dicts
+        """
+        headers = []
+        bc_rows = []
+        smp_rows = []
+        for tables, th, td in DemultiplexStatsParser().rows(fh):
+            if th:
+                headers.append(th)
+            if 1 in tables:
+                bc_rows.append(td)
+            if 3 in tables:
+                smp_rows.append(td)
+        bc_header = headers[0]
+        smp_header = headers[1]
+        ## 'Known' headers from a Demultiplex_Stats.htm document
+        bc_header_known = ['Lane', 'Sample ID', 'Sample Ref', 'Index', 'Description', 'Control', 'Project', 'Yield (Mbases)', '% PF', '# Reads', '% of raw clusters per lane', '% Perfect Index Reads', '% One Mismatch Reads (Index)', '% of >= Q30 Bases (PF)', 'Mean Quality Score (PF)']
+        smp_header_known = ['None', 'Recipe', 'Operator', 'Directory']
+        if not bc_header == bc_header_known:
+            self.log.warn("Barcode lane statistics header information has changed. New format?\nOld format: {}\nSaw: {}".format(",".join((["'{}'".format(x) for x in bc_header_known])), ",".join(["'{}'".format(x) for x in bc_header])))
+        if not smp_header == smp_header_known:
+            self.log.warn("Sample header information has changed. New format?\nOld format: {}\nSaw: {}".format(",".join((["'{}'".format(x) for x in smp_header_known])), ",".join(["'{}'".format(x) for x in smp_header])))
+        ## Fix first header name in smp_header since htm document is mal-formatted: <th>Sample<p></p>ID</th>
+        smp_header[0] = "Sample ID"
+
+        parse_row = lambda header, row: {header[i]:row[i] for i in range(0, len(header)) if row}
+        return [parse_row(bc_header, row) for row in bc_rows], [parse_row(smp_header, row) for row in smp_rows]
+
     def parse_demultiplex_stats_htm(self, fc_name, **kw):
         """Parse the Unaligned*/Basecall_Stats_*/Demultiplex_Stats.htm file
         generated from CASAVA demultiplexing and returns barcode metrics.
@@ -935,41 +1395,9 @@ class FlowcellRunMetricsParser(RunMetricsParser):
                 self.log.warn("No such file {}".format(htm_file))
                 continue
             with open(htm_file) as fh:
-                htm_doc = fh.read()
-            soup = BeautifulSoup(htm_doc)
-            ##
-            ## Find headers
-            allrows = soup.findAll("tr")
-            column_gen=(row.findAll("th") for row in allrows)
-            parse_row = lambda row: row
-            headers = [h for h in map(parse_row, column_gen) if h]
-            bc_header = [str(x.string) for x in headers[0]]
-            smp_header = [str(x.string) for x in headers[1]]
-            ## 'Known' headers from a Demultiplex_Stats.htm document
-            bc_header_known = ['Lane', 'Sample ID', 'Sample Ref', 'Index', 'Description', 'Control', 'Project', 'Yield (Mbases)', '% PF', '# Reads', '% of raw clusters per lane', '% Perfect Index Reads', '% One Mismatch Reads (Index)', '% of >= Q30 Bases (PF)', 'Mean Quality Score (PF)']
-            smp_header_known = ['None', 'Recipe', 'Operator', 'Directory']
-            if not bc_header == bc_header_known:
-                self.log.warn("Barcode lane statistics header information has changed. New format?\nOld format: {}\nSaw: {}".format(",".join((["'{}'".format(x) for x in bc_header_known])), ",".join(["'{}'".format(x) for x in bc_header])))
-            if not smp_header == smp_header_known:
-                self.log.warn("Sample header information has changed. New format?\nOld format: {}\nSaw: {}".format(",".join((["'{}'".format(x) for x in smp_header_known])), ",".join(["'{}'".format(x) for x in smp_header])))
-            ## Fix first header name in smp_header since htm document is mal-formatted: <th>Sample<p></p>ID</th>
-            smp_header[0] = "Sample ID"
-
-            ## Parse Barcode lane statistics
-            soup = BeautifulSoup(htm_doc)
-            table = soup.findAll("table")[1]
-            rows = table.findAll("tr")
-            column_gen = (row.findAll("td") for row in rows)
-            parse_row = lambda row: {bc_header[i]:str(row[i].string) for i in range(0, len(bc_header)) if row}
-            metrics["Barcode_lane_statistics"].extend(map(parse_row, column_gen))
-
-            ## Parse Sample information
-            soup = BeautifulSoup(htm_doc)
-            table = soup.findAll("table")[3]
-            rows = table.findAll("tr")
-            column_gen = (row.findAll("td") for row in rows)
-            parse_row = lambda row: {smp_header[i]:str(row[i].string) for i in range(0, len(smp_header)) if row}
-            metrics["Sample_information"].extend(map(parse_row, column_gen))
+                bc_rows, smp_rows = self._read_demultiplex_stats_htm(fh)
+            metrics["Barcode_lane_statistics"].extend(bc_rows)
+            metrics["Sample_information"].extend(smp_rows)
 
         # Define a function for sorting the values
         def by_lane_sample(data):
@@ -1,10 +1,18 @@
 """Database module"""
 import os
 import sys
+import json
+import time
+import socket
+import threading
+import collections
+import urlparse
+import cPickle as pickle
 import couchdb
+import couchdb.http
+from couchdb.client import Row
 
 from scilifelab.log import minimal_logger
-from scilifelab.utils.http import check_url
 
 class ConnectionError(Exception):
     """Exception raised for connection errors.
@@ -37,15 +45,302 @@ class Database(object):
     def __repr__(self):
         return "{}".format(self.__class__)
 
+class _ConnectionPool(couchdb.http.ConnectionPool):
+    """couchdb connection pool keeping at most <pool_size> idle keep-alive
+    connections per host; connections released beyond that are closed"""
+
+    def __init__(self, timeout, pool_size):
+        couchdb.http.ConnectionPool.__init__(self, timeout)
+        self.pool_size = pool_size
+
+    def release(self, url, conn):
+        scheme, host = couchdb.http.util.urlsplit(url, 'http', False)[:2]
+        with self.lock:
+            conns = self.conns.setdefault((scheme, host), [])
+            if len(conns) < self.pool_size:
+                conns.append(conn)
+                return
+        conn.close()
+
+class Session(couchdb.http.Session):
+    """couchdb http session with a bounded keep-alive connection pool,
+    shared by all connections to a server, see get_session. Counts the
+    requests made and the time spent waiting for responses, per method.
+
+    :param pool_size: maximum number of idle connections to keep open
+    :param timeout: socket timeout in seconds, or None for no timeout
+    """
+
+    def __init__(self, pool_size=10, timeout=None, **kwargs):
+        couchdb.http.Session.__init__(self, timeout=timeout, **kwargs)
+        self.connection_pool = _ConnectionPool(timeout, pool_size)
+        self.checked = False
+        self._lock = threading.Lock()
+        self.requests = collections.Counter()
+        self.latency = collections.Counter()
+
+    def configure(self, pool_size=None, timeout=None):
+        """Change the pool size and timeout of new connections"""
+        if pool_size is not None:
+            self.connection_pool.pool_size = pool_size
+        if timeout is not None:
+            self._timeout = self.connection_pool.timeout = timeout
+
+    def request(self, method, url, *args, **kwargs):
+        t0 = time.time()
+        try:
+            return couchdb.http.Session.request(self, method, url, *args, **kwargs)
+        finally:
+            with self._lock:
+                self.requests[method.upper()] += 1
+                self.latency[method.upper()] += time.time() - t0
+
+    def stats(self):
+        """Get the request statistics
+
+        :returns: dictionary with number of requests, total and mean latency in seconds, overall and per method
+        """
+        with self._lock:
+            stats = {method:{'requests':n, 'latency':self.latency[method], 'mean_latency':self.latency[method] / n} for method, n in self.requests.items()}
+            n = sum(self.requests.values())
+            t = sum(self.latency.values())
+        stats['total'] = {'requests':n, 'latency':t, 'mean_latency':t / n if n else 0.0}
+        return stats
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+def get_session(url, pool_size=None, timeout=None):
+    """Get the session shared by all connections to the server at url,
+    creating it if needed. Credentials in the url are ignored; they are
+    sent per request.
+
+    :param url: server url
+    :param pool_size: maximum number of idle connections to keep open. Defaults to 10
+    :param timeout: socket timeout in seconds. Defaults to no timeout
+
+    :returns: Session
+    """
+    pcs = urlparse.urlparse(url)
+    key = (pcs.scheme or "http", pcs.hostname, pcs.port)
+    with _sessions_lock:
+        if key not in _sessions:
+            _sessions[key] = Session(pool_size=pool_size or 10, timeout=timeout)
+        else:
+            _sessions[key].configure(pool_size, timeout)
+        return _sessions[key]
+
+def session_stats():
+    """Get the request statistics of all shared sessions
+
+    :returns: dictionary mapping server urls to Session.stats
+    """
+    with _sessions_lock:
+        sessions = _sessions.items()
+    return {"{}://{}:{}".format(scheme, host, port):session.stats() for (scheme, host, port), session in sessions}
+
+class LazyView(collections.Mapping):
+    """Read-only mapping from the keys of a CouchDB view to (a function of)
+    its rows, fetched from the server on demand. Looking up a key queries
+    the view for that key only, iterating over the mapping fetches the
+    whole view once. Fetched rows are cached. As when building a dict from
+    the view, the last row is used for keys that occur in several rows.
+
+    :param db: couchdb database
+    :param viewname: view name, as design_doc/view
+    :param value: function applied to a row to get the mapped value. Defaults to the row value
+    :param options: query options passed on to the view, e.g. reduce=False
+    """
+
+    def __init__(self, db, viewname, value=None, **options):
+        self.db = db
+        self.viewname = viewname
+        self.options = options
+        self._value = value or (lambda row: row.value)
+        self.clear()
+
+    def clear(self):
+        """Empty the cache"""
+        self._cache = {}
+        self._missing = set()
+        self._complete = False
+
+    def __getitem__(self, key):
+        if key not in self._cache:
+            if self._complete or key in self._missing:
+                raise KeyError(key)
+            rows = self.rows(key=key)
+            if not rows:
+                self._missing.add(key)
+                raise KeyError(key)
+        return self._cache[key]
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def __iter__(self):
+        self._load()
+        return iter(self._cache)
+
+    def __len__(self):
+        self._load()
+        return len(self._cache)
+
+    def rows(self, **query):
+        """Query the view with key, keys or startkey/endkey and cache the result
+
+        :returns: list of view rows
+        """
+        options = dict(self.options)
+        options.update(query)
+        rows = list(self.db.view(self.viewname, **options))
+        for row in rows:
+            self._cache[row.key] = self._value(row)
+        return rows
+
+    def prefetch(self, keys, batch_size=200):
+        """Fetch the rows of several keys not already cached, with one
+        keyed query per <batch_size> keys
+
+        :param keys: view keys
+        """
+        if self._complete:
+            return
+        keys = [k for k in set(keys) if k not in self._cache and k not in self._missing]
+        for i in xrange(0, len(keys), batch_size):
+            self.rows(keys=keys[i:i+batch_size])
+        self._missing.update([k for k in keys if k not in self._cache])
+
+    def _load(self):
+        if not self._complete:
+            self._cache = {row.key:self._value(row) for row in self.db.view(self.viewname, **self.options)}
+            self._missing = set()
+            self._complete = True
+
+def _hashable(key):
+    """Hashable representation of a view key, which may be a list"""
+    return json.dumps(key, sort_keys=True)
+
+class ViewCache(object):
+    """Persistent on-disk cache of the rows of the views of a CouchDB
+    database. The rows are pickled together with the database update
+    sequence they were fetched at. The first time a view is read, the
+    cache is brought up to date from the _changes feed since that
+    sequence, which is a single small request when nothing changed.
+    Otherwise, the rows of the keys emitted by the changed documents
+    are fetched again with a keyed query of each cached view. This
+    requires that the keys a document emits can be computed from the
+    document, see <key>. Views that are not cached, and all views if
+    more than <max_changes> documents changed, are fetched in full.
+
+    The view method mirrors couchdb.Database.view, without query
+    options other than those of the full view, e.g. reduce=False.
+
+    :param db: couchdb database
+    :param path: cache file
+    :param key: function of a document returning the list of keys it emits in the views. Defaults to the document name
+    :param max_changes: maximum number of changed documents to update incrementally
+    :param batch_size: number of keys per view query
+    """
+
+    def __init__(self, db, path, key=None, max_changes=1000, batch_size=200, log=None):
+        self.db = db
+        self.path = path
+        self.max_changes = max_changes
+        self.batch_size = batch_size
+        self.log = log or minimal_logger(repr(self))
+        self._key = key or (lambda doc: [doc.get("name")])
+        self.update_seq = None
+        self._views = {}
+        self._refreshed = False
+        self._read()
+
+    def view(self, viewname, **options):
+        """Get the rows of a view, refreshing the cache if needed
+
+        :param viewname: view name, as design_doc/view
+        :param options: query options for the full view
+
+        :returns: list of view rows
+        """
+        if not self._refreshed:
+            self.refresh()
+        if self._views.get(viewname, (None,))[0] != options:
+            self.log.debug("fetching view {} of {}".format(viewname, self.db))
+            if self.update_seq is None:
+                self.update_seq = self.db.info()["update_seq"]
+            self._views[viewname] = (options, [(row.id, row.key, row.value) for row in self.db.view(viewname, **options)])
+            self._write()
+        return [Row(id=docid, key=key, value=value) for docid, key, value in self._views[viewname][1]]
+
+    def refresh(self):
+        """Update the cached views with the changes in the database since
+        they were fetched"""
+        self._refreshed = True
+        if self.update_seq is None:
+            return
+        changes = self.db.changes(since=self.update_seq, include_docs=True, limit=self.max_changes + 1)
+        results = changes["results"]
+        if not results:
+            return
+        if len(results) > self.max_changes:
+            self.log.info("more than {} changes in {}; fetching views".format(self.max_changes, self.db))
+            self.update_seq = None
+            self._views = {}
+            return
+        changed = set([r["id"] for r in results])
+        new_keys = [key for r in results if not r.get("deleted") for key in self._key(r["doc"])]
+        for viewname, (options, rows) in self._views.items():
+            keys = {_hashable(key):key for key in new_keys}
+            keys.update({_hashable(row[1]):row[1] for row in rows if row[0] in changed})
+            rows = [row for row in rows if _hashable(row[1]) not in keys]
+            keys = keys.values()
+            for i in xrange(0, len(keys), self.batch_size):
+                rows.extend([(row.id, row.key, row.value) for row in self.db.view(viewname, keys=keys[i:i+self.batch_size], **options)])
+            self._views[viewname] = (options, rows)
+        self.log.debug("updated views of {} with {} changes".format(self.db, len(results)))
+        self.update_seq = changes["last_seq"]
+        self._write()
+
+    def _read(self):
+        try:
+            with open(self.path, "rb") as fh:
+                (self.update_seq, self._views) = pickle.load(fh)
+        except IOError:
+            pass
+        except Exception as e:
+            self.log.warn("could not read view cache {}: {}".format(self.path, e))
+
+    def _write(self):
+        tmp = "{}.{}".format(self.path, os.getpid())
+        try:
+            if not os.path.exists(os.path.dirname(self.path)):
+                os.makedirs(os.path.dirname(self.path))
+            with open(tmp, "wb") as fh:
+                pickle.dump((self.update_seq, self._views), fh, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp, self.path)
+        except (IOError, OSError) as e:
+            self.log.warn("could not write view cache {}: {}".format(self.path, e))
+
 ## From http://stackoverflow.com/questions/8780168/how-to-begin-writing-a-python-wrapper-around-another-wrapper
 class Couch(Database):
     _doc_type = None
     _update_fn = None
+    _bulk_update_fn = None
+    # Number of documents to fetch per request in get_entries
+    batch_size = 200
 
     def __init__(self, log=None, url="localhost", **kwargs):
         self.db = None
         self.url = url
-        self.port = 5984
+        self.port = kwargs.get("port", None) or 5984
+        self.batch_size = kwargs.get("batch_size", None) or self.batch_size
+        self.view_cache_dir = kwargs.get("view_cache", None)
+        self._prefetched = {}
         self.user = kwargs.get("username", None)
         self.pw = kwargs.get("password", None)
         if self.user and self.pw:
@@ -57,17 +352,24 @@ class Couch(Database):
         if log:
             self.log = log
         super(Couch, self).__init__(**kwargs)        
-        if not self.con:
+        if self.con is None:
             raise ConnectionError("Connection failed for url {}".format(self.display_url_string))
 
     def connect(self, username=None, password=None, url="localhost", port=5984, **kw):
         if not username or not password or not url:
             self.log.warn("please supply username, password, and url")
             return None
-        if not check_url(self.url_string):
-            self.log.warn("No such url {}".format(self.display_url_string))
-            return None
-        self.con = couchdb.Server(url=self.url_string)
+        session = get_session(self.url_string, kw.get("pool_size", None), kw.get("timeout", None))
+        con = couchdb.Server(url=self.url_string, session=session)
+        # Probe the server once per session rather than once per connection
+        if not session.checked:
+            try:
+                con.version()
+            except (socket.error, couchdb.http.HTTPError) as e:
+                self.log.warn("No such url {}: {}".format(self.display_url_string, e))
+                return None
+            session.checked = True
+        self.con = con
         self.log.debug("Connected to server @{}".format(self.display_url_string))
         self.user = username
         self.pw = password
@@ -90,10 +392,13 @@ class Couch(Database):
         :param field: get 'field' of document, i.e. key in document dict
         """
         self.log.debug("retrieving field entry in field '{}' for name '{}'".format(field, name))
-        if self.name_view.get(name, None) is None:
+        if name in self._prefetched:
+            doc = self._prefetched[name]
+        elif self.name_view.get(name, None) is None:
             self.log.warn("no entry '{}' in {}".format(name, self.db))
             return None
-        doc = self.db.get(self.name_view.get(name))
+        else:
+            doc = self.db.get(self.name_view.get(name))
         if field:
             if not self._doc_type:
                 return
@@ -102,6 +407,56 @@ class Couch(Database):
         else:
             return doc
 
+    def prefetch(self, names):
+        """Fetch the documents of several names in bulk, and serve them
+        from memory in get_entry, and the accessors built on it, for the
+        lifetime of the connection. Useful when a report or command
+        looks up the same few documents many times. Documents that are
+        modified in the database after prefetching are not refreshed.
+
+        :param names: unique name identifiers of documents
+        """
+        names = [name for name in set(names) if name not in self._prefetched]
+        if isinstance(self.name_view, LazyView):
+            self.name_view.prefetch(names, self.batch_size)
+        names = [name for name in names if self.name_view.get(name, None) is not None]
+        self.log.debug("prefetching {} documents from {}".format(len(names), self.db))
+        for name, doc in zip(names, self.get_entries([self.name_view.get(name) for name in names])):
+            if doc is not None:
+                self._prefetched[name] = doc
+
+    def get_entries(self, ids, batch_size=None):
+        """Retrieve documents for a list of document ids with as few
+        requests as possible, by posting the ids to _all_docs.
+
+        :param ids: list of document ids (uuids)
+        :param batch_size: number of documents to fetch per request. Defaults to self.batch_size
+
+        :returns: list of documents in the order of ids, None for ids that are not found
+        """
+        batch_size = batch_size or self.batch_size
+        docs = []
+        for i in xrange(0, len(ids), batch_size):
+            batch = ids[i:i+batch_size]
+            self.log.debug("retrieving {} documents from {}".format(len(batch), self.db))
+            docs.extend([row.doc for row in self.db.view("_all_docs", keys=batch, include_docs=True)])
+        return docs
+
+    def get_view_cache(self, **kwargs):
+        """Get a persistent cache of the views of the current database,
+        stored in the view_cache directory. If no view_cache directory
+        was given, the database itself is returned, so that views are
+        read the same way with and without the cache.
+
+        :param kwargs: keyword arguments passed on to ViewCache
+
+        :returns: ViewCache or couchdb database
+        """
+        if not self.view_cache_dir:
+            return self.db
+        path = os.path.join(os.path.expanduser(self.view_cache_dir), "{}_{}".format(self.url, self.port), "{}.pickle".format(self.db.name))
+        return ViewCache(self.db, path, log=self.log, **kwargs)
+
     def save(self, obj, **kwargs):
         """Save/update database object <obj>. If <obj> already exists
         and <update_fn> is defined, update will only take place if
@@ -121,6 +476,51 @@ class Couch(Database):
                 self.log.info("Object with id '{}' present in {} and not in need of updating".format(dbid.id, str(self.db)))
 
 
+    def save_all(self, objs, retries=3, **kwargs):
+        """Save/update several database objects with _bulk_docs. If
+        <bulk_update_fn> is defined, the objects are compared with those
+        in the database and only modified objects are written. Objects
+        that conflict with a concurrent update are compared and saved
+        again, up to <retries> times.
+
+        :param objs: database objects to save
+        :param retries: number of times to retry objects in conflict
+
+        :returns: number of objects saved
+        """
+        saved = 0
+        for attempt in xrange(retries + 1):
+            if not self._bulk_update_fn:
+                new_objs = objs
+                if attempt > 0:
+                    # Objects in conflict are overwritten with the latest revision
+                    for obj, doc in zip(objs, self.get_entries([obj["_id"] for obj in objs])):
+                        if doc:
+                            obj["_rev"] = doc["_rev"]
+            else:
+                new_objs = []
+                for new_obj, dbid in self._bulk_update_fn(self.db, objs, **kwargs):
+                    if new_obj is None:
+                        self.log.info("Object with id '{}' present in {} and not in need of updating".format(dbid, str(self.db)))
+                    else:
+                        new_objs.append(new_obj)
+            if not new_objs:
+                break
+            self.log.info("Saving {} objects in {}".format(len(new_objs), str(self.db)))
+            objs = []
+            for obj, (success, docid, rev_or_exc) in zip(new_objs, self.db.update(new_objs)):
+                if success:
+                    saved += 1
+                elif isinstance(rev_or_exc, couchdb.ResourceConflict):
+                    objs.append(obj)
+                else:
+                    self.log.error("Saving object with id '{}' in {} failed: {}".format(docid, str(self.db), rev_or_exc))
+            if not objs:
+                break
+            self.log.warn("{} objects in conflict in {}{}".format(len(objs), str(self.db), "; retrying" if attempt < retries else ""))
+        return saved
+
+
 class GenoLogics(Database):
     def __init__(**kwargs):
         super(Couch, self).__init__(**kwargs)
@@ -0,0 +1,152 @@
+"""Copying of CouchDB databases between servers"""
+import time
+import hashlib
+import urlparse
+import couchdb
+from multiprocessing.pool import ThreadPool
+
+from scilifelab.db import get_session
+from scilifelab.log import minimal_logger
+
+LOG = minimal_logger(__name__)
+
+def _display_url(url):
+    """Remove the credentials from a server url"""
+    pcs = urlparse.urlsplit(url)
+    return urlparse.urlunsplit((pcs.scheme, pcs.netloc.split("@")[-1]) + pcs[2:])
+
+class DatabaseReplicator(object):
+    """Copy the documents of databases on a source server to a
+    destination server.
+
+    Documents are read from the _changes feed of each source database,
+    <batch_size> at a time with their bodies, and written to the
+    destination database with _bulk_docs, keeping their revisions
+    (new_edits=false). Deleted documents are thus deleted in the
+    destination, and copying a document twice has no effect. After each
+    batch, the last copied source sequence is saved in a _local
+    checkpoint document of the destination database, from which a later
+    copy, e.g. of an interrupted clone, resumes. Databases are copied
+    concurrently by <workers> threads, sharing one keep-alive session
+    per server.
+
+    Documents that the destination rejects, e.g. by a validation
+    function, stop the copy of their database before the checkpoint is
+    saved, so that a resumed copy tries them again. Only the winning
+    revision of each document is copied: the conflicting revisions of
+    documents in conflict are not, unlike with a CouchDB replication.
+    The number of documents whose conflicts were dropped is logged.
+
+    :param source: source server url, with credentials
+    :param destination: destination server url, with credentials
+    :param batch_size: number of documents per read and write
+    :param workers: number of databases to copy concurrently
+    """
+
+    def __init__(self, source, destination, batch_size=500, workers=4, log=None):
+        self.source = source.rstrip("/")
+        self.destination = destination.rstrip("/")
+        self.batch_size = batch_size
+        self.workers = workers
+        self.log = log or LOG
+        self.s_couch = couchdb.Server(self.source, session=get_session(self.source, pool_size=workers))
+        self.d_couch = couchdb.Server(self.destination, session=get_session(self.destination, pool_size=workers))
+
+    def _checkpoint_id(self, db):
+        key = "{}/{} {}/{}".format(_display_url(self.source), db, _display_url(self.destination), db)
+        return "_local/replication-{}".format(hashlib.md5(key).hexdigest())
+
+    def checkpoint(self, db):
+        """Get the last source sequence copied to a destination database
+
+        :param db: database name
+
+        :returns: source sequence, or None if the database was not copied from source
+        """
+        try:
+            doc = self.d_couch[db].get(self._checkpoint_id(db))
+        except couchdb.ResourceNotFound:
+            return None
+        return doc.get("last_seq") if doc else None
+
+    def _full_doc(self, s_db, doc):
+        """_changes only gives attachment stubs, which cannot be written with new_edits=false"""
+        if not doc.get("_attachments") or doc.get("_deleted"):
+            return doc
+        return s_db.get(doc["_id"], rev=doc["_rev"], attachments=True)
+
+    def copy(self, db, security=True):
+        """Copy the documents changed in a source database since the
+        last checkpoint to the destination database, which must exist.
+
+        :param db: database name
+        :param security: copy the security object
+
+        :returns: dictionary with the database name, number of documents copied, number of documents 
+          whose conflicting revisions were not copied, seconds and documents per second
+        """
+        t0 = time.time()
+        s_db = self.s_couch[db]
+        d_db = self.d_couch[db]
+        checkpoint = d_db.get(self._checkpoint_id(db)) or {"_id": self._checkpoint_id(db)}
+        since = checkpoint.get("last_seq", 0)
+        if since:
+            self.log.info("Resuming copy of {} from sequence {}".format(db, since))
+        ndocs, nconflicts = 0, 0
+        while True:
+            changes = s_db.changes(since=since, include_docs=True, conflicts=True, limit=self.batch_size)
+            results = changes["results"]
+            if not results:
+                break
+            docs = [self._full_doc(s_db, r["doc"]) for r in results]
+            for doc in docs:
+                if doc.pop("_conflicts", None):
+                    nconflicts += 1
+            failed = [(docid, exc) for success, docid, exc in d_db.update(docs, new_edits=False) if not success]
+            if failed:
+                raise couchdb.ServerError("{} documents of {} were not written: {}".format(
+                    len(failed), db, ", ".join(["{} ({})".format(docid, exc) for docid, exc in failed])))
+            ndocs += len(results)
+            since = changes["last_seq"]
+            checkpoint["last_seq"] = since
+            d_db.save(checkpoint)
+            if len(results) < self.batch_size:
+                break
+        if security:
+            _, _, security_obj = s_db.resource.get_json("_security")
+            d_db.resource.put_json("_security", body=security_obj)
+        t = time.time() - t0
+        stats = {'db':db, 'docs':ndocs, 'conflicts':nconflicts, 'seconds':t, 'docs_per_second':ndocs / t if t > 0 else 0.0}
+        self.log.info("Copied {docs} documents of {db} in {seconds:.2f}s ({docs_per_second:.0f} documents/s)".format(**stats))
+        if nconflicts:
+            self.log.warn("The conflicting revisions of {conflicts} documents of {db} were not copied".format(**stats))
+        return stats
+
+    def _copy(self, args):
+        db, security = args
+        try:
+            return self.copy(db, security)
+        except Exception as e:
+            self.log.error("Copying {} failed: {}".format(db, e))
+            return {'db':db, 'docs':0, 'conflicts':0, 'seconds':0.0, 'docs_per_second':0.0, 'error':e}
+
+    def copy_all(self, dbs, security=True):
+        """Copy several databases concurrently. A failure to copy one
+        database is logged and does not stop the others.
+
+        :param dbs: database names
+        :param security: copy the security objects
+
+        :returns: list of copy statistics, see copy, in the order of dbs. Failed copies have an 'error'
+        """
+        t0 = time.time()
+        pool = ThreadPool(max(1, min(self.workers, len(dbs))))
+        try:
+            stats = pool.map(self._copy, [(db, security) for db in dbs], chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+        ndocs = sum([x['docs'] for x in stats])
+        t = time.time() - t0
+        self.log.info("Copied {} documents of {} databases in {:.2f}s ({:.0f} documents/s)".format(ndocs, len(dbs), t, ndocs / t if t > 0 else 0.0))
+        return stats
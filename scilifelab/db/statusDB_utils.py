@@ -1,8 +1,11 @@
 #!/usr/bin/env python
 from uuid import uuid4
 import time
+import json
+import hashlib
 from  datetime  import  datetime
 import couchdb
+from scilifelab.db import get_session
 #Make it backwards compatible
 try:
     import bcbio.pipeline.config_utils as cl
@@ -10,11 +13,13 @@ except ImportError:
     import bcbio.pipeline.config_loader as cl
 
 def load_couch_server(config_file):
-    """loads couch server with settings specified in 'config_file'"""
+    """loads couch server with settings specified in 'config_file'.
+    Servers loaded for the same url share a keep-alive connection pool,
+    whose size and socket timeout can be set with 'pool_size' and 'timeout'"""
     try:
         db_conf = cl.load_config(config_file)['statusdb']
-        url = db_conf['username']+':'+db_conf['password']+'@'+db_conf['url']+':'+str(db_conf['port'])
-        couch = couchdb.Server("http://" + url)
+        url = "http://" + db_conf['username']+':'+db_conf['password']+'@'+db_conf['url']+':'+str(db_conf['port'])
+        couch = couchdb.Server(url, session=get_session(url, db_conf.get('pool_size'), db_conf.get('timeout')))
         return couch
     except KeyError:
         raise RuntimeError("\"statusdb\" section missing from configuration file.")
@@ -24,24 +29,102 @@ def find_or_make_key(key):
         key = uuid4().hex
     return key
 
-def save_couchdb_obj(db, obj):
-    """Updates ocr creates the object obj in database db."""
-    dbobj = db.get(obj['_id'])
+def content_hash(obj):
+    """md5 hash of the content of the object obj, ignoring its id, revision,
+    time stamps and stored hash"""
+    content = dict((k, v) for k, v in obj.iteritems() if k not in ["_id", "_rev", "creation_time", "modification_time",
+                                                                    "content_hash", "content_hash_rev"])
+    return hashlib.md5(json.dumps(content, sort_keys=True, default=str)).hexdigest()
+
+def _rev_number(rev):
+    return int(rev.split("-")[0]) if rev else 0
+
+def _stored_hashes(db, ids, viewname):
+    """Get the content hashes of the documents ids, if db has the view.
+    The view only gives the hashes of documents that were last written
+    by save_couchdb_objs, see content_hash_rev."""
+    try:
+        return dict((row.key, row.value) for row in db.view(viewname, keys=ids))
+    except couchdb.ResourceNotFound:
+        return {}
+
+def save_couchdb_objs(db, objs, viewname="names/content_hash", batch_size=200, retries=3):
+    """Updates or creates the objects objs in database db.
+
+    The objects are stored with the hash of their content as generated,
+    see content_hash, and the revision number the write will give the
+    document, in 'content_hash_rev'. Any other write to the document, e.g.
+    by Couch.save_all or by hand, changes its revision number, so that
+    its hash no longer counts. The objects are compared with the stored
+    hashes that still count, which are read
+    for <batch_size> objects at a time from the view <viewname>. Only the
+    stored documents of objects whose hash differs are fetched, compared
+    as in save_couchdb_obj and written with one _bulk_docs request per
+    batch, so that the number of documents transferred scales with the
+    number of changed objects. Without the view, all stored documents are
+    fetched. Objects whose write conflicts are saved again up to <retries>
+    times. Other write errors, e.g. a document rejected by a validation
+    function, are raised as returned by the server.
+
+    :param db: couchdb database
+    :param objs: objects, each with an '_id'
+    :param viewname: view of document ids to content hashes
+
+    :returns: list of 'created', 'uppdated' or 'not uppdated' for each object
+    """
+    info = []
+    for i in xrange(0, len(objs), batch_size):
+        info.extend(_save_couchdb_batch(db, objs[i:i + batch_size], viewname, retries))
+    return info
+
+def _save_couchdb_batch(db, objs, viewname, retries):
+    hashes = [content_hash(obj) for obj in objs]
+    stored = _stored_hashes(db, [obj['_id'] for obj in objs], viewname)
+    info = ['not uppdated'] * len(objs)
+    changed = [i for i, obj in enumerate(objs) if stored.get(obj['_id']) != hashes[i]]
+    if not changed:
+        return info
+    dbobjs = dict((row.key, row.doc) for row in db.view('_all_docs', keys=[objs[i]['_id'] for i in changed], include_docs=True))
     time_log = datetime.utcnow().isoformat() + "Z"
-    if dbobj is None:
-        obj["creation_time"] = time_log
-        obj["modification_time"] = time_log
-        db.save(obj)
-        return 'created'
-    else:
-        obj["_rev"] = dbobj.get("_rev")
-        obj["modification_time"] = time_log
-        dbobj["modification_time"] = time_log
-        obj["creation_time"] = dbobj["creation_time"]
-        if not comp_obj(obj, dbobj):
-            db.save(obj)
-            return 'uppdated'
-    return 'not uppdated'
+    save = []
+    for i in changed:
+        obj = objs[i]
+        obj["content_hash"] = hashes[i]
+        dbobj = dbobjs.get(obj['_id'])
+        if dbobj is None:
+            obj.pop("_rev", None)
+            obj["content_hash_rev"] = 1
+            obj["creation_time"] = time_log
+            obj["modification_time"] = time_log
+            info[i] = 'created'
+            save.append(i)
+        else:
+            obj["_rev"] = dbobj.get("_rev")
+            obj["content_hash_rev"] = _rev_number(obj["_rev"]) + 1
+            dbobj["content_hash_rev"] = obj["content_hash_rev"]
+            obj["modification_time"] = time_log
+            dbobj["modification_time"] = time_log
+            obj["creation_time"] = dbobj.get("creation_time")
+            if not comp_obj(obj, dbobj):
+                info[i] = 'uppdated'
+                save.append(i)
+    conflicts = []
+    for i, (success, docid, result) in zip(save, db.update([objs[i] for i in save])):
+        if success:
+            continue
+        if not isinstance(result, couchdb.ResourceConflict):
+            raise result
+        conflicts.append(i)
+    if conflicts:
+        if retries == 0:
+            raise couchdb.ResourceConflict("Document update conflict for {}".format(", ".join([objs[i]['_id'] for i in conflicts])))
+        for i, result in zip(conflicts, _save_couchdb_batch(db, [objs[i] for i in conflicts], viewname, retries - 1)):
+            info[i] = result
+    return info
+
+def save_couchdb_obj(db, obj):
+    """Updates ocr creates the object obj in database db. See save_couchdb_objs."""
+    return save_couchdb_objs(db, [obj])[0]
 
 def save_couchdb_ref_obj(db, obj):
     """Updates ocr creates the object obj in database db."""
@@ -99,28 +182,38 @@ def dont_load_status_if_20158_not_found(obj, dbobj):
     return obj
 
 def find_proj_from_view(proj_db, project_name):
-    view = proj_db.view('project/project_name')
+    view = proj_db.view('project/project_name', key=project_name)
     for proj in view:
-        if proj.key == project_name:
-            return proj.value
+        return proj.value
     return None
 
 def find_proj_from_samp(proj_db, sample_name):
-    view = proj_db.view('samples/sample_project_name')
+    view = proj_db.view('samples/sample_project_name', key=sample_name)
     for samp in view:
-        if samp.key == sample_name:
-            return samp.value
+        return samp.value
     return None
 
 def find_samp_from_view(samp_db, proj_name):
-    view = samp_db.view('names/id_to_proj')
     samps = {}
+    try:
+        for doc in samp_db.view('names/proj_to_id', keys=list(set([proj_name, proj_name.lower()]))):
+            samps[doc.id] = doc.value[1:3]
+        return samps
+    except couchdb.ResourceNotFound:
+        pass
+    view = samp_db.view('names/id_to_proj')
     for doc in view:
         if (doc.value[0] == proj_name) or (doc.value[0] == proj_name.lower()):
             samps[doc.key] = doc.value[1:3]
     return samps
 
 def find_flowcell_from_view(flowcell_db, flowcell_name):
+    try:
+        for doc in flowcell_db.view('names/fcid_to_id', key=flowcell_name, limit=1):
+            return doc.value
+        return None
+    except couchdb.ResourceNotFound:
+        pass
     view = flowcell_db.view('names/id_to_name')
     for doc in view:
         if doc.value:
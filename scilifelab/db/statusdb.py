@@ -1,8 +1,10 @@
 """Database backend for connecting to statusdb"""
 import re
 import collections
+import couchdb
+from datetime import datetime
 from itertools import izip
-from scilifelab.db import Couch
+from scilifelab.db import Couch, LazyView
 from scilifelab.utils.timestamp import utc_time
 from scilifelab.utils.misc import query_yes_no, merge
 from scilifelab.db.statusDB_utils import save_couchdb_obj
@@ -17,15 +19,25 @@ VIEWS = {'samples' : {'names': {'name' : '''function(doc) {if (!doc["name"].matc
                                 'name_fc' : '''function(doc) {if (!doc["name"].match(/_[0-9]+$/)) {emit(doc["name"], doc["flowcell"]);}}''',
                                 'name_fc_proj' : '''var list; function(doc) {if (!doc["name"].match(/_[0-9]+$/)) {list = [doc["flowcell"], doc["sample_prj"]];emit(doc["name"], list);}}''',
                                 'name_proj' : '''function(doc) {if (!doc["name"].match(/_[0-9]+$/)) {emit(doc["name"], doc["sample_prj"]);}}''',
+                                'fc_name' : '''function(doc) {if (!doc["name"].match(/_[0-9]+$/)) {emit(doc["flowcell"], doc["name"]);}}''',
+                                'proj_name' : '''function(doc) {if (!doc["name"].match(/_[0-9]+$/)) {emit(doc["sample_prj"], doc["name"]);}}''',
                                 'id_to_name' : '''function(doc) {emit(doc["_id"], doc["name"]);}''',
+                                'name_to_id' : '''function(doc) {emit(doc["name"], doc["_id"]);}''',
+                                'proj_to_id' : '''function(doc) {emit(doc["sample_prj"], [doc["sample_prj"], doc["name"], doc["barcode_name"]]);}''',
                                 }},
          'flowcells' : {'names' : {'name' : '''function(doc) {emit(doc["name"], null);}''',
                                    'id_to_name' : '''function(doc) {emit(doc["_id"], doc["name"]);}''',
-                                   'Barcode_lane_stat' : '''function(doc) {emit(doc["name"],doc["illumina"]["Demultiplex_Stats"]["Barcode_lane_statistics"] );}'''}},
+                                   'fcid_to_id' : '''function(doc) {if (doc["name"]) {emit(doc["name"].split("_")[1], doc["_id"]);}}''',
+                                   'Barcode_lane_stat' : '''function(doc) {emit(doc["name"],doc["illumina"]["Demultiplex_Stats"]["Barcode_lane_statistics"] );}''',
+                                   'project_date_name' : '''function(doc) {if (doc["project_ids"]) {for (var i = 0; i < doc["project_ids"].length; i++) {emit([doc["project_ids"][i], doc["name"].split("_")[0]], doc["name"]);}}}''',
+                                   'content_hash' : '''function(doc) {if (doc["content_hash"] && doc["content_hash_rev"] == parseInt(doc["_rev"])) {emit(doc["_id"], doc["content_hash"]);}}'''},
+                        'info' : {'status_name' : '''function(doc) {emit(doc["storage_status"], doc["name"]);}'''}},
+         'x_flowcells' : {'names' : {'project_date_name' : '''function(doc) {if (doc["project_ids"]) {for (var i = 0; i < doc["project_ids"].length; i++) {emit([doc["project_ids"][i], doc["name"].split("_")[0]], doc["name"]);}}}'''}},
          'projects' : {'project' : {'project_id' : '''function(doc) {emit(doc.project_id, doc._id)}''',
                                     'project_name' : '''function(doc) {emit(doc.project_name, doc._id)}'''},
                        'names' : {'id_to_name' : '''function(doc) {emit(doc["_id"], doc["project_name"]);}''',
-                                  'name' : '''function(doc) {emit(doc["project_name"], null);}'''}},
+                                  'name' : '''function(doc) {emit(doc["project_name"], null);}''',
+                                  'content_hash' : '''function(doc) {if (doc["content_hash"] && doc["content_hash_rev"] == parseInt(doc["_rev"])) {emit(doc["_id"], doc["content_hash"]);}}'''}},
          }
 
 # Regular expressions for general use
@@ -131,6 +143,93 @@ def _match_barcode_name_to_project_sample(barcode_name, project_samples, extensi
                 return {'sample_name':project_sample_name, 'project_sample':project_samples[project_sample_name]}
     return None
 
+class ProjectSampleMatcher(object):
+    """Map barcode names to the project sample names of a project.
+
+    Gives the same results as _match_barcode_name_to_project_sample, but
+    indexes the project sample names once so that each barcode name is
+    resolved with a few dictionary lookups instead of a scan over all
+    project samples. Barcode names following the project id convention
+    (PXXX_) are matched on their prefixes against an index of the
+    project sample names and their prep letter variants (the name with
+    a trailing F, B, C, D or E stripped). When several project samples
+    match, the first in the order of project_samples wins, as in the
+    scan. Barcode names that don't follow the convention only match
+    exactly, or with extensive matching, which falls back on the scan.
+
+    :param project_samples: dictionary of project samples as obtained from statusdb project_summary
+    """
+    _prep_letters = "FBCDE"
+
+    def __init__(self, project_samples):
+        self.project_samples = project_samples
+        self._names = None
+        self._index = None
+        if project_samples is None:
+            return
+        self._names = project_samples.keys()
+        index = {}
+        try:
+            for i, project_sample_name in enumerate(self._names):
+                name = str(project_sample_name)
+                for variant in [name] + [name.rstrip(x) for x in self._prep_letters]:
+                    index.setdefault(variant, i)
+        except UnicodeError:
+            # Names that cannot be converted are left to the scan, which handles them the same way
+            return
+        self._index = index
+
+    def _lookup(self, name):
+        """Get the index of the first project sample name that is a prefix of name, or of one of its variants"""
+        hits = [self._index.get(name[:i]) for i in xrange(len(name) + 1)]
+        return min([i for i in hits if i is not None] or [None])
+
+    def match(self, barcode_name, extensive_matching=False, force=False):
+        """Take a barcode name and map it to a project sample name.
+
+        :param barcode_name: barcode name as it appears in sample sheet
+        :param extensive_matching: perform extensive matching of barcode to project sample names
+        :param force: override interactive queries.
+
+        :returns: dictionary with keys project sample name and project sample or None
+        """
+        if self._index is None:
+            return _match_barcode_name_to_project_sample(barcode_name, self.project_samples, extensive_matching, force)
+        if barcode_name in self.project_samples:
+            return {'sample_name':barcode_name, 'project_sample':self.project_samples[barcode_name]}
+        if not self._names:
+            return None
+        if not re.search(re_project_id_nr, barcode_name):
+            if not extensive_matching:
+                return None
+            return _match_barcode_name_to_project_sample(barcode_name, self.project_samples, extensive_matching, force)
+        prj_id = barcode_name.split("_")[0]
+        hits = [self._lookup(str(barcode_name)), self._lookup(str(barcode_name.replace("{}_".format(prj_id), "")))]
+        hits = [i for i in hits if i is not None]
+        if not hits:
+            return None
+        project_sample_name = self._names[min(hits)]
+        return {'sample_name':project_sample_name, 'project_sample':self.project_samples[project_sample_name]}
+
+def _get_project_flowcells(con, project_id, open_date=None):
+    """Get the flowcells on which a project was sequenced, from the
+    names/project_date_name view if present, otherwise by filtering the
+    project id lists of all flowcells.
+
+    :param con: flowcell connection
+    :param project_id: project id
+    :param open_date: project open date, as YYYY-MM-DD; older flowcells are skipped
+
+    :returns: list of flowcell names, newest first
+    """
+    since = datetime.strptime(open_date, "%Y-%m-%d").strftime("%y%m%d") if open_date else ""
+    try:
+        fcs = [row.value for row in con.db.view("names/project_date_name", startkey=[project_id, since], endkey=[project_id, u"\ufff0"], reduce=False)]
+    except couchdb.ResourceNotFound:
+        con.log.debug("no view 'names/project_date_name' in {}; filtering project ids of all flowcells".format(con.db))
+        fcs = [fc for fc, project_ids in con.proj_list.iteritems() if project_id in project_ids and fc.split("_")[0] >= since]
+    return sorted(set(fcs), reverse=True)
+
 ##############################
 # Documents
 ##############################
@@ -216,34 +315,25 @@ class AnalysisDocument(StatusDocument):
         StatusDocument.__init__(self, **kw)
 
 # Updating function for object comparison
-def update_fn(cls, db, obj, viewname = "names/id_to_name", key="name"):
-    """Compare object with object in db if present.
+def _updated_obj(obj, dbobj, t_utc):
+    """Compare object with the corresponding object in db, if any.
 
-    :param cls: calling class
-    :param db: couch database
     :param obj: database object to save
+    :param dbobj: database object or None
 
-    :returns: database object to save and database id if present
+    :returns: database object to save, or None if obj equals dbobj
     """
-    t_utc = utc_time()
     def equal(a, b):
         a_keys = [str(x) for x in a.keys() if x not in ["_id", "_rev", "creation_time", "modification_time"]]
         b_keys = [str(x) for x in b.keys() if x not in ["_id", "_rev", "creation_time", "modification_time"]]
         keys = list(set(a_keys + b_keys))
         return {k:a.get(k, None) for k in keys} == {k:b.get(k, None) for k in keys}
 
-    view = db.view(viewname)
-    d_view = {k.value:k for k in view}
-    dbid =  d_view.get(obj[key], None)
-    dbobj = None
-
-    if dbid:
-        dbobj = db.get(dbid.id, None)
     if dbobj is None:
         obj["creation_time"] = t_utc
-        return (obj, dbid)
+        return obj
     if equal(obj, dbobj):
-        return (None, dbid)
+        return None
     else:
         # Merge the newly created object with the one found in the database, replacing
         # the information found in the database for the new one if found the same key
@@ -253,7 +343,55 @@ def update_fn(cls, db, obj, viewname = "names/id_to_name", key="name"):
         obj["modification_time"] = t_utc
         obj["_rev"] = dbobj.get("_rev")
         obj["_id"] = dbobj.get("_id")
-        return (obj, dbid)
+        return obj
+
+def update_fn(cls, db, obj, viewname = "names/id_to_name", key="name"):
+    """Compare object with object in db if present.
+
+    :param cls: calling class
+    :param db: couch database
+    :param obj: database object to save
+
+    :returns: database object to save and database id if present
+    """
+    t_utc = utc_time()
+    view = db.view(viewname)
+    d_view = {k.value:k for k in view}
+    dbid =  d_view.get(obj[key], None)
+    dbobj = None
+
+    if dbid:
+        dbobj = db.get(dbid.id, None)
+    return (_updated_obj(obj, dbobj, t_utc), dbid)
+
+def bulk_update_fn(cls, db, objs, key="name", viewname=None):
+    """Compare several objects with the objects in db with the same key.
+    Database ids are resolved with one keyed query of a view that maps
+    key to document id, cls._key_view unless viewname is given, and
+    the database objects are fetched in bulk. If the server lacks the
+    view, the ids are looked up in the names/id_to_name view, as in
+    update_fn.
+
+    :param cls: calling class
+    :param db: couch database
+    :param objs: database objects to save
+
+    :returns: list of (database object to save or None, database id or None) tuples, in the order of objs
+    """
+    t_utc = utc_time()
+    names = [obj[key] for obj in objs]
+    viewname = viewname or cls._key_view
+    d_view = {}
+    try:
+        for i in xrange(0, len(names), cls.batch_size):
+            d_view.update({row.key:row.id for row in db.view(viewname, keys=names[i:i+cls.batch_size])})
+    except couchdb.ResourceNotFound:
+        cls.log.debug("no view '{}' in {}; looking up ids in 'names/id_to_name'".format(viewname, db))
+        d_view = {row.value:row.id for row in db.view("names/id_to_name")}
+    dbids = [d_view.get(name, None) for name in names]
+    found = list(set([x for x in dbids if x]))
+    dbobjs = dict(zip(found, cls.get_entries(found)))
+    return [(_updated_obj(obj, dbobjs.get(dbid, None), t_utc), dbid) for obj, dbid in izip(objs, dbids)]
 
 ##############################
 # functions that operate on status_document objects
@@ -345,18 +483,33 @@ def get_scilife_to_customer_name(project_name, p_con, s_con, get_barcode_seq=Fal
 class SampleRunMetricsConnection(Couch):
     _doc_type = SampleRunMetricsDocument
     _update_fn = update_fn
+    _bulk_update_fn = bulk_update_fn
+    _key_view = "names/name_to_id"
     def __init__(self, dbname="samples", **kwargs):
         super(SampleRunMetricsConnection, self).__init__(**kwargs)
         self.db = self.con[dbname]
-        self.name_view = {k.key:k.id for k in self.db.view("names/name", reduce=False)}
-        self.name_fc_view = {k.key:k for k in self.db.view("names/name_fc", reduce=False)}
-        self.name_proj_view = {k.key:k for k in self.db.view("names/name_proj", reduce=False)}
-        self.name_fc_proj_view = {k.key:k for k in self.db.view("names/name_fc_proj", reduce=False)}
+        self.name_view = LazyView(self.db, "names/name", value=lambda row: row.id, reduce=False)
+        self.name_fc_view = LazyView(self.db, "names/name_fc", value=lambda row: row, reduce=False)
+        self.name_proj_view = LazyView(self.db, "names/name_proj", value=lambda row: row, reduce=False)
+        self.name_fc_proj_view = LazyView(self.db, "names/name_fc_proj", value=lambda row: row, reduce=False)
+        self.fc_name_view = LazyView(self.db, "names/fc_name", reduce=False)
+        self.proj_name_view = LazyView(self.db, "names/proj_name", reduce=False)
 
     def set_db(self, dbname):
         """Make sure we don't change db from samples"""
         pass
 
+    def _get_ids(self, view, name_view, value):
+        """Get the ids of the samples with a given flowcell or project from
+        a view keyed on it, falling back to filtering a view keyed on sample name if
+        the server lacks the view
+        """
+        try:
+            return [row.id for row in view.rows(key=value)]
+        except couchdb.ResourceNotFound:
+            self.log.debug("no view '{}' in {}; filtering '{}'".format(view.viewname, self.db, name_view.viewname))
+            return [row.id for row in name_view.values() if row.value == value]
+
     def get_sample_ids(self, fc_id=None, sample_prj=None):
         """Retrieve sample ids subset by fc_id and/or sample_prj
 
@@ -366,8 +519,8 @@ class SampleRunMetricsConnection(Couch):
         :returns sample_ids: list of couchdb sample ids
         """
         self.log.debug("retrieving sample ids subset by flowcell '{}' and sample_prj '{}'".format(fc_id, sample_prj))
-        fc_sample_ids = [self.name_fc_view[k].id for k in self.name_fc_view.keys() if self.name_fc_view[k].value == fc_id] if fc_id else []
-        prj_sample_ids = [self.name_proj_view[k].id for k in self.name_proj_view.keys() if self.name_proj_view[k].value == sample_prj] if sample_prj else []
+        fc_sample_ids = self._get_ids(self.fc_name_view, self.name_fc_view, fc_id) if fc_id else []
+        prj_sample_ids = self._get_ids(self.proj_name_view, self.name_proj_view, sample_prj) if sample_prj else []
         # | -> union, & -> intersection
         if len(fc_sample_ids) > 0 and len(prj_sample_ids) > 0:
             sample_ids = list(set(fc_sample_ids) & set(prj_sample_ids))
@@ -385,31 +538,33 @@ class SampleRunMetricsConnection(Couch):
         self.log.debug("Number of samples: {}, number of fc samples: {}, number of project samples: {}".format(len(sample_ids), len(fc_sample_ids), len(prj_sample_ids)))
         return sample_ids
 
-    def get_samples(self, fc_id=None, sample_prj=None):
+    def get_samples(self, fc_id=None, sample_prj=None, batch_size=None):
         """Retrieve samples subset by fc_id and/or sample_prj
 
         :param fc_id: flowcell id
         :param sample_prj: sample project name
+        :param batch_size: number of samples to fetch per request, see Couch.get_entries
 
         :returns samples: list of sample_run_metrics documents
         """
         self.log.debug("retrieving samples subset by flowcell '{}' and sample_prj '{}'".format(fc_id, sample_prj))
         sample_ids = self.get_sample_ids(fc_id, sample_prj)
-        inv_view = {v:k for k,v in self.name_view.iteritems()}
-        sample_names = [inv_view[x] for x in sample_ids]
-        return [self.get_entry(x) for x in sample_names]
+        return self.get_entries(sample_ids, batch_size)
 
 class FlowcellRunMetricsConnection(Couch):
     _doc_type = FlowcellRunMetricsDocument
     _update_fn = update_fn
+    _bulk_update_fn = bulk_update_fn
+    _key_view = "names/name"
     def __init__(self, dbname="flowcells", **kwargs):
         super(FlowcellRunMetricsConnection, self).__init__(**kwargs)
         self.db = self.con[dbname]
-        self.name_view = {k.key:k.id for k in self.db.view("names/name", reduce=False)}
-        self.storage_status_view = {k.key:k.value for k in self.db.view("info/storage_status")}
-        self.id_view = {k.key:k.value for k in self.db.view("info/id")}
-        self.stat_view = {k.key:k.value for k in self.db.view("names/Barcode_lane_stat", reduce=False)}
-        self.proj_list = {k.key:k.value for k in self.db.view("names/project_ids_list", reduce=False) if k.key}
+        self.name_view = LazyView(self.db, "names/name", value=lambda row: row.id, reduce=False)
+        views = self.get_view_cache()
+        self.storage_status_view = {k.key:k.value for k in views.view("info/storage_status")}
+        self.id_view = {k.key:k.value for k in views.view("info/id")}
+        self.stat_view = {k.key:k.value for k in views.view("names/Barcode_lane_stat", reduce=False)}
+        self.proj_list = {k.key:k.value for k in views.view("names/project_ids_list", reduce=False) if k.key}
 
     def set_db(self):
         """Make sure we don't change db from flowcells"""
@@ -487,10 +642,30 @@ class FlowcellRunMetricsConnection(Couch):
         return len([read for read in reads if read.get('IsIndexedRead','N') == 'N']) == 2
 
     def get_storage_status(self, status):
-        """Get all runs with the specified storage status.
+        """Get all runs with the specified storage status. Queries the
+        info/status_name view for the status if present, otherwise
+        filters info/storage_status.
+
+        :param status: storage status
+
+        :returns: dictionary mapping run names to dicts of storage status and document id
         """
         self.log.info("Fetching all Flowcells with storage status \"{}\"".format(status))
-        return {run: info for run, info in self.storage_status_view.iteritems() if info.get("storage_status") == status}
+        try:
+            return {row.value: {"storage_status": row.key, "_id": row.id} for row in self.db.view("info/status_name", key=status)}
+        except couchdb.ResourceNotFound:
+            self.log.debug("no view 'info/status_name' in {}; filtering 'info/storage_status'".format(self.db))
+            return {run: info for run, info in self.storage_status_view.iteritems() if info.get("storage_status") == status}
+
+    def get_project_flowcells(self, project_id, open_date=None):
+        """Get the flowcells on which a project was sequenced.
+
+        :param project_id: project id
+        :param open_date: project open date, as YYYY-MM-DD; older flowcells are skipped
+
+        :returns: list of flowcell names, newest first
+        """
+        return _get_project_flowcells(self, project_id, open_date)
 
     def set_storage_status(self, doc_id, status):
         """Sets the run storage status.
@@ -510,17 +685,31 @@ class X_FlowcellRunMetricsConnection(Couch):
     def __init__(self, dbname="x_flowcells", **kwargs):
         super(X_FlowcellRunMetricsConnection, self).__init__(**kwargs)
         self.db = self.con[dbname]
-        self.name_view = {k.key:k.id for k in self.db.view("info/name", reduce=False)}
-        self.proj_list = {k.key:k.value for k in self.db.view("names/project_ids_list", reduce=False) if k.key} 
+        self.name_view = LazyView(self.db, "info/name", value=lambda row: row.id, reduce=False)
+        self.proj_list = {k.key:k.value for k in self.get_view_cache().view("names/project_ids_list", reduce=False) if k.key}
+
+    def get_project_flowcells(self, project_id, open_date=None):
+        """Get the flowcells on which a project was sequenced.
+
+        :param project_id: project id
+        :param open_date: project open date, as YYYY-MM-DD; older flowcells are skipped
+
+        :returns: list of flowcell names, newest first
+        """
+        return _get_project_flowcells(self, project_id, open_date)
 
 
 class ProjectSummaryConnection(Couch):
     _doc_type = ProjectSummaryDocument
     _update_fn = update_fn
+    _bulk_update_fn = bulk_update_fn
+    _key_view = "project/project_name"
     def __init__(self, dbname="projects", **kwargs):
         super(ProjectSummaryConnection, self).__init__(**kwargs)
         self.db = self.con[dbname]
-        self.name_view = {k.key:k.id for k in self.db.view("project/project_name", reduce=False)}
+        self.name_view = LazyView(self.db, "project/project_name", value=lambda row: row.id, reduce=False)
+        # Barcode name matchers, built once per project
+        self._matchers = {}
 
     def set_db(self, dbname):
         """Make sure we don't change db from projects"""
@@ -537,11 +726,12 @@ class ProjectSummaryConnection(Couch):
         """
         if not barcode_name:
             return None
-        project = self.get_entry(project_name)
-        if not project:
-            return None
-        project_samples = project.get('samples', None)
-        return _match_barcode_name_to_project_sample(barcode_name, project_samples, extensive_matching)
+        if project_name not in self._matchers:
+            project = self.get_entry(project_name)
+            if not project:
+                return None
+            self._matchers[project_name] = ProjectSampleMatcher(project.get('samples', None))
+        return self._matchers[project_name].match(barcode_name, extensive_matching)
 
     def _get_sample_run_metrics(self, v):
         if v.get('library_prep', None):
@@ -46,6 +46,7 @@ def  main(flowcell, all_flowcells,days,conf):
     today = date.today()
     couch = load_couch_server(conf)
     fc_db = couch['flowcells']
+    dbobjs = []
     if all_flowcells:
         flowcells = lims.get_processes(type = ['Illumina Sequencing (Illumina SBS) 4.0','MiSeq Run (MiSeq) 4.0'])
         for fc in flowcells:
@@ -68,8 +69,7 @@ def  main(flowcell, all_flowcells,days,conf):
                     print dbobj['modification_time']+'  '+key
                     if delta.days < days:
                         dbobj["illumina"]["run_summary"] = get_sequencing_info(fc)
-                        info = save_couchdb_obj(fc_db, dbobj)
-                        LOG.info('flowcell %s %s : _id = %s' % (flowcell_name, info, key))
+                        dbobjs.append((flowcell_name, dbobj))
     elif flowcell is not None:
         if '-' in flowcell:
             flowcell_name = flowcell
@@ -84,9 +84,12 @@ def  main(flowcell, all_flowcells,days,conf):
             dbobj = fc_db.get(key)
             dbobj["illumina"]["run_summary"] = get_sequencing_info(fc)
             get_run_qcs(fc, dbobj['lanes'])
-            info = save_couchdb_obj(fc_db, dbobj)
-            LOG.info('flowcell %s %s : _id = %s' % (flowcell_name, info, key))
-                
+            dbobjs.append((flowcell_name, dbobj))
+    # Save the updated flowcells together
+    infos = save_couchdb_objs(fc_db, [dbobj for flowcell_name, dbobj in dbobjs])
+    for (flowcell_name, dbobj), info in zip(dbobjs, infos):
+        LOG.info('flowcell %s %s : _id = %s' % (flowcell_name, info, dbobj['_id']))
+
 
 if __name__ == '__main__':
     usage = "Usage:       python flowcell_summary_upload_LIMS.py [options]"
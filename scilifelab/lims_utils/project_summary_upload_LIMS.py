@@ -23,9 +23,11 @@ import Queue
 import logging
 import logging.handlers
 
+# The number of project summaries collected before they are saved together
+SAVE_BATCH_SIZE = 100
    
 class PSUL():
-    def __init__(self, proj, samp_db, proj_db, upload_data, days, man_name, output_f, log):
+    def __init__(self, proj, samp_db, proj_db, upload_data, days, man_name, output_f, log, pending):
         self.proj = proj
         self.id = proj.id
         self.udfs = proj.udf
@@ -41,6 +43,7 @@ class PSUL():
         self.ordered_opened = None
         self.lims = Lims(BASEURI, USERNAME, PASSWORD)
         self.log=log
+        self.pending=pending
 
     def print_couchdb_obj_to_file(self, obj):
         if self.output_f is not None:
@@ -113,7 +116,8 @@ class PSUL():
                 except RequestError:
                     return "Failed to get the 20158 spreadsheet for project{}".format(self.id)
             if self.upload_data:
-                info = save_couchdb_obj(self.proj_db, project.obj)
+                self.pending.append((self.name, project.obj))
+                info = 'queued for upload'
             else:
                 info = self.print_couchdb_obj_to_file(project.obj)
             return "project {name} is handled and {info}: _id = {id}".format(
@@ -135,6 +139,15 @@ class PSUL():
                  '{name}'.format(elapsed = elapsed, name = self.name))
         self.log.info(log_info) 
 
+def save_projects(proj_db, pending, log):
+    """Save the collected (name, project summary) pairs with one call to
+    save_couchdb_objs and empty the list."""
+    infos = save_couchdb_objs(proj_db, [obj for name, obj in pending])
+    for (name, obj), info in zip(pending, infos):
+        log.info("project {name} is {info}: _id = {id}".format(
+                 name=name, info=info, id=obj['_id']))
+    del pending[:]
+
 def main(options):
     man_name = options.project_name
     all_projects = options.all_projects
@@ -162,8 +175,10 @@ def main(options):
             mainlog.warn('No project named {man_name} in Lims'.format(
                         man_name = man_name))
         else:
-            P = PSUL(proj[0], samp_db, proj_db, upload_data, days, man_name, output_f, mainlog)
+            pending = []
+            P = PSUL(proj[0], samp_db, proj_db, upload_data, days, man_name, output_f, mainlog, pending)
             P.project_update_and_logging()
+            save_projects(proj_db, pending, mainlog)
 
 def processPSUL(options, queue, logqueue):
     couch = load_couch_server(options.conf)
@@ -179,18 +194,22 @@ def processPSUL(options, queue, logqueue):
     mfh.setFormatter(mft)
     proclog.addHandler(mfh)
 
+    pending = []
     while work:
         #grabs project from queue
         try:
             projname = queue.get(block=True, timeout=3)
         except Queue.Empty:
             work=False
+            save_projects(proj_db, pending, proclog)
             proclog.info("exiting gracefully")
             break
         else:
             proj=mylims.get_projects(name=projname)[0]
-            P = PSUL(proj, samp_db, proj_db, options.upload, options.days, options.project_name, options.output_f, proclog)
+            P = PSUL(proj, samp_db, proj_db, options.upload, options.days, options.project_name, options.output_f, proclog, pending)
             P.project_update_and_logging()
+            if len(pending) >= SAVE_BATCH_SIZE:
+                save_projects(proj_db, pending, proclog)
             #signals to queue job is done
             queue.task_done()
 
@@ -160,7 +160,7 @@ class DeliveryController(AbstractBaseController):
         # Extract the list of samples and runs associated with the project and sort them
         samples = self.samples_to_copy(pid = p_con.get_entry(self.pargs.project, "project_id"),
                                        pod = p_con.get_entry(self.pargs.project, "open_date"),
-                                       fc_dict = {'HiSeq2500':f_con.proj_list, 'HiSeqX':x_con.proj_list},
+                                       fc_dict = {'HiSeq2500':f_con, 'HiSeqX':x_con},
                                        proj_base_dir = proj_base_dir,
                                        destination_root = destination_root,
                                        sample = self.pargs.sample,
@@ -293,21 +293,18 @@ class DeliveryController(AbstractBaseController):
 
     def samples_to_copy(self, pid, pod, fc_dict, proj_base_dir, destination_root, sample=None, flowcell=None):
         """Go through FC database and collect samples have been sequenced for a project
+
+        :param fc_dict: dictionary mapping flowcell types to flowcell database connections
         """
-        proj_open_date = datetime.strptime(pod,'%Y-%m-%d')
         self.proj_flowcells = {}
         sam_sequenced = defaultdict(dict)
         # collect flowcells sequenced for this project
-        for fc_type, proj_list in fc_dict.iteritems():
-            sort_fcs = sorted(proj_list.keys(), key=lambda k: datetime.strptime(k.split('_')[0], "%y%m%d"), reverse=True)
-            for fc in sort_fcs:
+        for fc_type, fc_con in fc_dict.iteritems():
+            for fc in fc_con.get_project_flowcells(pid, pod):
                 fc_date, fc_name = fc.split('_')
-                if datetime.strptime(fc_date,'%y%m%d') < proj_open_date:
-                    break
-                if pid in proj_list[fc]:
-                    if flowcell and flowcell != fc_name:
-                        continue
-                    self.proj_flowcells[fc] = {'name':fc, 'type':fc_type}
+                if flowcell and flowcell != fc_name:
+                    continue
+                self.proj_flowcells[fc] = {'name':fc, 'type':fc_type}
         
         if not self.proj_flowcells:
             self.log.error("Could not find any sequenced FC for project {}".format(self.pargs.project))
@@ -1,5 +1,6 @@
 """Couchdb extension."""
 from cement.core import hook
+from scilifelab.db import session_stats
 
 def add_shared_couchdb_options(app):
     """
@@ -11,18 +12,37 @@ def add_shared_couchdb_options(app):
     user = None
     url = None
     password = None
+    view_cache = None
     if app.config.has_option("db", "user"):
         user = app.config.get("db", "user") 
     if app.config.has_option("db", "password"):
         password = app.config.get("db", "password") 
     if app.config.has_option("db", "url"):
         url = app.config.get("db", "url") 
+    if app.config.has_option("db", "view_cache"):
+        view_cache = app.config.get("db", "view_cache")
     group = app.args.add_argument_group('couchdb', 'Options for couchdb connections')
     group.add_argument('--url', help="Database url (excluding http://). Default '{}'".format(url), default=url, nargs="?", type=str)
     group.add_argument('--port', help="Database port. Default 5984", nargs="?", default="5984", type=str)
     group.add_argument('--username', help="Database user. Default '{}'".format(user), nargs="?", default=user, type=str)
     group.add_argument('--password', help="Database password.", default=password, type=str)
+    group.add_argument('--db_pool_size', dest="pool_size", help="Maximum number of idle connections kept open per database server. Default 10", default=None, type=int)
+    group.add_argument('--db_timeout', dest="timeout", help="Database socket timeout in seconds. Default no timeout", default=None, type=float)
+    group.add_argument('--view_cache', help="Directory in which to cache database views between runs, e.g. ~/.pm/cache. Default '{}'".format(view_cache), default=view_cache, type=str)
+
+def log_couchdb_stats(app):
+    """
+    Logs the number of requests made to, and the time spent waiting
+    for, each couchdb server.
+
+    :param app: The application object.
+
+    """
+    for url, stats in session_stats().iteritems():
+        app.log.debug("{}: {} requests, {:.3f}s total latency, {:.4f}s mean latency".format(
+                url, stats['total']['requests'], stats['total']['latency'], stats['total']['mean_latency']))
 
 def load():
     """Called by the framework when the extension is 'loaded'."""
     hook.register('post_setup', add_shared_couchdb_options)
+    hook.register('pre_close', log_couchdb_stats)
@@ -7,12 +7,13 @@ import itertools
 import re
 import glob
 from collections import defaultdict
+from multiprocessing.pool import ThreadPool
 
 from cement.core import backend, controller, handler, hook
 from scilifelab.utils.misc import query_yes_no
 from scilifelab.pm.core.controller import AbstractBaseController
 from scilifelab.utils.timestamp import modified_within_days
-from scilifelab.bcbio.qc import FlowcellRunMetricsParser, SampleRunMetricsParser
+from scilifelab.bcbio.qc import FlowcellRunMetricsParser, SampleRunMetricsParser, DirectoryIndex, ParseCache
 from scilifelab.pm.bcbio.utils import validate_fc_directory_format, fc_id, fc_parts, fc_fullname
 from scilifelab.db.statusdb import SampleRunMetricsConnection, FlowcellRunMetricsConnection, ProjectSummaryConnection, SampleRunMetricsDocument, FlowcellRunMetricsDocument, AnalysisConnection, AnalysisDocument
 from scilifelab.utils.dry import dry
@@ -41,6 +42,8 @@ class RunMetricsController(AbstractBaseController):
             (['--names'], dict(help="Sample name mapping from barcode name to project name as a JSON string, as in \"{'sample_run_name':'project_run_name'}\". Mapping can also be given in a file", default=None, action="store", type=str)),
             (['--extensive_matching'], dict(help="Perform extensive barcode to project sample name matcing", default=False, action="store_true")),
             (['--project_alias'], dict(help="True project name as defined in project summary, as in 'J.Doe_00_01'.", default=None, action="store", type=str)),
+            (['--workers'], dict(help="Number of sample runs whose qc metrics are collected concurrently. Defaults to 1.", default=1, action="store", type=int)),
+            (['--parse_cache'], dict(help="Directory in which to cache parsed picard, fastq_screen and FastQC metrics between runs, e.g. ~/.pm/parse_cache. Default is not to cache them", default=None, action="store", type=str)),
             ]
 
 
@@ -48,6 +51,12 @@ class RunMetricsController(AbstractBaseController):
         self._meta.root_path = self.app.pargs.runqc if self.app.pargs.runqc else self.app.config.get("runqc", "root")
         self._meta.production_root_path = self.app.config.get("runqc", "production") if self.app.config.has_option("runqc", "production") else self.app.config.get("runqc", "root")
 
+    def _get_parse_cache(self):
+        """Get the cache of parsed metrics files, or None unless --parse_cache is given"""
+        if getattr(self, "_parse_cache", None) is None and self.pargs.parse_cache:
+            self._parse_cache = ParseCache(os.path.expanduser(self.pargs.parse_cache), log=self.app.log)
+        return getattr(self, "_parse_cache", None)
+
     @controller.expose(hide=True)
     def default(self):
         print self._help_text
@@ -109,9 +118,17 @@ class RunMetricsController(AbstractBaseController):
     ##############################
     ## New structures
     ##############################
-    def _parse_samplesheet(self, runinfo, qc_objects, fc_date, fc_name, fcdir, as_yaml=False, demultiplex_stats=None, setup=None):
-        """Parse samplesheet information and populate sample run metrics object"""
+    def _parse_samplesheet(self, runinfo, qc_objects, fc_date, fc_name, fcdir, as_yaml=False, demultiplex_stats=None, setup=None, index=None):
+        """Parse samplesheet information and populate sample run metrics object.
+
+        The samples of a flowcell directory share the index of its files,
+        which is created once if not given. The metrics of the samples are
+        collected by --workers threads.
+        """
+        samples = []
         if as_yaml:
+            if index is None:
+                index = DirectoryIndex(fcdir, ignore=SampleRunMetricsParser.reignore)
             for info in runinfo:
                 if not info.get("multiplex"):
                     self.app.log.warn("No multiplex information for lane {}".format(info.get("lane")))
@@ -124,15 +141,7 @@ class RunMetricsController(AbstractBaseController):
                     sample_kw = dict(flowcell=fc_name, date=fc_date, lane=sample['lane'], barcode_name=sample['name'], sample_prj=sample.get('sample_prj', None),
                                      barcode_id=sample['barcode_id'], sequence=sample.get('sequence', "NoIndex"))
                 
-                    parser = SampleRunMetricsParser(fcdir)
-                    obj = SampleRunMetricsDocument(**sample_kw)
-                    obj["picard_metrics"] = parser.read_picard_metrics(**sample_kw)
-                    obj["fastq_scr"] = parser.parse_fastq_screen(**sample_kw)
-                    obj["bc_count"] = parser.get_bc_count(run_setup=setup, **sample_kw)
-                    obj["fastqc"] = parser.read_fastqc_metrics(**sample_kw)
-                    obj["bcbb_checkpoints"] = parser.parse_bcbb_checkpoints(**sample_kw)
-                    obj["software_versions"] = parser.parse_software_versions(**sample_kw)
-                    qc_objects.append(obj)
+                    samples.append((fcdir, index, sample_kw, dict(run_setup=setup)))
         else:
             for d in runinfo:
                 LOG.debug("Getting information for sample defined by {}".format(d.values()))
@@ -161,17 +170,59 @@ class RunMetricsController(AbstractBaseController):
                     self.app.log.warn("No multiplex information for sample {}".format(d['SampleID']))
                     runinfo_yaml['details'][0]['multiplex'] = [{'barcode_id': 0, 'sequence': 'NoIndex'}]
                 sample_kw = dict(flowcell=fc_name, date=fc_date, lane=d['Lane'], barcode_name=d['SampleID'], sample_prj=d['SampleProject'].replace("__", "."), barcode_id=runinfo_yaml['details'][0]['multiplex'][0]['barcode_id'], sequence=runinfo_yaml['details'][0]['multiplex'][0]['sequence'])
-                parser = SampleRunMetricsParser(sample_fcdir)
-                obj = SampleRunMetricsDocument(**sample_kw)
-                obj["picard_metrics"] = parser.read_picard_metrics(**sample_kw)
-                obj["fastq_scr"] = parser.parse_fastq_screen(**sample_kw)
-                obj["bc_count"] = parser.get_bc_count(demultiplex_stats=demultiplex_stats, run_setup=setup, **sample_kw)
-                obj["fastqc"] = parser.read_fastqc_metrics(**sample_kw)
-                obj["bcbb_checkpoints"] = parser.parse_bcbb_checkpoints(**sample_kw)
-                obj["software_versions"] = parser.parse_software_versions(**sample_kw)
-                qc_objects.append(obj)
+                samples.append((sample_fcdir, None, sample_kw, dict(demultiplex_stats=demultiplex_stats, run_setup=setup)))
+        qc_objects.extend(self._collect_sample_qc(samples))
         return qc_objects
 
+    def _sample_qc(self, sample):
+        """Collect the qc metrics of a sample run.
+
+        :param sample: tuple of sample run directory, DirectoryIndex or None, sample keywords and bc_count keywords
+
+        :returns: sample run metrics document
+        """
+        path, index, sample_kw, bc_kw = sample
+        try:
+            parser = SampleRunMetricsParser(path, index=index, cache=self._get_parse_cache())
+            obj = SampleRunMetricsDocument(**sample_kw)
+            obj["picard_metrics"] = parser.read_picard_metrics(**sample_kw)
+            obj["fastq_scr"] = parser.parse_fastq_screen(**sample_kw)
+            obj["bc_count"] = parser.get_bc_count(**dict(sample_kw, **bc_kw))
+            obj["fastqc"] = parser.read_fastqc_metrics(**sample_kw)
+            obj["bcbb_checkpoints"] = parser.parse_bcbb_checkpoints(**sample_kw)
+            obj["software_versions"] = parser.parse_software_versions(**sample_kw)
+            return obj
+        except Exception as e:
+            self.app.log.error("Collecting qc metrics for sample {} in lane {} failed: {}".format(sample_kw.get("barcode_name"), sample_kw.get("lane"), e))
+            raise
+
+    def _collect_sample_qc(self, samples):
+        """Collect the qc metrics of sample runs, --workers at a time.
+
+        The metrics are mostly read from network storage, so threads
+        parse them concurrently. The first failure is raised, as when
+        collecting them one by one. The parse cache is written when done.
+
+        :param samples: list of sample tuples, see _sample_qc
+
+        :returns: list of sample run metrics documents, in the order of samples
+        """
+        workers = min(self.pargs.workers, len(samples))
+        cache = self._get_parse_cache()
+        try:
+            if workers <= 1:
+                return [self._sample_qc(sample) for sample in samples]
+            self.app.log.info("Collecting qc metrics of {} sample runs with {} workers".format(len(samples), workers))
+            pool = ThreadPool(workers)
+            try:
+                return pool.map(self._sample_qc, samples, chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+        finally:
+            if cache is not None:
+                cache.flush()
+
     def _collect_pre_casava_qc(self):
         qc_objects = []
         as_yaml = False
@@ -219,7 +270,7 @@ class RunMetricsController(AbstractBaseController):
         read_setup = fcobj["RunInfo"].get('Reads',[])
         fcobj["run_setup"] = self._run_setup(read_setup)
         qc_objects.append(fcobj)
-        qc_objects = self._parse_samplesheet(runinfo, qc_objects, fc_date, "{}{}".format(fc_pos,fc_name), fcdir, as_yaml=as_yaml, setup=read_setup)
+        qc_objects = self._parse_samplesheet(runinfo, qc_objects, fc_date, "{}{}".format(fc_pos,fc_name), fcdir, as_yaml=as_yaml, setup=read_setup, index=parser.index)
         return qc_objects
 
     def _collect_casava_qc(self):
@@ -336,7 +387,7 @@ class RunMetricsController(AbstractBaseController):
                         sinfos.append(sample_kw)
                 
                 # Create a parser object and collect the metrics
-                parser = SampleRunMetricsParser(sdir)
+                parser = SampleRunMetricsParser(sdir, cache=self._get_parse_cache())
                 sinfo = sinfos[0]
                 name = sinfo.get("barcode_name","unknown")
                 samples[name] = {}
@@ -357,6 +408,8 @@ class RunMetricsController(AbstractBaseController):
                     gteval = parser.parse_eval_metrics(**sinfo)
                     if gteval:
                         samples[name]["gatk_variant_eval"] = gteval
+            if self._get_parse_cache() is not None:
+                self._get_parse_cache().flush()
                         
             # Store the collected metrics in an analysis document
             obj = AnalysisDocument(**{'project_name': project_name,
@@ -395,16 +448,20 @@ class RunMetricsController(AbstractBaseController):
         s_con = SampleRunMetricsConnection(dbname=self.app.config.get("db", "samples"), **vars(self.app.pargs))
         fc_con = FlowcellRunMetricsConnection(dbname=self.app.config.get("db", "flowcells"), **vars(self.app.pargs))
         p_con = ProjectSummaryConnection(dbname=self.app.config.get("db", "projects"), **vars(self.app.pargs))
+        fc_objs = []
+        s_objs = []
         for obj in qc_objects:
             if self.app.pargs.debug:
                 self.log.debug("{}: {}".format(str(obj), obj["_id"]))
             if isinstance(obj, FlowcellRunMetricsDocument):
-                dry("Saving object {}".format(repr(obj)), fc_con.save(obj))
+                fc_objs.append(obj)
             if isinstance(obj, SampleRunMetricsDocument):
                 project_sample = p_con.get_project_sample(obj.get("sample_prj", None), obj.get("barcode_name", None), self.pargs.extensive_matching)
                 if project_sample:
                     obj["project_sample_name"] = project_sample['sample_name']
-                dry("Saving object {}".format(repr(obj)), s_con.save(obj))
+                s_objs.append(obj)
+        dry("Saving {} flowcell objects".format(len(fc_objs)), fc_con.save_all(fc_objs))
+        dry("Saving {} sample objects".format(len(s_objs)), s_con.save_all(s_objs))
 
     @controller.expose(help="Perform a multiplex QC")
     def multiplex_qc(self):
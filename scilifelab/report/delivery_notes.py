@@ -283,15 +283,16 @@ def sample_status_note(project_name=None, flowcell=None, username=None, password
     output_data = _update_sample_output_data(output_data, cutoffs)
 
     # Connect and run
-    s_con = SampleRunMetricsConnection(dbname=samplesdb, username=username, password=password, url=url)
-    fc_con = FlowcellRunMetricsConnection(dbname=flowcelldb, username=username, password=password, url=url)
-    p_con = ProjectSummaryConnection(dbname=projectdb, username=username, password=password, url=url)
+    s_con = SampleRunMetricsConnection(dbname=samplesdb, username=username, password=password, url=url, port=kw.get("port", None))
+    fc_con = FlowcellRunMetricsConnection(dbname=flowcelldb, username=username, password=password, url=url, port=kw.get("port", None))
+    p_con = ProjectSummaryConnection(dbname=projectdb, username=username, password=password, url=url, port=kw.get("port", None))
 
     # Set up paragraphs
     paragraphs = sample_note_paragraphs()
     headers = sample_note_headers()
 
-    # Get project
+    # Get project; the project document is looked up for every sample, so keep it in memory
+    p_con.prefetch([project_name])
     project = p_con.get_entry(project_name)
     source = p_con.get_info_source(project_name)
     if not project:
@@ -312,9 +313,11 @@ def sample_status_note(project_name=None, flowcell=None, username=None, password
     # Count number of times a sample has been run on a flowcell; if several, make lane-specific reports
     sample_count = Counter([x.get("barcode_name") for x in sample_run_list])
 
+    # Fetch the flowcell documents of all sample runs at once
+    fc_con.prefetch(["{}_{}".format(s.get("date"), s.get("flowcell")) for s in sample_run_list])
+
     # Loop samples and collect information
     s_param_out = []
-    fcdoc = None
     for s in sample_run_list:
         if _exclude_sample_id(exclude_sample_ids, s.get("barcode_name"), s.get("sequence")):
             continue
@@ -330,8 +333,7 @@ def sample_status_note(project_name=None, flowcell=None, username=None, password
             LOG.warn("Failed to set instrument and software versions for flowcell {} in report due to missing RunInfo -> Instrument field in statusdb. Either rerun 'pm qc update-qc' or search-and-replace 'NN' in the sample report.".format(fc))
             s_param.update(instrument_dict['default'])
         # Get run mode
-        if not fcdoc or fcdoc.get("name") != fc:
-            fcdoc = fc_con.get_entry(fc)
+        fcdoc = fc_con.get_entry(fc)
         runp = fcdoc.get("RunParameters",{})
         s_param["sequencing_platform"] = "MiSeq" if "MCSVersion" in runp else "HiSeq2500"
         s_param["clustering_method"] = "onboard clustering" if runp.get("ClusteringChoice","") == "OnBoardClustering" or s_param["sequencing_platform"] == "MiSeq" else "cBot"
@@ -1,53 +1,296 @@
 """Utilities for handling FastQ data"""
 import gzip
+import hashlib
+import heapq
+import math
+import operator
 import os
 import re
+import struct
+import subprocess
+import tempfile
+import threading
+import zlib
+import Queue
+import numpy as np
+from collections import Counter, deque
+from distutils.spawn import find_executable
+from itertools import chain, imap, islice, izip, compress
+from multiprocessing import cpu_count, Pool
+from multiprocessing.pool import ThreadPool
 from scilifelab.illumina.hiseq import HiSeqRun
-         
+
+# Default number of bytes to decode in each call to the underlying file handle
+BLOCK_SIZE = 4*1024*1024
+
+# Backend used for decompressing gzipped input when none is given by the caller:
+# 'gzip' inflates in the calling thread, 'thread' in a background thread and 
+# 'process' pipes the file through one of DECOMPRESSORS, falling back to 'thread'
+# if none of them can be found
+DECOMPRESS = os.environ.get("FASTQ_DECOMPRESS","gzip")
+DECOMPRESSORS = ["pigz","igzip"]
+
+def open_fastq(fname, decompress=None, block_size=BLOCK_SIZE, read_ahead=4):
+    """Open a fastq file for reading, decompressing it with the specified 
+    backend if the file name ends with .gz
+    
+    :param fname: the fastq file
+    :param decompress: 'gzip', 'thread' or 'process', defaults to DECOMPRESS
+    :param block_size: the size of the blocks read ahead by background readers
+    :param read_ahead: the maximum number of blocks buffered by background readers
+    :returns: a file-like object
+    """
+    if not fname.endswith(".gz"):
+        return open(fname,"rb")
+    
+    decompress = decompress or DECOMPRESS
+    if decompress == "gzip":
+        return gzip.GzipFile(fileobj=open(fname,"rb"))
+    if decompress == "process":
+        cmd = find_decompressor()
+        if cmd is not None:
+            return ThreadedReader(lambda: ProcessReader([cmd,"-dc",fname]), block_size, read_ahead)
+        decompress = "thread"
+    if decompress == "thread":
+        return ThreadedReader(lambda: gzip.GzipFile(fname,"rb"), block_size, read_ahead)
+    raise ValueError("Unknown decompression backend: {}".format(decompress))
+
+def find_decompressor():
+    """Return the path to the first available program in DECOMPRESSORS,
+    or None if none of them was found
+    """
+    for cmd in DECOMPRESSORS:
+        path = find_executable(cmd)
+        if path is not None:
+            return path
+    return None
+
+class ProcessReader:
+    """Read the standard output of an external command, e.g. a parallel 
+       decompressor, as a file. Raises IOError if the command exits with a
+       non-zero status. The standard error is written to a temporary file, 
+       so that the command cannot block on a full pipe"""
+    
+    def __init__(self, cmd):
+        self.cmd = cmd
+        self._stderr = tempfile.TemporaryFile()
+        self._proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=self._stderr)
+        
+    def read(self, size=-1):
+        data = self._proc.stdout.read(size)
+        if not data and self._proc.wait() != 0:
+            self._stderr.seek(0)
+            raise IOError("Command '{}' failed: {}".format(" ".join(self.cmd),self._stderr.read().strip()))
+        return data
+    
+    def close(self):
+        if self._proc.poll() is None:
+            self._proc.kill()
+        self._proc.stdout.close()
+        self._stderr.close()
+        self._proc.wait()
+        
+class ThreadedReader:
+    """Reads blocks from a file-like object in a background thread, keeping
+       at most read_ahead blocks buffered. The file is opened by calling 
+       opener, which allows the reader to be rewound by reopening it. An 
+       error in the background thread is raised by every later read"""
+    
+    def __init__(self, opener, block_size=BLOCK_SIZE, read_ahead=4):
+        self._opener = opener
+        self.block_size = block_size
+        self.read_ahead = read_ahead
+        self._start()
+        
+    def _start(self):
+        self._queue = Queue.Queue(self.read_ahead)
+        self._stop = threading.Event()
+        self._buffer = ""
+        self._eof = False
+        self._error = None
+        self._thread = threading.Thread(target=self._fill, args=(self._opener(),))
+        self._thread.daemon = True
+        self._thread.start()
+        
+    def _fill(self, fh):
+        """Read blocks into the queue until the end of the file is reached or
+        the reader is closed. Exceptions are passed on to the reading thread
+        """
+        try:
+            while not self._stop.is_set():
+                try:
+                    block = fh.read(self.block_size)
+                except Exception as e:
+                    self._put((None, e))
+                    break
+                self._put((block, None))
+                if not block:
+                    break
+        finally:
+            fh.close()
+            
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return
+            except Queue.Full:
+                pass
+
+    def _get(self):
+        if self._error is not None:
+            raise self._error
+        block, self._error = self._queue.get()
+        if self._error is not None:
+            raise self._error
+        if not block:
+            self._eof = True
+        return block
+        
+    def read(self, size=-1):
+        while not self._eof and (size < 0 or len(self._buffer) < size):
+            self._buffer += self._get()
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+    
+    def seek(self, offset, whence=None):
+        """Only rewinding to the start of the file is supported
+        """
+        if offset != 0 or whence:
+            raise IOError("ThreadedReader only supports seeking to the start of the file")
+        self.close()
+        self._start()
+        
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+
+class FastQBatch:
+    """A batch of fastq records, stored column-wise as four parallel lists 
+       holding 1) Headers, 2) Nucleotide sequences, 3) Optional headers, 
+       4) Qualities. Iterating over the batch yields records in the same 
+       list format as FastQParser"""
+    
+    def __init__(self, headers, sequences, optional, qualities):
+        self.headers = headers
+        self.sequences = sequences
+        self.optional = optional
+        self.qualities = qualities
+        
+    def __len__(self):
+        return len(self.headers)
+    
+    def __iter__(self):
+        return imap(list, izip(self.headers, self.sequences, self.optional, self.qualities))
+    
+    def select(self, mask):
+        """Return a new batch with the records for which the corresponding
+           element in mask evaluates to True
+        """
+        return FastQBatch(*[list(compress(column, mask)) for column in 
+                            (self.headers, self.sequences, self.optional, self.qualities)])
+    
+    def slice(self, start, end):
+        """Return a new batch with the records from start to end
+        """
+        return FastQBatch(self.headers[start:end], self.sequences[start:end],
+                          self.optional[start:end], self.qualities[start:end])
+
+class FastQBlockReader:
+    """Reads fastq data from an open file handle in large blocks and splits 
+       each block into records in bulk. Iterates over FastQBatch objects 
+       containing all complete records in a block, carrying any trailing 
+       partial record over to the next block. As when reading the file line 
+       by line, leading and trailing whitespace is stripped from each line"""
+    
+    def __init__(self, fh, block_size=BLOCK_SIZE):
+        self._fh = fh
+        self.block_size = block_size
+        
+    def __iter__(self):
+        tail = []
+        while True:
+            block = self._fh.read(self.block_size)
+            if not block:
+                break
+            lines = block.split("\n")
+            # The last element is a partial line (or empty if the block ended on a newline)
+            if tail:
+                lines[0] = tail[-1] + lines[0]
+                lines = tail[:-1] + lines
+            # Strip the complete lines; the partial line is stripped once it is complete
+            lines[:-1] = [l.strip() for l in lines[:-1]]
+            n = 4*((len(lines)-1)//4)
+            tail = lines[n:]
+            if n > 0:
+                yield self._batch(lines, n)
+        
+        # Handle a final record lacking a trailing newline and ignore trailing empty lines
+        tail = [l.strip() for l in tail]
+        while tail and not tail[-1]:
+            tail.pop()
+        if len(tail) == 4:
+            yield self._batch(tail, 4)
+        elif len(tail) > 0:
+            raise ValueError("Truncated fastq record at end of file: {}".format(tail[0]))
+            
+    def _batch(self, lines, n):
+        return FastQBatch(lines[0:n:4], lines[1:n:4], lines[2:n:4], lines[3:n:4])
+
 class FastQParser:
     """Parser for fastq files, possibly compressed with gzip. 
        Iterates over one record at a time. A record consists 
        of a list with 4 elements corresponding to 1) Header, 
-       2) Nucleotide sequence, 3) Optional header, 4) Qualities"""
+       2) Nucleotide sequence, 3) Optional header, 4) Qualities.
+       The file is decoded in blocks of block_size bytes, use
+       batches() to iterate over FastQBatch objects directly. See 
+       open_fastq for the available decompression backends"""
     
-    def __init__(self,file,filter=None):
+    def __init__(self,file,filter=None,block_size=BLOCK_SIZE,decompress=None):
         self.fname = file
         self.filter = filter
-        fh = open(file,"rb")
-        if file.endswith(".gz"):
-            self._fh = gzip.GzipFile(fileobj=fh)
-        else:
-            self._fh = fh
+        self.block_size = block_size
+        self._fh = open_fastq(file,decompress,block_size)
         self._records_read = 0
-        self._next = self.setup_next()
+        self._setup_reader()
         
     def __iter__(self):
         return self
     
     def next(self):
-        return self._next(self)
+        record = self._records.next()
+        self._records_read += 1
+        return record
 
-    def setup_next(self):
-        """Return the function to return the next record
+    def batches(self):
+        """Iterate over the remaining records in the file as FastQBatch
+           objects, with the filter applied
+        """
+        for batch in self._batches:
+            self._records_read += len(batch)
+            yield batch
+            
+    def _setup_reader(self):
+        """Set up the block reader and the record iterator on top of it
+        """
+        self._batches = self._filtered_batches(FastQBlockReader(self._fh, self.block_size))
+        self._records = chain.from_iterable(self._batches)
+        
+    def _filtered_batches(self, batches):
+        """Apply the header filter, if any, to each batch
         """
         if self.filter is None or len(self.filter.keys()) == 0:
-            def _next(self):
-                self._records_read += 1
-                return [self._fh.next().strip() for n in range(4)]
-        else:
-            def _next(self):
-                while True:
-                    record = [self._fh.next().strip() for n in range(4)]
-                    header = parse_header(record[0])
-                    skip = False
-                    for k, v in self.filter.items():
-                        if k in header and header[k] not in v:
-                            skip = True
-                            break
-                    if not skip:
-                        self._records_read += 1
-                        return record 
-        return _next
+            return iter(batches)
+        return imap(lambda batch: batch.select([self._keep(h) for h in batch.headers]), batches)
+            
+    def _keep(self, header):
+        header = parse_header(header)
+        for k, v in self.filter.items():
+            if k in header and header[k] not in v:
+                return False
+        return True
     
     def name(self):
         return self.fname
@@ -57,6 +300,7 @@ class FastQParser:
 
     def seek(self,offset,whence=None):
         self._fh.seek(offset,whence)
+        self._setup_reader()
         
     def close(self):
         self._fh.close()
@@ -67,11 +311,11 @@ class FastQWriter:
        4) Qualities. If the supplied filename ends with .gz, the output file 
        will be compressed with gzip"""
        
-    def __init__(self,file):
+    def __init__(self,file,compresslevel=9):
         self.fname = file
         fh = open(file,"wb")
         if file.endswith(".gz"):
-            self._fh = gzip.GzipFile(fileobj=fh)
+            self._fh = gzip.GzipFile(fileobj=fh,compresslevel=compresslevel)
         else:    
             self._fh = fh
         self._records_written = 0
@@ -83,45 +327,242 @@ class FastQWriter:
         self._fh.write("{}\n".format("\n".join([r.strip() for r in record])))
         self._records_written += 1
     
+    def write_batch(self,batch):
+        """Write all records in a FastQBatch
+        """
+        if len(batch) > 0:
+            self._fh.write(_format_batch(batch))
+        self._records_written += len(batch)
+        
     def rwritten(self):
         return self._records_written
     
     def close(self):
         self._fh.close()
 
+def _format_batch(batch):
+    """Format the records in a FastQBatch as fastq text
+    """
+    return "".join(["{}\n{}\n{}\n{}\n".format(*r) for r in 
+                    izip(batch.headers, batch.sequences, batch.optional, batch.qualities)])
+
+def gzip_member(data, compresslevel=9):
+    """Compress data into a complete, independent gzip member. Concatenated
+    members form a valid gzip file, so blocks can be compressed in any order
+    and written out one after another
+    """
+    c = zlib.compressobj(compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS)
+    body = c.compress(data) + c.flush()
+    # Magic number, deflate, no flags, no mtime, no extra flags, unknown OS
+    header = "\037\213\010\000\000\000\000\000\000\377"
+    return "".join([header, body, struct.pack("<II", zlib.crc32(data) & 0xffffffff, len(data) & 0xffffffff)])
+
+class FastQWriterPool:
+    """A pool of compression workers shared by several fastq outputs. Each 
+       output buffers records in memory until block_size bytes have been 
+       collected, after which the block is compressed by the workers into an 
+       independent gzip member. Compressed blocks are written to the output 
+       in order as they are finished, with at most max_pending blocks per 
+       output waiting for compression"""
+    
+    def __init__(self, workers=None, compresslevel=9, block_size=1024*1024, max_pending=4):
+        self.workers = workers or cpu_count()
+        self.compresslevel = compresslevel
+        self.block_size = block_size
+        self.max_pending = max_pending
+        self._pool = ThreadPool(self.workers)
+        self._writers = []
+        
+    def writer(self, fname):
+        """Return a writer for fname, with the same interface as FastQWriter
+        """
+        writer = PooledFastQWriter(fname, self)
+        self._writers.append(writer)
+        return writer
+    
+    def compress(self, data):
+        return self._pool.apply_async(gzip_member, (data, self.compresslevel))
+    
+    def close(self):
+        """Close all writers and shut down the workers
+        """
+        for writer in self._writers:
+            writer.close()
+        self._pool.close()
+        self._pool.join()
+        
+class PooledFastQWriter(FastQWriter):
+    """Writes fastq records through a FastQWriterPool. Uncompressed outputs
+       are buffered in the same way but written directly"""
+    
+    def __init__(self, file, pool):
+        self.fname = file
+        self._fh = open(file,"wb")
+        self._pool = pool
+        self._compress = file.endswith(".gz")
+        self._buffer = []
+        self._buffered = 0
+        self._pending = deque()
+        self._records_written = 0
+        
+    def write(self, record):
+        entry = "\n".join([r.strip() for r in record])
+        self._buffer.append(entry)
+        self._buffered += len(entry) + 1
+        self._records_written += 1
+        if self._buffered >= self._pool.block_size:
+            self.flush(False)
+            
+    def write_batch(self, batch):
+        if len(batch) == 0:
+            return
+        self.write_text(_format_batch(batch), len(batch))
+
+    def write_text(self, text, nrecords):
+        """Write nrecords records already formatted as fastq text, ending 
+        with a newline
+        """
+        if not text:
+            return
+        self._buffer.append(text[:-1])
+        self._buffered += len(text)
+        self._records_written += nrecords
+        if self._buffered >= self._pool.block_size:
+            self.flush(False)
+            
+    def flush(self, wait=True):
+        """Submit the buffered records and write the finished blocks. If 
+        wait is True, block until all pending blocks have been written
+        """
+        if self._buffer:
+            data = "\n".join(self._buffer) + "\n"
+            self._buffer = []
+            self._buffered = 0
+            if self._compress:
+                self._pending.append(self._pool.compress(data))
+            else:
+                self._fh.write(data)
+        while self._pending and (wait or self._pending[0].ready() or len(self._pending) > self._pool.max_pending):
+            self._fh.write(self._pending.popleft().get())
+        
+    def close(self):
+        if self._fh.closed:
+            return
+        self.flush()
+        # Make sure that an empty output is still a valid gzip file
+        if self._compress and self._fh.tell() == 0:
+            self._fh.write(gzip_member("", self._pool.compresslevel))
+        self._fh.close()
+
 class BarcodeExtractor():
     """Parse a FastQ-file and extract the barcode assumed to be at the 
        given offset and of specified length
     """
     
-    def __init__(self,  fqfile, casava18=True, offset=101, length=6):
-        fh = open(fqfile)
-        if os.path.splitext(fqfile)[1] == ".gz":
-            self.fh = gzip.GzipFile(fileobj=fh)
-        else:
-            self.fh = fh
+    def __init__(self,  fqfile, casava18=True, offset=101, length=6, decompress=None):
+        self.fh = open_fastq(fqfile,decompress)
         self.start = offset
         self.end = offset+length
         self.casava18 = casava18
-        self._next = self.setup_next(self.start, self.end)
+        self._extract = self.setup_extract(self.start, self.end)
+        self._barcodes = chain.from_iterable(imap(self._extract, FastQBlockReader(self.fh)))
         
     def __iter__(self):
         return self
     def next(self):
-        return self._next(self)
+        return self._barcodes.next()
     
-    def setup_next(self, start, end):
-        """Return the function to extract the barcode
+    def setup_extract(self, start, end):
+        """Return the function to extract the barcodes from a FastQBatch
         """
         if not self.casava18:
-            def _next(self):
-                _, seq, _, _ = [self.fh.next() for i in xrange(4)]
-                return seq[start:end]
+            def _extract(batch):
+                return [seq[start:end] for seq in batch.sequences]
         else:
-            def _next(self):
-                header, _, _, _ = [self.fh.next() for i in xrange(4)]
-                return header.strip().rsplit(":",1)[1]
-        return _next
+            def _extract(batch):
+                return [header.rsplit(":",1)[1] for header in batch.headers]
+        return _extract
+
+class BarcodeCounter:
+    """Count the most frequent barcodes in a stream in bounded memory, using 
+       the Space-Saving algorithm (Metwally et al. 2005). At most capacity 
+       barcodes are tracked. Barcodes are counted exactly in chunks of 
+       chunk_size and each chunk is merged into the tracked barcodes, keeping
+       the capacity barcodes with the highest counts. The count of a tracked 
+       barcode may be overestimated by at most its error, and a barcode that is 
+       not tracked has occurred at most floor() times. The barcodes in exact 
+       are counted exactly and kept apart from the others. Counters for 
+       different parts of the data can be combined with merge"""
+    
+    def __init__(self, capacity=10000, exact=[], chunk_size=1000000):
+        self.capacity = capacity
+        self.chunk_size = chunk_size
+        self.counts = {}
+        self.errors = {}
+        self.exact = dict.fromkeys(exact, 0)
+        self.total = 0
+        
+    def update(self, barcodes):
+        """Count the barcodes in an iterable
+        """
+        barcodes = iter(barcodes)
+        while True:
+            chunk = Counter(islice(barcodes, self.chunk_size))
+            if not chunk:
+                break
+            self.total += sum(chunk.itervalues())
+            for bc in self.exact:
+                self.exact[bc] += chunk.pop(bc, 0)
+            self._merge(chunk, {}, 0)
+    
+    def merge(self, other):
+        """Add the counts of another BarcodeCounter with the same exact barcodes
+        """
+        self.total += other.total
+        for bc, count in other.exact.iteritems():
+            self.exact[bc] = self.exact.get(bc, 0) + count
+        self._merge(other.counts, other.errors, other.floor())
+        
+    def floor(self):
+        """Return the highest count a barcode that is not tracked can have
+        """
+        if len(self.counts) < self.capacity:
+            return 0
+        return min(self.counts.itervalues())
+    
+    def _merge(self, counts, errors, floor):
+        """Merge the counts and errors of another summary, in which barcodes 
+           that are absent have occurred at most floor times
+        """
+        own_floor = self.floor()
+        merged = {}
+        for bc in set(self.counts).union(counts):
+            merged[bc] = self.counts.get(bc, own_floor) + counts.get(bc, floor)
+        if len(merged) > self.capacity:
+            merged = dict(heapq.nlargest(self.capacity, merged.iteritems(), key=operator.itemgetter(1)))
+        self.errors = {bc: self.errors.get(bc, own_floor if bc not in self.counts else 0) + 
+                           errors.get(bc, floor if bc not in counts else 0) for bc in merged}
+        self.counts = merged
+        
+    def most_common(self, n=None):
+        """Return a list of the n most common barcodes, not counting those in 
+           exact, and their counts, ordered from the most common
+        """
+        if n is None:
+            return sorted(self.counts.iteritems(), key=operator.itemgetter(1), reverse=True)
+        return heapq.nlargest(n, self.counts.iteritems(), key=operator.itemgetter(1))
+
+def count_barcodes(fqfile1, fqfile2=None, casava18=True, offset=101, length=6, capacity=10000, exact=[]):
+    """Count the barcodes extracted from a fastq file with BarcodeExtractor in 
+       a BarcodeCounter. If fqfile2 is given, the barcodes extracted from it 
+       are appended to the ones from fqfile1
+    """
+    counter = BarcodeCounter(capacity=capacity, exact=exact)
+    barcodes = BarcodeExtractor(fqfile1, casava18, offset, length)
+    if fqfile2 is not None:
+        barcodes = imap(operator.add, barcodes, BarcodeExtractor(fqfile2, casava18, offset, length))
+    counter.update(barcodes)
+    return counter
 
 
 def avgQ(record,offset=33):
@@ -139,6 +580,459 @@ def gtQ30(record,offset=33):
             g += 1
     return round(100*float(g)/len(qual),1)
 
+def quality_values(qualities,offset=33):
+    """Convert a list of quality strings into a flat uint8 array with the Phred 
+    quality values of all bases, together with arrays holding the start position 
+    and the length of each quality string in the flat array
+    """
+    lengths = np.fromiter(imap(len, qualities), dtype=np.int64, count=len(qualities))
+    starts = np.zeros(len(lengths), dtype=np.int64)
+    np.cumsum(lengths[:-1], out=starts[1:])
+    values = np.frombuffer("".join(qualities), dtype=np.uint8) - np.uint8(offset)
+    return values, starts, lengths
+
+def round_array(x, ndigits=0):
+    """Round an array the way the built-in round does, i.e. with halfway cases
+    rounded away from zero
+    """
+    scale = 10.0**ndigits
+    y = x*scale
+    rounded = np.sign(y)*np.floor(np.abs(y) + 0.5)/scale
+    # Values close to a halfway case may be affected by the scaling, leave those to round
+    ties = np.nonzero(np.abs(np.abs(y) - np.floor(np.abs(y)) - 0.5) < 1e-6)[0]
+    for i in ties:
+        rounded[i] = round(x[i], ndigits)
+    return rounded
+
+def _string_sums(values, starts, lengths):
+    """Sum the values in each string of a flat array as returned by quality_values
+    """
+    sums = np.zeros(len(lengths), dtype=np.int64)
+    nonempty = lengths > 0
+    if np.any(nonempty):
+        sums[nonempty] = np.add.reduceat(values.astype(np.int64), starts[nonempty])
+    return sums
+
+def quality_stats(qualities,offset=33,cutoff=30):
+    """Compute quality statistics for a list of quality strings in one go. Returns 
+    a dict with the average quality ('avgQ') and the percentage of bases with 
+    quality >= cutoff ('gtQ30') for each string, rounded as in avgQ and gtQ30, and 
+    the average quality for each cycle ('cycle_mean') and the number of bases with 
+    each quality value ('histogram') over all strings. The strings may be of
+    different lengths
+    """
+    values, starts, lengths = quality_values(qualities,offset)
+    sums = _string_sums(values, starts, lengths)
+    above = _string_sums(values >= cutoff, starts, lengths)
+    
+    # The cycle of each base is its position relative to the start of its string
+    if len(lengths) > 0 and np.all(lengths == lengths[0]):
+        cycle_sums = values.reshape((len(lengths), lengths[0])).sum(axis=0, dtype=np.int64)
+        cycle_counts = np.repeat(len(lengths), lengths[0])
+    else:
+        cycles = np.arange(len(values)) - np.repeat(starts, lengths)
+        cycle_sums = np.bincount(cycles, weights=values)
+        cycle_counts = np.bincount(cycles)
+    
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return {'avgQ': round_array(sums.astype(np.float64)/lengths, 1),
+                'gtQ30': round_array(100*above.astype(np.float64)/lengths, 1),
+                'cycle_mean': cycle_sums.astype(np.float64)/cycle_counts,
+                'histogram': np.bincount(values)}
+
+def avgQ_batch(qualities,offset=33):
+    """Return the average quality of each of a list of quality strings as an 
+    array, rounded as in avgQ
+    """
+    values, starts, lengths = quality_values(qualities,offset)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return round_array(_string_sums(values, starts, lengths).astype(np.float64)/lengths, 1)
+    
+def gtQ30_batch(qualities,offset=33):
+    """Return the percentage of bases with quality >= 30 in each of a list of 
+    quality strings as an array, rounded as in gtQ30
+    """
+    values, starts, lengths = quality_values(qualities,offset)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return round_array(100*_string_sums(values >= 30, starts, lengths).astype(np.float64)/lengths, 1)
+
+# Codes used by FastQProfiler when counting nucleotides: G, A, T, C, N and anything else
+_BASE_CODES = np.repeat(np.uint8(5), 256)
+for _i, _b in enumerate("GATCN"):
+    _BASE_CODES[ord(_b)] = _i
+    _BASE_CODES[ord(_b.lower())] = _i
+
+class FastQProfiler:
+    """Collects FastQC-style statistics, i.e. per-base quality, per-sequence 
+       quality, base composition and length distribution, from fastq data in 
+       a single pass. Counts are kept in NumPy arrays sized by the read length 
+       and the quality range, so memory use does not depend on the number of 
+       reads. 
+       
+       If fraction is given, only a random subset of that fraction of the 
+       reads is profiled. The subset is drawn from a generator seeded with 
+       seed, so it is the same between runs and, for paired files of the same 
+       length, selects the same pairs in both reads. If max_reads is given, 
+       profiling stops after that many reads have been profiled. The quality 
+       offset is detected from the data, as in FastQC, unless offset is given"""
+    
+    def __init__(self, fraction=None, seed=0, max_reads=None, offset=None):
+        self.fraction = fraction
+        self.seed = seed
+        self.max_reads = max_reads
+        self.offset = offset
+        self.reset()
+        
+    def reset(self):
+        """Clear all counts
+        """
+        self.total = 0
+        self.filename = None
+        self._random = np.random.RandomState(self.seed)
+        # Counts of each quality character and of each base code, by cycle 
+        self._qualities = np.zeros((0,128), dtype=np.int64)
+        self._bases = np.zeros((0,6), dtype=np.int64)
+        # Counts of each average quality character, GC percentage and read length, by read
+        self._read_qualities = np.zeros(128, dtype=np.int64)
+        self._read_gc = np.zeros(101, dtype=np.int64)
+        self._lengths = np.zeros(0, dtype=np.int64)
+        
+    def done(self):
+        """Return True if max_reads reads have been profiled
+        """
+        return self.max_reads is not None and self.total >= self.max_reads
+    
+    def profile(self, fname, decompress=None, block_size=BLOCK_SIZE):
+        """Profile the reads in a fastq file and return the FastQC-style 
+           statistics, see fastqc_summary 
+        """
+        self.filename = os.path.basename(fname)
+        fp = FastQParser(fname, block_size=block_size, decompress=decompress)
+        try:
+            for batch in fp.batches():
+                self.add_batch(batch)
+                if self.done():
+                    break
+        finally:
+            fp.close()
+        return self.fastqc_summary()
+    
+    def add_batch(self, batch):
+        """Add the reads in a FastQBatch to the counts
+        """
+        if self.fraction is not None:
+            batch = batch.select(self._random.random_sample(len(batch)) < self.fraction)
+        if self.max_reads is not None:
+            batch = batch.slice(0, max(0, self.max_reads - self.total))
+        if len(batch) == 0:
+            return
+        self.total += len(batch)
+        
+        # Work on the raw characters, the offset is not known until all reads have been seen
+        values, starts, lengths = quality_values(batch.qualities, 0)
+        self._grow(lengths.max())
+        cycles = np.arange(len(values)) - np.repeat(starts, lengths)
+        self._qualities[:lengths.max()] += np.bincount(cycles*128 + values, 
+                                                       minlength=128*lengths.max()).reshape((-1,128))
+        self._lengths += np.bincount(lengths, minlength=len(self._lengths))
+        nonempty = lengths > 0
+        averages = _string_sums(values, starts, lengths)[nonempty]//lengths[nonempty]
+        self._read_qualities += np.bincount(averages, minlength=128)
+        
+        codes, starts, lengths = quality_values(batch.sequences, 0)
+        codes = _BASE_CODES[codes]
+        self._grow(lengths.max())
+        cycles = np.arange(len(codes)) - np.repeat(starts, lengths)
+        self._bases[:lengths.max()] += np.bincount(cycles*6 + codes, 
+                                                   minlength=6*lengths.max()).reshape((-1,6))
+        nonempty = lengths > 0
+        gc = _string_sums((codes == 0) | (codes == 3), starts, lengths)[nonempty]
+        gc = round_array(100.0*gc/lengths[nonempty]).astype(np.int64)
+        self._read_gc += np.bincount(gc, minlength=101)
+        
+    def _grow(self, cycles):
+        """Extend the per-cycle counts to cover reads of the given length
+        """
+        if cycles > len(self._qualities):
+            self._qualities = np.vstack((self._qualities, np.zeros((cycles - len(self._qualities),128), dtype=np.int64)))
+        if cycles > len(self._bases):
+            self._bases = np.vstack((self._bases, np.zeros((cycles - len(self._bases),6), dtype=np.int64)))
+        if cycles >= len(self._lengths):
+            self._lengths = np.concatenate((self._lengths, np.zeros(cycles + 1 - len(self._lengths), dtype=np.int64)))
+        
+    def encoding(self):
+        """Return the name of the quality encoding and its offset, guessed 
+           from the lowest quality character as in FastQC
+        """
+        observed = np.nonzero(self._qualities.sum(axis=0))[0]
+        if self.offset is not None:
+            return ("Sanger / Illumina 1.9" if self.offset == 33 else "Illumina 1.5", self.offset)
+        if len(observed) == 0 or observed[0] < 64:
+            return ("Sanger / Illumina 1.9", 33)
+        return ("Illumina 1.5", 64)
+    
+    def fastqc_summary(self):
+        """Return the statistics as a dict keyed by FastQC module name, holding 
+           the columns of each module as lists of strings. This is the layout 
+           of ExtendedFastQCParser.get_fastqc_summary, with one row per base 
+           (as with FastQC --nogroup). Sequence duplication levels, 
+           overrepresented sequences and kmer content are not computed and 
+           are returned as empty dicts
+        """
+        name, offset = self.encoding()
+        cycles = np.nonzero(self._qualities.sum(axis=1))[0]
+        base = [str(x + 1) for x in cycles]
+        
+        # Per base quality quantiles are computed as in FastQC, on the quality counts
+        counts = self._qualities[cycles, offset:]
+        totals = counts.sum(axis=1)
+        cumulative = np.cumsum(counts, axis=1)
+        def percentile(p):
+            return _fastqc_values(np.argmax(cumulative >= (totals*p//100)[:,None], axis=1).astype(np.float64))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean = (counts*np.arange(counts.shape[1])).sum(axis=1).astype(np.float64)/totals
+        
+        read_qualities = self._read_qualities[offset:]
+        observed = np.nonzero(read_qualities)[0]
+        quality_range = np.arange(observed[0], observed[-1] + 1) if len(observed) else []
+        
+        bases = self._bases[cycles].astype(np.float64)
+        called = bases[:,:4].sum(axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            content = 100*bases[:,:4]/called[:,None]
+            gc_content = 100*(bases[:,0] + bases[:,3])/called
+            n_content = 100*bases[:,4]/(called + bases[:,4])
+            total_gc = 100*(bases[:,0] + bases[:,3]).sum()/called.sum()
+        
+        observed = np.nonzero(self._lengths)[0]
+        length_range = np.arange(observed[0], observed[-1] + 1) if len(observed) else []
+        if len(observed) == 0:
+            seq_length = "0"
+        elif observed[0] == observed[-1]:
+            seq_length = str(observed[0])
+        else:
+            seq_length = "{}-{}".format(observed[0], observed[-1])
+        
+        return {"Basic Statistics": {"Measure": ["Filename", "File type", "Encoding", "Total Sequences", 
+                                                 "Filtered Sequences", "Sequence length", "%GC"],
+                                     "Value": [str(self.filename), "Conventional base calls", name, str(self.total), 
+                                               "0", seq_length, str(int(total_gc)) if self.total > 0 else "0"]},
+                "Per base sequence quality": {"Base": base, "Mean": _fastqc_values(mean), 
+                                              "Median": percentile(50), 
+                                              "Lower Quartile": percentile(25), "Upper Quartile": percentile(75), 
+                                              "10th Percentile": percentile(10), "90th Percentile": percentile(90)},
+                "Per sequence quality scores": {"Quality": [str(x) for x in quality_range],
+                                                "Count": _fastqc_values(read_qualities[quality_range])},
+                "Per base sequence content": {"Base": base, "G": _fastqc_values(content[:,0]), 
+                                              "A": _fastqc_values(content[:,1]), "T": _fastqc_values(content[:,2]), 
+                                              "C": _fastqc_values(content[:,3])},
+                "Per base GC content": {"Base": base, "%GC": _fastqc_values(gc_content)},
+                "Per sequence GC content": {"GC Content": [str(x) for x in range(101)], 
+                                            "Count": _fastqc_values(self._read_gc)},
+                "Per base N content": {"Base": base, "N-Count": _fastqc_values(n_content)},
+                "Sequence Length Distribution": {"Length": [str(x) for x in length_range],
+                                                 "Count": _fastqc_values(self._lengths[length_range])},
+                "Sequence Duplication Levels": {},
+                "Overrepresented sequences": {},
+                "Kmer Content": {}}
+
+def _fastqc_values(x):
+    """Format an array of numbers as FastQC writes them, i.e. as floating point strings
+    """
+    return [repr(float(v)) for v in x]
+
+def profile_fastq(fname, fraction=None, seed=0, max_reads=None, decompress=None):
+    """Profile a fastq file with FastQProfiler and return the statistics in the 
+       same layout as SampleRunMetricsParser.read_fastqc_metrics
+    """
+    profiler = FastQProfiler(fraction=fraction, seed=seed, max_reads=max_reads)
+    return {'stats': profiler.profile(fname, decompress=decompress)}
+
+class _BloomFilter:
+    """A fixed size Bloom filter stored as a packed bit array. Keys are 
+       given as two arrays of 64-bit hashes, from which the nhashes bit 
+       positions of each key are derived by double hashing"""
+    
+    def __init__(self, capacity, error_rate):
+        self.capacity = capacity
+        self.count = 0
+        self.nbits = max(8, int(math.ceil(-capacity*math.log(error_rate)/math.log(2)**2)))
+        self.nhashes = max(1, int(round(self.nbits*math.log(2)/capacity)))
+        self.bits = np.zeros((self.nbits + 7)//8, dtype=np.uint8)
+        
+    def _positions(self, h1, h2):
+        positions = (h1[:,None] + np.arange(self.nhashes, dtype=np.uint64)[None,:]*h2[:,None]) % np.uint64(self.nbits)
+        return (positions >> np.uint64(3)).astype(np.intp), (np.uint8(1) << (positions & np.uint64(7)).astype(np.uint8))
+    
+    def contains(self, h1, h2):
+        index, mask = self._positions(h1, h2)
+        return np.all(self.bits[index] & mask, axis=1)
+    
+    def add(self, h1, h2):
+        index, mask = self._positions(h1, h2)
+        np.bitwise_or.at(self.bits, index.ravel(), mask.ravel())
+        self.count += len(h1)
+
+class ScalableBloomFilter:
+    """A Bloom filter that grows with the number of keys added, as described
+       by Almeida et al. (2007). Keys are added to the most recent filter until 
+       it holds its capacity, when a new filter with growth times the capacity 
+       and ratio times the error rate is started. The false positive rate of 
+       all filters together stays below error_rate, without knowing the number
+       of keys in advance"""
+    
+    def __init__(self, capacity=1000000, error_rate=1e-3, growth=2, ratio=0.5):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.growth = growth
+        self.ratio = ratio
+        self.filters = []
+        self._add_filter()
+        
+    def __len__(self):
+        return sum([f.count for f in self.filters])
+        
+    def _add_filter(self):
+        n = len(self.filters)
+        self.filters.append(_BloomFilter(self.capacity*self.growth**n, 
+                                         self.error_rate*(1 - self.ratio)*self.ratio**n))
+    
+    def contains(self, h1, h2):
+        """Return a boolean array telling which of the keys may have been added
+        """
+        found = np.zeros(len(h1), dtype=bool)
+        for f in self.filters:
+            found |= f.contains(h1, h2)
+        return found
+    
+    def add(self, h1, h2):
+        """Add keys to the filter
+        """
+        start = 0
+        while start < len(h1):
+            f = self.filters[-1]
+            end = min(len(h1), start + f.capacity - f.count)
+            f.add(h1[start:end], h2[start:end])
+            start = end
+            if f.count >= f.capacity:
+                self._add_filter()
+                
+    def nbytes(self):
+        return sum([f.bits.nbytes for f in self.filters])
+
+class _DigestSet:
+    """A set of 64-bit digests, held in a sorted array with the most recent
+       additions in a set that is merged into the array when it grows large"""
+    
+    def __init__(self, buffer_size=1024*1024):
+        self.buffer_size = buffer_size
+        self._sorted = np.zeros(0, dtype=np.uint64)
+        self._recent = set()
+        
+    def __len__(self):
+        return len(self._sorted) + len(self._recent)
+    
+    def contains(self, digests):
+        index = np.minimum(np.searchsorted(self._sorted, digests), max(0, len(self._sorted) - 1))
+        found = (self._sorted[index] == digests) if len(self._sorted) > 0 else np.zeros(len(digests), dtype=bool)
+        return found | np.array([d in self._recent for d in digests.tolist()], dtype=bool)
+    
+    def add(self, digests):
+        self._recent.update(digests.tolist())
+        if len(self._recent) > max(self.buffer_size, len(self._sorted)//8):
+            recent = np.fromiter(self._recent, dtype=np.uint64, count=len(self._recent))
+            self._sorted = np.union1d(self._sorted, recent)
+            self._recent = set()
+            
+    def nbytes(self):
+        # A set entry takes roughly 24 bytes in its table and 24 bytes for the integer object
+        return self._sorted.nbytes + 48*len(self._recent)
+
+class FastQDeduplicator:
+    """Finds the first occurrence of each read sequence, or of each pair of 
+       sequences for paired reads, in a single pass over batches of reads. 
+       
+       Every sequence is hashed with md5. The hashes are looked up in a 
+       ScalableBloomFilter, so that sequences that have not been seen before
+       are recognized without a further lookup. If exact is True, the 64-bit
+       digests of all sequences are also kept, taking about 8 bytes per
+       unique sequence, and sequences the Bloom filter reports as seen are 
+       confirmed against them. Otherwise only the Bloom filter is used and a
+       fraction of at most error_rate of the unique sequences will be taken 
+       for duplicates. capacity is the number of sequences the first Bloom 
+       filter is sized for, the filter grows beyond that as needed"""
+    
+    def __init__(self, exact=True, error_rate=1e-3, capacity=1000000):
+        self.bloom = ScalableBloomFilter(capacity=capacity, error_rate=error_rate)
+        self.digests = _DigestSet() if exact else None
+        self.records = 0
+        self.duplicates = 0
+        self.candidates = 0
+        self.false_positives = 0
+        
+    def _hashes(self, keys):
+        digests = np.frombuffer("".join([hashlib.md5(k).digest() for k in keys]), dtype=np.uint64)
+        return digests[0::2], digests[1::2]
+    
+    def unique(self, batch, mate=None):
+        """Return a boolean array telling which of the records in batch are the 
+           first occurrence of their sequence. If mate is given, the records 
+           in batch and mate are taken to be pairs and the pair of sequences 
+           is used
+        """
+        if mate is None:
+            keys = batch.sequences
+        else:
+            keys = imap("\t".join, izip(batch.sequences, mate.sequences))
+        h1, h2 = self._hashes(keys)
+        
+        # Only the first occurrence of each sequence within the batch is looked up
+        first = np.sort(np.unique(h1, return_index=True)[1])
+        h1, h2 = h1[first], h2[first]
+        seen = self.bloom.contains(h1, h2)
+        self.candidates += np.count_nonzero(seen)
+        if self.digests is not None:
+            confirmed = self.digests.contains(h1[seen])
+            self.false_positives += len(confirmed) - np.count_nonzero(confirmed)
+            seen[seen] = confirmed
+            self.digests.add(h1[~seen])
+        self.bloom.add(h1[~seen], h2[~seen])
+        
+        keep = np.zeros(len(batch), dtype=bool)
+        keep[first[~seen]] = True
+        self.records += len(batch)
+        self.duplicates += len(batch) - np.count_nonzero(keep)
+        return keep
+    
+    def nbytes(self):
+        """Return the approximate memory used for the Bloom filter and the digests
+        """
+        return self.bloom.nbytes() + (self.digests.nbytes() if self.digests is not None else 0)
+
+def deduplicate_fastq(fastq1, out1, fastq2=None, out2=None, exact=True, error_rate=1e-3, 
+                      capacity=1000000, decompress=None):
+    """Write the first occurrence of each sequence in fastq1 to out1, reading 
+       and writing in a single pass. If fastq2 is given, it should contain the 
+       mates of the reads in fastq1 and pairs are written to out1 and out2 if 
+       the pair of sequences has not been seen before. See FastQDeduplicator 
+       for exact, error_rate and capacity. Returns the FastQDeduplicator, 
+       which holds the number of records and duplicates
+    """
+    dedup = FastQDeduplicator(exact=exact, error_rate=error_rate, capacity=capacity)
+    readers = [FastQParser(f, decompress=decompress) for f in [fastq1, fastq2] if f is not None]
+    writers = [FastQWriter(f) for f in [out1, out2][0:len(readers)]]
+    try:
+        for batches in lockstep_batches([r.batches() for r in readers]):
+            if None in batches:
+                raise ValueError("{} and {} do not contain the same number of records".format(fastq1, fastq2))
+            keep = dedup.unique(*batches)
+            for writer, batch in izip(writers, batches):
+                writer.write_batch(batch.select(keep))
+    finally:
+        for f in readers + writers:
+            f.close()
+    return dedup
+
 def parse_header(header):
     """Parses the FASTQ header as specified by CASAVA 1.8.2 and returns the fields in a dictionary
        @<instrument>:<run number>:<flowcell ID>:<lane>:<tile>:<x-pos>:<y-pos> <read>:<is filtered>:<control number>:<index sequence>
@@ -172,65 +1066,153 @@ def is_read_pair(rec1, rec2, casava18=True):
     r2 = rec2[0].split(' ')
     return (len(r1) == 2 and len(r2) == 2 and r1[0] == r2[0] and r1[1][1:] == r2[1][1:])
 
-def demultiplex_fastq(outdir, samplesheet, fastq1, fastq2=None):
-    """Demultiplex a bcl-converted illumina fastq file. Assumes it has the index sequence
-    in the header a la CASAVA 1.8+
+def header_lane_index(header):
+    """Return the lane and index fields of a CASAVA 1.8+ header as strings, without
+    parsing the remaining fields as parse_header does
+    """
+    return header.split(":",4)[3], header[header.rfind(":")+1:]
+
+def lockstep_batches(readers):
+    """Iterate over the batches from several FastQBlockReaders in lockstep, yielding
+    lists with one batch per reader covering the same records. If a reader runs out 
+    of records before the others, None is yielded in its place
     """
-    outfiles = {}
+    readers = [iter(r) for r in readers]
+    pending = [next(r, None) for r in readers]
+    while any([p is not None for p in pending]):
+        n = min([len(p) for p in pending if p is not None])
+        yield [p.slice(0,n) if p is not None else None for p in pending]
+        for i, p in enumerate(pending):
+            if p is None:
+                continue
+            if n < len(p):
+                pending[i] = p.slice(n,len(p))
+            else:
+                pending[i] = next(readers[i], None)
+
+def _demultiplex_batches(args):
+    """Sort the records in a list of batches (one per read) by the lane and index in 
+    their headers, keeping those in targets. Returns the number of records and the 
+    fastq text with the records for each read, keyed by (lane, index)
+    """
+    batches, targets = args
     counts = {}
-    sdata = HiSeqRun.parse_samplesheet(samplesheet)
-    reads = [1]
-    if fastq2 is not None:
-        reads.append(2)
-        
-    # For each Lane-Index combination, create a file and open a filehandle
-    for sd in sdata:
-        lane = sd['Lane']
-        index = sd['Index']
-        if lane not in outfiles:
-            outfiles[lane] = {}
-            counts[lane] = {}
-        outfiles[lane][index] = []
-        counts[lane][index] = 0
-        for read in reads:
-            fname = "tmp_{}_{}_L00{}_R{}_001.fastq.gz".format(sd['SampleID'],
-                                                              index,
-                                                              lane,
-                                                              read)
-            outfiles[lane][index].append(FastQWriter(os.path.join(outdir,fname)))
-    
-    # Parse the input file(s) and write the records to the appropriate output files
-    fhs = [FastQParser(fastq1)]
-    if fastq2 is not None:
-        fhs.append(FastQParser(fastq2))
-        
-    for r, fh in enumerate(fhs):
-        for record in fh:
-            header = parse_header(record[0])
-            lane = str(header['lane'])
-            index = header['index']
-            if lane in outfiles and index in outfiles[lane]:
-                outfiles[lane][index][r].write(record)
-                counts[lane][index] += 1
-    
-    # Close filehandles and replace the handles with the file names
-    for lane in outfiles.keys():
-        for index in outfiles[lane].keys():
-            for r, fh in enumerate(outfiles[lane][index]):
-                fh.close()
-                fname = fh.name()
-                # If no sequences were written, remove the temporary file and the entry from the results
-                if counts[lane][index] == 0:
-                    os.unlink(fname)
-                    del outfiles[lane][index]
-                    break
-                
-                # Rename the temporary file to a persistent name
-                nname = fname.replace("tmp_","")
+    blocks = {}
+    for r, batch in enumerate(batches):
+        if batch is None:
+            continue
+        groups = {}
+        for key, record in izip(imap(header_lane_index, batch.headers), 
+                                izip(batch.headers, batch.sequences, batch.optional, batch.qualities)):
+            if key in targets:
+                groups.setdefault(key, []).append("\n".join(record))
+        for key, records in groups.items():
+            counts[key] = counts.get(key, 0) + len(records)
+            blocks.setdefault(key, [None]*len(batches))[r] = ("\n".join(records) + "\n", len(records))
+    return counts, blocks
+
+class FastQDemultiplexer:
+    """Demultiplex bcl-converted illumina fastq files by the lane and index sequence in 
+       the CASAVA 1.8+ headers. The reads are parsed in lockstep, one block at a time. 
+       With workers > 1, each block is sorted by a pool of worker processes, with at
+       most 2 blocks per worker in flight; by default, the blocks are sorted in the 
+       calling process. The sorted records are written through a FastQWriterPool with
+       compress_workers compression threads at gzip level compresslevel, 9 by default
+       as for FastQWriter; level 6 is considerably faster for slightly larger files.
+       After run(), counts holds the number of records written for each lane and 
+       index, summed over the reads"""
+    
+    def __init__(self, outdir, samplesheet, workers=1, compresslevel=9, block_size=BLOCK_SIZE, compress_workers=1):
+        self.outdir = outdir
+        self.samplesheet = samplesheet
+        self.workers = workers
+        self.compresslevel = compresslevel
+        self.block_size = block_size
+        self.compress_workers = compress_workers
+        self.counts = {}
+        
+    def run(self, fastq1, fastq2=None):
+        """Demultiplex the fastq file(s) and return a dict with the output files,
+        as described for demultiplex_fastq
+        """
+        fastq_files = [f for f in [fastq1, fastq2] if f is not None]
+        samples = {}
+        for sd in HiSeqRun.parse_samplesheet(self.samplesheet):
+            samples[(sd['Lane'], sd['Index'])] = sd['SampleID']
+        targets = frozenset(samples.keys())
+        
+        # The writers of a lane and index are opened when its first records are found
+        pool = FastQWriterPool(self.compress_workers, self.compresslevel)
+        writers = {}
+        counts = dict([(key, 0) for key in targets])
+        readers = [FastQBlockReader(open_fastq(f), self.block_size) for f in fastq_files]
+        tasks = imap(lambda batches: (batches, targets), lockstep_batches(readers))
+        try:
+            for chunk_counts, blocks in self._process(tasks):
+                for key, n in chunk_counts.items():
+                    counts[key] += n
+                for key, data in blocks.items():
+                    if key not in writers:
+                        writers[key] = [pool.writer(self._tmp_name(samples[key], key, r)) for r in xrange(len(fastq_files))]
+                    for r, block in enumerate(data):
+                        if block is not None:
+                            writers[key][r].write_text(*block)
+        finally:
+            # Closing the pool also writes an empty gzip file for reads without any records
+            pool.close()
+        
+        # Rename the temporary files and collect the output per lane and index 
+        outfiles = {}
+        self.counts = {}
+        for (lane, index), n in counts.items():
+            outfiles.setdefault(lane, {})
+            self.counts.setdefault(lane, {})[index] = n
+            if n == 0:
+                continue
+            outfiles[lane][index] = []
+            for w in writers[(lane, index)]:
+                fname = w.name()
+                nname = os.path.join(os.path.dirname(fname), os.path.basename(fname)[len("tmp_"):])
                 os.rename(fname,nname)
-                outfiles[lane][index][r] = nname
+                outfiles[lane][index].append(nname)
+        return outfiles
+    
+    def _tmp_name(self, sample, key, r):
+        lane, index = key
+        return os.path.join(self.outdir, "tmp_{}_{}_L00{}_R{}_001.fastq.gz".format(sample, index, lane, r+1))
     
-    return outfiles
+    def _process(self, tasks):
+        """Process the tasks in order, in a pool of worker processes if more than one
+        worker was requested
+        """
+        if self.workers <= 1:
+            for result in imap(_demultiplex_batches, tasks):
+                yield result
+            return
+        pool = Pool(self.workers)
+        try:
+            pending = deque()
+            for task in tasks:
+                pending.append(pool.apply_async(_demultiplex_batches, (task,)))
+                if len(pending) >= 2*self.workers:
+                    yield pending.popleft().get()
+            while pending:
+                yield pending.popleft().get()
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+def demultiplex_fastq(outdir, samplesheet, fastq1, fastq2=None, workers=1, compresslevel=9, compress_workers=1):
+    """Demultiplex a bcl-converted illumina fastq file. Assumes it has the index sequence
+    in the header a la CASAVA 1.8+. Returns a dict with the lanes in the samplesheet as keys 
+    and, for each lane, a dict with the output files for each index that had any records.
+    The records are sorted in the calling process unless more workers are requested.
+    See FastQDemultiplexer for a description of the parameters
+    """
+    return FastQDemultiplexer(outdir, samplesheet, workers, compresslevel, compress_workers=compress_workers).run(fastq1, fastq2)
 
   
 def create_final_name(fname, date, fc_id, sample_name):
@@ -6,34 +6,58 @@ import ConfigParser
 import re
 import os
 import traceback
-from scilifelab.utils.fastq_utils import BarcodeExtractor
+from scilifelab.utils.fastq_utils import count_barcodes
 from scilifelab.utils.string import hamming_distance
 from scilifelab.illumina.hiseq import HiSeqRun
 from scilifelab.illumina import map_index_name
-from collections import Counter
-from itertools import imap
- 
-def extract_barcodes(fqfile1, lane, fqfile2=None, nindex=25, casava18=True, offset=101, bclen=6, expected=[], mismatch=True):
+from collections import OrderedDict
+from multiprocessing import Pool, cpu_count
+
+HEADER = ['lane', 'sequence', 'count', 'index_name']
+
+def extract_barcodes(fqfile1, lane, fqfile2=None, nindex=25, casava18=True, offset=101, bclen=6, expected=[], mismatch=True, capacity=10000):
     """Parse the fastq file and extract barcodes. Return a dict structure suitable for upload to StatusDB
     """
+    c = count_barcodes(fqfile1, fqfile2, casava18, offset, bclen, capacity, expected_barcodes(expected, mismatch))
+    return [HEADER, format_counts(c, lane, nindex, mismatch)]
+
+def extract_lanes(jobs, nindex=25, casava18=True, offset=101, mismatch=True, capacity=10000, processes=None):
+    """Extract and count the barcodes for several lanes in parallel processes. 
+    jobs is a list of (lane, fqfile1, fqfile2, expected, bclen) tuples, fqfile2 
+    may be None. The counts for jobs with the same lane are merged. Returns the 
+    header and the top nindex barcodes of each lane, in the order of the lanes in jobs
+    """
+    args = [(fq1, fq2, casava18, offset, bclen, capacity, expected_barcodes(expected, mismatch))
+            for lane, fq1, fq2, expected, bclen in jobs]
+    pool = Pool(processes or min(len(jobs), cpu_count()))
+    try:
+        counters = pool.map(_count_barcodes, args)
+    finally:
+        pool.close()
+        pool.join()
     
-    bcx = BarcodeExtractor(fqfile1, casava18, offset, bclen)
-    c = {}
+    lanes = OrderedDict()
+    for (lane, fq1, fq2, expected, bclen), c in zip(jobs, counters):
+        if lane in lanes:
+            lanes[lane].merge(c)
+        else:
+            lanes[lane] = c
+    counts = []
+    for lane, c in lanes.items():
+        counts.extend(format_counts(c, lane, nindex, mismatch))
+    return [HEADER, counts]
 
-    if fqfile2 is None:
-        c = Counter(bcx)
-    else:
-        bcx2 = BarcodeExtractor(fqfile2, casava18, offset, bclen)
-        c = Counter(imap(lambda x, y: x+y, bcx, bcx2))
+def _count_barcodes(args):
+    return count_barcodes(*args)
 
-    c = remove_expected(c,expected,mismatch)
+def format_counts(counter, lane, nindex, mismatch):
+    """Format the nindex most common barcodes in a BarcodeCounter as rows for write_metrics
+    """
     counts = []
-    header = ['lane', 'sequence', 'count', 'index_name']
-    for bc, count in c.most_common(nindex):
-        counts.append(dict(zip(header,
+    for bc, count in counter.most_common(nindex):
+        counts.append(dict(zip(HEADER,
                                [lane, bc, count, ','.join(map_index_name(bc,int(mismatch)))])))
-        
-    return [header, counts]
+    return counts
 
 def write_metrics(header, counts):
     """Write the counts to stdout
@@ -62,21 +86,19 @@ def generate_mismatches(src):
         
     return list(set(seqs))
 
-def remove_expected(bc_counter, expected_bc, mismatch=False):
+def expected_barcodes(expected_bc, mismatch=False):
     """
-    Remove the entries corresponding to the supplied list of expected barcodes, 
+    Return the list of barcodes corresponding to the supplied list of expected barcodes, 
     optionally allowing for one mismatch 
     """
+    bcs = []
     for bc in expected_bc:
         if mismatch:
-            bcs = generate_mismatches(bc)
+            bcs.extend(generate_mismatches(bc))
         else:
-            bcs = [bc]
-            
-        for b in bcs:
-            del bc_counter[b]
+            bcs.append(bc)
             
-    return bc_counter
+    return list(set(bcs))
     
 def get_expected(csv_file, lane):
     """Extract the expected barcodes in a lane from a supplied csv samplesheet
@@ -112,6 +134,28 @@ def get_expected_from_db(infile, config_file):
     found_bc = re.search('\(([GCTAN-]*)\)$',label).group(1)
     return [found_bc.replace('-','')]
 
+def get_lane_expected(args, infile1, infile2, lane, config_file):
+    """Return the expected barcodes, the barcode length and the second input file to use for a lane
+    """
+    bc_length = int(args.barcode_length)
+    expected = []
+    if args.csvfile is not None:
+        expected = get_expected(args.csvfile,lane)
+    if args.db:
+        try:
+            expected = get_expected_from_db(infile1, config_file)
+            bc_length = len(expected[0])
+            # If a dual-index FC setup
+            if infile2 is not None:
+                # Expected barcode is dual-indexed
+                if bc_length > 8:
+                    bc_length = bc_length / 2
+                else:
+                    infile2 = None
+        except Exception:
+            traceback.print_exc()
+    return expected, bc_length, infile2
+
 def main():
     
     parser = argparse.ArgumentParser(description="""Extract and count barcodes indices from fastq file""")
@@ -132,37 +176,43 @@ def main():
     parser.add_argument('--db', action='store_true', default=False,
                         help='Will try fetch the expected barcode from StatusDB. Useful when sample has no index in samplesheet')
     parser.add_argument('--config', action='store', help="Path to PM configuration file, used to connec to StatusDB")
-    parser.add_argument('infile1', action='store',
+    parser.add_argument('--capacity', action='store', type=int, default=10000,
+                        help="The number of distinct barcodes to keep counts for. Counts of the top indexes are exact " \
+                        "as long as the barcodes not tracked are rarer than the reported ones. Default is 10000")
+    parser.add_argument('--lane', dest='lanes', action='append', nargs='+', default=[], metavar=('LANE', 'INFILE'),
+                        help="A lane and its input FastQ file(s), given as LANE INFILE1 [INFILE2]. Can be given " \
+                        "several times to process lanes in parallel, counts for the same lane are merged. Replaces " \
+                        "the positional arguments")
+    parser.add_argument('-p','--processes', action='store', type=int, default=None,
+                        help="The number of processes to use with --lane. Default is one per input, up to the number of cpus")
+    parser.add_argument('infile1', action='store', default=None, nargs='?',
                         help="The input FastQ file to process. Can be gzip compressed")
     parser.add_argument('infile2', action='store', default=None, nargs='?',
                         help="(Optional) The second input FastQ file. Indices will be concatenated to the ones in infile1")
-    parser.add_argument('lane', action='store', default=None, 
+    parser.add_argument('lane', action='store', default=None, nargs='?',
                         help="The lane to be analyzed")
     
     args = parser.parse_args()
-    bc_length = int(args.barcode_length)
+    # With an optional second file, the lane ends up in infile2 if only two positional arguments are given
+    if args.lane is None and args.infile2 is not None:
+        args.lane, args.infile2 = args.infile2, None
+    if not args.lanes and (args.infile1 is None or args.lane is None):
+        parser.error("an input file and a lane, or --lane, are required")
+    if any([len(l) not in [2,3] for l in args.lanes]):
+        parser.error("--lane takes a lane and one or two input files")
     config_file = args.config if args.config else os.path.join(os.environ['HOME'], '.pm/pm.conf')
 
-    expected = []
-    if args.csvfile is not None:
-        expected = get_expected(args.csvfile,args.lane)
-    if args.db:
-        try:
-            expected = get_expected_from_db(args.infile1, config_file)
-            bc_length = len(expected[0])
-            # If a dual-index FC setup
-            if args.infile2 is not None:
-                # Expected barcode is dual-indexed
-                if bc_length > 8:
-                    bc_length = bc_length / 2
-                else:
-                    args.infile2 = None
-        except Exception:
-            traceback.print_exc()
-
-    header, counts = extract_barcodes(args.infile1, args.lane, args.infile2, int(args.nindex), args.casava18, int(args.offset), bc_length, expected, args.mismatch)
+    if not args.lanes:
+        expected, bc_length, infile2 = get_lane_expected(args, args.infile1, args.infile2, args.lane, config_file)
+        header, counts = extract_barcodes(args.infile1, args.lane, infile2, int(args.nindex), args.casava18, int(args.offset), bc_length, expected, args.mismatch, args.capacity)
+    else:
+        jobs = []
+        for l in args.lanes:
+            lane, infile1, infile2 = (l + [None])[0:3]
+            expected, bc_length, infile2 = get_lane_expected(args, infile1, infile2, lane, config_file)
+            jobs.append((lane, infile1, infile2, expected, bc_length))
+        header, counts = extract_lanes(jobs, int(args.nindex), args.casava18, int(args.offset), args.mismatch, args.capacity, args.processes)
     write_metrics(header, counts)
     
 if __name__ == "__main__":
     main()
- 
@@ -1,5 +1,6 @@
 import os
 import sys
+import numpy as np
 import scilifelab.utils.fastq_utils as fastq_utils
 import argparse
 
@@ -46,28 +47,23 @@ def process_fastq(fastq_r1, fastq_r2, bins, phred_offset, casava17):
         oh1[b] = fastq_utils.FastQWriter("%s.Q%d%s" % (root1,b,ext1))
         oh2[b] = fastq_utils.FastQWriter("%s.Q%d%s" % (root2,b,ext2))
     
-    for r1 in fh_r1:
-        r2 = fh_r2.next()
-        assert fastq_utils.is_read_pair(r1,r2,not casava17), "FATAL: Read identifiers differ for paired reads ({:s} and {:s})".format(r1[0],r2[0])
+    # Process the read pairs a block at a time
+    for b1, b2 in fastq_utils.lockstep_batches([fh_r1.batches(), fh_r2.batches()]):
+        assert b1 is not None and b2 is not None, "FATAL: The fastq files contain different numbers of reads"
+        for h1, h2 in zip(b1.headers, b2.headers):
+            assert fastq_utils.is_read_pair([h1],[h2],not casava17), "FATAL: Read identifiers differ for paired reads ({:s} and {:s})".format(h1,h2)
 
-        bin = min(int(round(fastq_utils.avgQ(r1,phred_offset))),int(round(fastq_utils.avgQ(r2,phred_offset))))
+        qbin = fastq_utils.round_array(np.minimum(fastq_utils.avgQ_batch(b1.qualities,phred_offset),
+                                             fastq_utils.avgQ_batch(b2.qualities,phred_offset)))
         
         for b in bins:
-            if bin >= b:
-                oh1[b].write(r1)
-                oh2[b].write(r2)
+            mask = qbin >= b
+            oh1[b].write_batch(b1.select(mask))
+            oh2[b].write_batch(b2.select(mask))
         
     for oh in oh1.values() + oh2.values():
         oh.close()
 
-
-def quality_average(quality_str, phred_offset):
-    sum = 0.
-    for qual in quality_str:
-        sum += ord(qual)
-    sum -= len(quality_str)*phred_offset
-    return sum/len(quality_str)
-    
 if __name__ == "__main__":
     sys.exit(main())
     
@@ -20,9 +20,8 @@ import sys
 import time
 
 #from Bio import Seq, pairwise2
-from scilifelab.utils.fastq_utils import FastQParser, FastQWriter
+from scilifelab.utils.fastq_utils import FastQParser
 
-# TODO memoize sequence corrections? optimize somehow if possible
 # TODO ensure read 1,2 files are paired (SciLifeLab code)
 # TODO add directory processing
 
@@ -105,80 +104,255 @@ def parse_readset_byindexdict(read_1_fq, read_2_fq, read_index_fq, index_dict, o
     print(" complete.", file=sys.stderr)
     if not progress_interval: progress_interval = 1000
     if progress_interval > (total_lines_in_file / 4): progress_interval = (total_lines_in_file / 4)
-    index_fh_dict = collections.defaultdict(list)
+    output_manager = OutputHandleManager()
+    resolver = IndexResolver(index_dict.keys(), max_mismatches)
+    if resolver.collisions:
+        print("{} sequences are equally close to more than one index and will be classified as ambiguous.".format(
+              len(resolver.collisions)), file=sys.stderr)
     print("Demultiplexing...", file=sys.stderr)
     time_started = datetime.datetime.now()
     for read_1, read_2, read_ind in itertools.izip(fqp_1, fqp_2, fqp_ind):
         read_ind_seq = read_ind[1]
-        matches_dict = collections.defaultdict(list)
-        # Sort indexes by descending length to match longer indexes first
-        for supplied_index in sorted(index_dict.keys(), key=lambda x: (-len(x))):
-            mismatches = find_dist(supplied_index, read_ind_seq, max_mismatches)
-            matches_dict[mismatches].append(supplied_index)
-            if mismatches == 0:
-                break
-        for x in range(0, max_mismatches+1):
-            if matches_dict.get(x):
-                if len(matches_dict.get(x)) == 1:
-                    # Single unamibiguous match
-                    index_seq       = matches_dict[x][0]
-                    index_len       = len(index_seq)
-                    molecular_tag   = read_ind_seq[index_len:]
-                    modify_reads( (read_1, read_2), index_seq, molecular_tag)
-                    sample_name     = index_dict[index_seq] if index_dict[index_seq] else index_seq
-                    data_write_loop(read_1, read_2, sample_name, output_directory, index_fh_dict, index_seq)
-                    num_match      += 1
-                    if not x == 0:
-                        num_corrected += 1
-                    break
-                else:
-                    # Ambiguous match
-                    sample_name     = "Ambiguous"
-                    index_seq_list  = ",".join(matches_dict.get(x))
-                    modify_reads( (read_1, read_2), index_seq_list, read_ind_seq)
-                    data_write_loop(read_1, read_2, sample_name, output_directory, index_fh_dict, sample_name)
-                    num_ambigmatch += 1
-                    break
+        matches, mismatches = resolver.resolve(read_ind_seq)
+        if len(matches) == 1:
+            # Single unamibiguous match
+            index_seq       = matches[0]
+            index_len       = len(index_seq)
+            molecular_tag   = read_ind_seq[index_len:]
+            modify_reads( (read_1, read_2), index_seq, molecular_tag)
+            sample_name     = index_dict[index_seq] if index_dict[index_seq] else index_seq
+            data_write_loop(read_1, read_2, sample_name, output_directory, output_manager)
+            num_match      += 1
+            if not mismatches == 0:
+                num_corrected += 1
+        elif matches:
+            # Ambiguous match
+            sample_name     = "Ambiguous"
+            index_seq_list  = ",".join(matches)
+            modify_reads( (read_1, read_2), index_seq_list, read_ind_seq)
+            data_write_loop(read_1, read_2, sample_name, output_directory, output_manager)
+            num_ambigmatch += 1
         else:
             # No match
             sample_name     = "Undetermined"
             modify_reads( (read_1, read_2), "", read_ind_seq)
-            data_write_loop(read_1, read_2, sample_name, output_directory, index_fh_dict, sample_name)
+            data_write_loop(read_1, read_2, sample_name, output_directory, output_manager)
             num_nonmatch   += 1
         reads_processed    += 1
         if reads_processed % progress_interval == 0:
             print_progress(reads_processed, (total_lines_in_file / 4), time_started=time_started)
+    output_manager.close()
+    print("\nWrote {bytes_written} bytes to {outputs} files in {flushes} flushes " \
+          "({opens} opens, {reopens} reopens, at most {max_open} open files).".format(**output_manager.metrics()), file=sys.stderr)
     return reads_processed, num_match, num_ambigmatch, num_nonmatch, num_corrected
 
 
-def data_write_loop(read_1, read_2, sample_name, output_directory, index_fh_dict, index):
+class IndexResolver(object):
     """
-    Writes data using FastQAppender, closing files if we open too many.
+    Resolves index reads to the supplied indexes allowing for up to max_mismatches
+    mismatches, giving the same result as comparing the read to every index with
+    find_dist. Every index is expanded up front into all sequences within 
+    table_mismatches mismatches, so most reads resolve with one dict lookup per 
+    index length. Reads that cannot be resolved from the tables (other characters 
+    than the alphabet, reads shorter than the indexes or more mismatches allowed 
+    than were expanded) are compared to every index and the result is kept in an 
+    LRU cache of cache_size reads.
+    """
+    def __init__(self, indexes, max_mismatches=1, table_mismatches=2, alphabet="ACGTN", cache_size=100000):
+        # Sort indexes by descending length to match longer indexes first
+        self.indexes = sorted(indexes, key=lambda x: (-len(x)))
+        self.max_mismatches = max_mismatches
+        self.alphabet = alphabet
+        self.cache_size = cache_size
+        self._depth = min(max_mismatches, table_mismatches)
+        self._lengths = sorted(set(map(len, self.indexes)), reverse=True)
+        self._order = dict((index, n) for n, index in enumerate(self.indexes))
+        self._cache = collections.OrderedDict()
+        self.cache_hits = 0
+        self.cache_misses = 0
+        # Maps each index length to a dict of sequence -> [(index, mismatches), ...]
+        self._tables = dict((length, {}) for length in self._lengths)
+        for index in self.indexes:
+            table = self._tables[len(index)]
+            for seq, mismatches in self._expand(index):
+                table.setdefault(seq, []).append((index, mismatches))
+        # Sequences within the same distance of several indexes are ambiguous
+        self.collisions = {}
+        for table in self._tables.values():
+            for seq, hits in table.items():
+                closest = min(m for _, m in hits)
+                closest_hits = [i for i, m in hits if m == closest]
+                if len(closest_hits) > 1:
+                    self.collisions[seq] = closest_hits
+
+    def _expand(self, index):
+        """
+        Generate all sequences within self._depth substitutions of index, with their distance.
+        """
+        seen = {index: 0}
+        frontier = [index]
+        for mismatches in range(1, self._depth + 1):
+            next_frontier = []
+            for seq in frontier:
+                for pos in range(len(seq)):
+                    for base in self.alphabet:
+                        new_seq = seq[:pos] + base + seq[pos+1:]
+                        if new_seq not in seen:
+                            seen[new_seq] = mismatches
+                            next_frontier.append(new_seq)
+            frontier = next_frontier
+        return seen.items()
+
+    def resolve(self, read_ind_seq):
+        """
+        Return a list of the best matching indexes (ordered as they were compared)
+        and their number of mismatches. The list is empty if no index matched.
+        """
+        if not self._lengths:
+            return [], None
+        key = read_ind_seq[:self._lengths[0]]
+        # The tables only cover reads composed of the alphabet and long enough for all indexes
+        if len(key) < self._lengths[0] or key.strip(self.alphabet):
+            return self._resolve_cached(key)
+        matches_dict = {}
+        for length in self._lengths:
+            hits = self._tables[length].get(key[:length])
+            if hits:
+                for index, mismatches in hits:
+                    if mismatches == 0:
+                        return [index], 0
+                    matches_dict.setdefault(mismatches, []).append(index)
+        if matches_dict:
+            mismatches = min(matches_dict.keys())
+            return sorted(matches_dict[mismatches], key=self._order.get), mismatches
+        if self._depth == self.max_mismatches:
+            return [], None
+        return self._resolve_cached(key)
+
+    def _resolve_cached(self, key):
+        try:
+            result = self._cache.pop(key)
+            self.cache_hits += 1
+        except KeyError:
+            result = self._resolve_slow(key)
+            self.cache_misses += 1
+            if len(self._cache) >= self.cache_size:
+                self._cache.popitem(last=False)
+        self._cache[key] = result
+        return result
+
+    def _resolve_slow(self, read_ind_seq):
+        """
+        Compare the read to every index with find_dist.
+        """
+        matches_dict = collections.defaultdict(list)
+        for supplied_index in self.indexes:
+            mismatches = find_dist(supplied_index, read_ind_seq, self.max_mismatches)
+            matches_dict[mismatches].append(supplied_index)
+            if mismatches == 0:
+                break
+        for x in range(0, self.max_mismatches+1):
+            if matches_dict.get(x):
+                return matches_dict[x], x
+        return [], None
+
+
+def data_write_loop(read_1, read_2, sample_name, output_directory, output_manager):
+    """
+    Writes data through the OutputHandleManager, one file per sample and read.
     """
     for read_num, read in enumerate([read_1, read_2]):
+        file_path   = os.path.join(output_directory, "{sample_name}_R{read_num}.fastq".format( \
+                                                       sample_name=sample_name, read_num=read_num+1))
+        output_manager.write(file_path, "{}\n".format("\n".join([r.strip() for r in read])))
+
+
+class OutputHandleManager(object):
+    """
+    Buffers data written to many output files in memory and writes it in chunks of
+    buffer_size bytes, keeping at most max_open files open at a time. The least 
+    recently used file is closed when another one needs to be opened, and files are
+    reopened in append mode. By default, max_open is derived from the soft limit on
+    open files, less reserved_files for other uses. When more than max_buffered bytes
+    are held in total, all buffers are flushed.
+    """
+    def __init__(self, max_open=None, buffer_size=256*1024, max_buffered=256*1024*1024, reserved_files=32):
+        if max_open is None:
+            soft_limit, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+            if soft_limit == resource.RLIM_INFINITY:
+                soft_limit = 4096
+            max_open = max(1, soft_limit - reserved_files)
+        self.max_open = max_open
+        self.buffer_size = buffer_size
+        self.max_buffered = max_buffered
+        self._handles = collections.OrderedDict()
+        self._buffers = collections.defaultdict(list)
+        self._buffered = collections.defaultdict(int)
+        self._total_buffered = 0
+        self._opened = set()
+        self.opens, self.reopens, self.flushes, self.bytes_written = 0, 0, 0, 0
+
+    def write(self, path, data):
+        self._buffers[path].append(data)
+        self._buffered[path] += len(data)
+        self._total_buffered += len(data)
+        if self._buffered[path] >= self.buffer_size:
+            self.flush(path)
+        elif self._total_buffered >= self.max_buffered:
+            self.flush()
+
+    def flush(self, path=None):
+        """
+        Write the buffered data for path, or for all files if path is None.
+        """
+        paths = [path] if path is not None else self._buffers.keys()
+        for path in paths:
+            data = "".join(self._buffers.pop(path, []))
+            if not data:
+                continue
+            self._handle(path).write(data)
+            self._total_buffered -= self._buffered.pop(path)
+            self.flushes += 1
+            self.bytes_written += len(data)
+
+    def _handle(self, path):
+        """
+        Return an open file handle for path, closing the least recently used ones
+        if needed.
+        """
         try:
-            index_fh_dict[index][read_num].write(read)
-        except IndexError:
-            file_path   = os.path.join(output_directory, "{sample_name}_R{read_num}.fastq".format( \
-                                                           sample_name=sample_name, read_num=read_num+1))
-            try:
-                index_fh_dict[index].append(FastQAppender(file_path))
-            except IOError as e:
-                # Too many open filehandles
-                if e.errno == 24:
-                    for fh1, fh2 in index_fh_dict.values():
-                        map(file.close, [ fh1, fh2 ] )
-                    index_fh_dict[index].append(FastQAppender(file_path))
-                    index_fh_dict[index][read_num].write(read)
-                else:
-                    raise IOError(e)
-            except ValueError:
-                # File was closed previously
-                index_fh_dict[index][read_num].reopen()
-
-# TODO make this faster
-# TODO compare to Bio.align.pairwise2 for speed
-# TODO possibly @memoize somehow
+            fh = self._handles.pop(path)
+        except KeyError:
+            while len(self._handles) >= self.max_open:
+                self._handles.popitem(last=False)[1].close()
+            while True:
+                try:
+                    fh = open(path, "ab")
+                    break
+                except IOError as e:
+                    # Too many open filehandles despite the limit, open fewer from now on
+                    if e.errno != 24 or not self._handles:
+                        raise
+                    self.max_open = len(self._handles)
+                    self._handles.popitem(last=False)[1].close()
+            self.opens += 1
+            if path in self._opened:
+                self.reopens += 1
+            self._opened.add(path)
+        self._handles[path] = fh
+        return fh
+
+    def close(self):
+        self.flush()
+        for fh in self._handles.values():
+            fh.close()
+        self._handles.clear()
+
+    def metrics(self):
+        return {"outputs": len(self._opened), "opens": self.opens, "reopens": self.reopens,
+                "flushes": self.flushes, "bytes_written": self.bytes_written, "max_open": self.max_open}
+
+
 def find_dist(str_01, str_02, max_mismatches=None, approach="shorten"):
     """
     Find the number of mismatches between two strings. The longer string is truncated
@@ -359,26 +533,6 @@ def iter_sample_fast(iterable, samplesize, total_size):
     return results
 
 
-class FastQAppender(FastQWriter):
-    """
-    A good deal like the FastQWriter but appends instead of writing.
-    Also allows file re-opening.
-    """
-    def __init__(self, file):
-        self.fname = file
-        fh = open(file,"ab")
-        if file.endswith(".gz"):
-            self._fh = gzip.GzipFile(fileobj=fh)
-        else:
-            self._fh = fh
-        self._records_written = 0
-
-    def reopen(self):
-        _records_written = self._records_written
-        self.__init__(self.fname)
-        self._records_written = _records_written
-
-
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
 
@@ -1,64 +1,47 @@
 """
-Reads a FastQ file from stdin and writes a file with unique records to sdout
+Reads a FastQ file, or a pair of FastQ files, and writes the first occurrence 
+of each read sequence (pair) to <prefix>-unique.fastq.gz, in a single pass
 usage:
-    %s < in.fastq > out.unique.fastq
+    %s [--probabilistic] [--error-rate RATE] [--capacity N] in_1.fastq [in_2.fastq]
+
+Sequences are screened with a scalable Bloom filter and, unless --probabilistic
+is given, confirmed against the digests of all sequences seen so far, see
+scilifelab.utils.fastq_utils.FastQDeduplicator
 
 see: http://hackmap.blogspot.com/2010/10/bloom-filter-ing-repeated-reads.html
 """
-from bloomfaster import Elf
-import collections
+import argparse
 import sys
 
-# Slight modification to read from input file instead of stdin
-from scilifelab.utils.fastq_utils import (FastQParser, FastQWriter)
+from scilifelab.utils.fastq_utils import deduplicate_fastq
 
 __doc__ %= sys.argv[0]
-if len(sys.argv) > 2:
-    print sys.argv
-    print __doc__
-    sys.exit()
-
-print >>sys.stderr, "Command: ", " ".join(sys.argv)
-infile = sys.argv[1]
-fp = FastQParser(infile)
-for _ in fp:
-    pass
-records = fp.rread()
-print >>sys.stderr, records, "records in file ", infile
-
-# say 1 out of 1000 is false positive.
-bloom = Elf(records, error_rate=1e-3)
-fp.seek(0)
-checks = []
-for _,seq,_,_ in fp:
-    if seq in bloom:
-        checks.append(seq)
-    bloom.add(seq)
-
-# now checks contains anything that could be a duplicate according to
-# the bloomfilter. for some, they were false positives.
-# for actual duplicated, just choose the first, but can also sort by quality.
-fp.seek(0)
-checks = frozenset(checks)
-print >>sys.stderr, "checking %s potential duplicates in a python set" \
-                                            % len(checks)
-outfile = "%s-unique.fastq.gz" % infile.split(".")[0]                                            
-fw = FastQWriter(outfile)
-
-putative_false_positives = collections.defaultdict(int)
-for header,seq,plus,qual in fp:
-    # it appeared only once, so just print it.
-    if not seq in checks:
-        fw.write([header,seq,plus,qual])
-        continue
-    # it appeared in the bloom-filter > 1x, so track and make sure not
-    # to print any others with same sequence.
-    putative_false_positives[seq] += 1
-    if putative_false_positives[seq] > 1:
-        continue
-    fw.write([header,seq,plus,qual])
 
-fw.close()
-false_positives = sum(1 for count in putative_false_positives.values() \
-                                                        if count == 1)
-print >>sys.stderr,  false_positives, "false-positive duplicates in the bloom filter"
+def unique_name(infile):
+    return "%s-unique.fastq.gz" % infile.split(".")[0]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--probabilistic', action='store_true', default=False,
+                        help="only use the Bloom filter, dropping a fraction of at most the error rate of the unique reads")
+    parser.add_argument('--error-rate', dest='error_rate', type=float, default=1e-3,
+                        help="false positive rate of the Bloom filter. Default is 0.001")
+    parser.add_argument('--capacity', type=int, default=1000000,
+                        help="number of reads the Bloom filter is initially sized for. Default is 1000000")
+    parser.add_argument('fastq1', action='store',
+                        help="the (first) fastq file")
+    parser.add_argument('fastq2', action='store', nargs='?', default=None,
+                        help="the fastq file with the mates of the reads in fastq1, if paired")
+    args = parser.parse_args()
+    
+    print >>sys.stderr, "Command: ", " ".join(sys.argv)
+    dedup = deduplicate_fastq(args.fastq1, unique_name(args.fastq1),
+                              args.fastq2, unique_name(args.fastq2) if args.fastq2 else None,
+                              exact=not args.probabilistic, error_rate=args.error_rate, capacity=args.capacity)
+    print >>sys.stderr, dedup.records, "records in file ", args.fastq1
+    print >>sys.stderr, dedup.duplicates, "duplicates removed"
+    if not args.probabilistic:
+        print >>sys.stderr, dedup.false_positives, "false-positive duplicates in the bloom filter"
+
+if __name__ == "__main__":
+    main()
@@ -13,6 +13,7 @@ import scilifelab.google.project_metadata as pmeta
 import bcbio.pipeline.config_loader as cl
 from bcbio.google import _to_unicode, spreadsheet
 import couchdb
+import scilifelab.db.statusDB_utils as statusDB_utils
 
 def get_proj_inf(WS_projects,project_name_swe, samp_db, proj_db, client, config):
 	project_name = _replace_ascii(_to_unicode(project_name_swe))
@@ -205,35 +206,16 @@ def get_column(ssheet_content, header, col_cond=0):
 
 
 #		COUCHDB
-def save_couchdb_obj(db, obj):
-    dbobj = db.get(obj['_id'])
-    print dbobj
-    time_log = datetime.utcnow().isoformat() + "Z"
-    if dbobj is None:
-     #   obj["creation_time"] = time_log
-     #   obj["modification_time"] = time_log
-     #   db.save(obj)   
-        return None
-    elif dbobj.has_key('source'):
-        if dbobj['source']=='lims':
-            return None
-    else:
-        obj["_rev"] = dbobj.get("_rev")
-        del dbobj["modification_time"]
-        obj["creation_time"] = dbobj["creation_time"]
-        if not comp_obj(obj, dbobj):
-            obj["modification_time"] = time_log
-            db.save(obj)
-            return 'Uppdated'
-
-def comp_obj(obj, dbobj):
-	for key in obj:
-		if (dbobj.has_key(key)):
-			if (obj[key] != dbobj[key]):
-	                     return False
-	     	else:
-			return False
-	return True
+def save_couchdb_objs(db, objs):
+    """Update the stored project summaries of objs with one call to
+    statusDB_utils.save_couchdb_objs. Projects that are not in the database,
+    or that have a source, e.g. were loaded from lims, are not updated and
+    get None.
+    """
+    stored = dict((row.key, row.doc) for row in db.view('_all_docs', keys=[obj['_id'] for obj in objs], include_docs=True))
+    update = [obj for obj in objs if stored.get(obj['_id']) is not None and not stored[obj['_id']].has_key('source')]
+    info = dict(zip([obj['_id'] for obj in update], statusDB_utils.save_couchdb_objs(db, update)))
+    return [info.get(obj['_id']) for obj in objs]
 
 def find_proj_from_view(proj_db, project_name):
 	view = proj_db.view('project/project_name')
@@ -243,12 +225,7 @@ def find_proj_from_view(proj_db, project_name):
 	return None
 
 def find_samp_from_view(samp_db, proj_name):
-        view = samp_db.view('names/id_to_proj')
-	samps = {}
-        for doc in view:
-                if (doc.value[0] == proj_name)|(doc.value[0] == proj_name.lower()):
-			samps[doc.key] = doc.value[1:3]
-        return samps
+        return statusDB_utils.find_samp_from_view(samp_db, proj_name)
 
 
 def get_20132_info(client,project_name_swe):
@@ -446,30 +423,32 @@ def  main(client, CONFIG, URL, proj_ID, all_projects, GPL ):
     if all_projects:
         content, ws_key, ss_key = get_google_document("Genomics Project list", GPL, client)
         row_ind, col_ind = get_column(content, 'Project name')
+        objs = []
         for j, row in enumerate(content):
             try:
                 proj_ID = str(row[col_ind]).strip().split(' ')[0]
                 if (proj_ID != '') & (j > row_ind + 2):
                     obj = get_proj_inf(WS_projects,proj_ID, samp_db, proj_db, client, CONFIG)
                     if obj['samples'].keys() != []:
-                        info = save_couchdb_obj(proj_db, obj)
-                        if info:
-                            logger.info('CouchDB: %s %s %s' % (obj['_id'], obj['project_name'], info))
-                        else:
-                            logger.info('CouchDB: %s %s Not uppdated. Project might be opened after first of july' % (obj['_id'], obj['project_name']))
+                        objs.append(obj)
             except:
                 pass
+        for obj, info in zip(objs, save_couchdb_objs(proj_db, objs)):
+            if info:
+                logger.info('CouchDB: %s %s %s' % (obj['_id'], obj['project_name'], info))
+            else:
+                logger.info('CouchDB: %s %s Not uppdated. Project might be opened after first of july' % (obj['_id'], obj['project_name']))
     elif proj_ID is not None:
         print proj_ID
         obj = get_proj_inf(WS_projects,proj_ID, samp_db, proj_db, client, CONFIG)
         if obj['samples'].keys() != []:
-            info = save_couchdb_obj(proj_db, obj)
+            info = save_couchdb_objs(proj_db, [obj])[0]
+        if info:
+            logger.info('CouchDB: %s %s %s' % (obj['_id'], obj['project_name'], info))
+        else:
+            logger.info('Project opened after first of jul? Load with project_summary_uppoad_LIMS.py')
     else:
         logger.debug('Argument error')
-    if info:
-        logger.info('CouchDB: %s %s %s' % (obj['_id'], obj['project_name'], info))
-    else:
-        logger.info('Project opened after first of jul? Load with project_summary_uppoad_LIMS.py')
 
 if __name__ == '__main__':
     	usage = """Usage:	python project_summary_upload.py [options]
@@ -50,6 +50,7 @@ setup(name = "scilifelab",
         "beautifulsoup4",
         "texttable",
         "gdata",
+        "numpy",
         ],
       test_suite = 'nose.collector',
       packages=find_packages(exclude=['tests']),
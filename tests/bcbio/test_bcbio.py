@@ -1,9 +1,13 @@
 import os
+import re
 import tempfile
 import shutil
 import unittest
+import StringIO
+import xml.etree.cElementTree as ET
+from bs4 import BeautifulSoup
 from ..data import data_files
-from scilifelab.bcbio.qc import RunInfoParser
+from scilifelab.bcbio.qc import RunInfoParser, RunMetricsParser, SampleRunMetricsParser, FlowcellRunMetricsParser, DirectoryIndex, ParseCache, DemultiplexStatsParser, XmlToDict, parse_xml_dict
 
 filedir = os.path.abspath(os.path.realpath(os.path.dirname(__file__)))
 
@@ -28,3 +32,264 @@ class TestBcbioQC(unittest.TestCase):
         self.assertEqual(res["Instrument"], "SN0002")
         self.assertEqual(res["Date"], "120924")
 
+
+class TestDirectoryIndex(unittest.TestCase):
+    """Test for the directory index shared by the run metrics parsers"""
+    def setUp(self):
+        # Paths containing 'tmp' are ignored by the parsers
+        self.rootdir = tempfile.mkdtemp(prefix="test_bcbio_qc_", dir=filedir)
+        for d in ["nophix/fastqc/1_120924_AC003CCCXX_nophix_1-sort-dup_fastqc", "nophix/tmp", "nophix/alignments/tx", "2_120924_AC003CCCXX"]:
+            os.makedirs(os.path.join(self.rootdir, d))
+        for d, _, _ in os.walk(self.rootdir):
+            for f in ["a.txt", "1_120924_AC003CCCXX_nophix_1-sort-dup.align_metrics"]:
+                open(os.path.join(d, f), "w").close()
+        os.symlink(os.path.join(self.rootdir, "nophix"), os.path.join(self.rootdir, "link"))
+
+    def tearDown(self):
+        shutil.rmtree(self.rootdir)
+
+    def _walk(self, path):
+        files = []
+        for root, dirs, fnames in os.walk(path):
+            if not re.search(RunMetricsParser.reignore, root):
+                files.extend([os.path.join(root, x) for x in fnames])
+        return files
+
+    def test_files(self):
+        """List the same files, in the same order, as os.walk"""
+        index = DirectoryIndex(self.rootdir, ignore=RunMetricsParser.reignore)
+        self.assertEqual(12, len(index.files()))
+        self.assertListEqual(self._walk(self.rootdir), index.files())
+        subdir = os.path.join(self.rootdir, "nophix")
+        self.assertListEqual(self._walk(subdir), index.files(subdir))
+        self.assertListEqual([], index.files(os.path.join(self.rootdir, "nophix", "tmp")))
+
+    def test_shared_index(self):
+        """Parsers sharing an index do not walk the tree"""
+        index = DirectoryIndex(self.rootdir, ignore=RunMetricsParser.reignore)
+        fc_parser = FlowcellRunMetricsParser(self.rootdir, index=index)
+        parser = SampleRunMetricsParser(self.rootdir, index=index)
+        self.assertListEqual(fc_parser.files, parser.files)
+        self.assertListEqual(self._walk(self.rootdir), SampleRunMetricsParser(self.rootdir).files)
+        self.assertEqual(6, len(parser.filter_files("align_metrics")))
+
+class TestFileClassifier(unittest.TestCase):
+    """Test for looking up metrics files by kind and lane"""
+    files = ["/fc/nophix/{}_120924_AC003CCCXX_nophix{}-sort.{}_metrics".format(lane, bc, m)
+             for lane in [1, 2, 11] for bc in ["", "_1", "_2", "_12"] for m in ["align", "dup"]] + \
+            ["/fc/fastq_screen/{}_120924_AC003CCCXX_nophix_{}_1_screen.txt".format(lane, bc) for lane in [1, 2] for bc in [1, 2]] + \
+            ["/fc/P001_101_ACGT_L00{}_R1_001_screen.txt".format(lane) for lane in [1, 2]] + \
+            ["/fc/fastqc/{}_120924_AC003CCCXX_nophix_1-sort-dup_fastqc/fastqc_data.txt".format(lane) for lane in [1, 2]] + \
+            ["/fc/nophix/{}_120924_AC003CCCXX_nophix.bc_metrics".format(lane) for lane in [1, 2]] + \
+            ["/fc/01_align.txt", "/fc/02_dup.txt.bak", "/fc/log.txt", "/fc/bcbb_software_versions.txt"]
+
+    def setUp(self):
+        self.parser = SampleRunMetricsParser(None)
+        self.parser.files = self.files
+
+    def test_filter_files(self):
+        """Classified lookups find the same files as searching all files"""
+        lookups = [(p, "picard", lane) for lane in [1, 2, 11, "1", None] for p in
+                   ["{}_[0-9]+_[0-9A-Za-z]+(_nophix)?(_{})?-.*.(align|hs|insert|dup)_metrics".format(lane, bc) for bc in [1, 2, 12]]] + \
+                  [("{}_[0-9]+_[0-9A-Za-z]+(_nophix)?(_{})?_[12]_screen.txt".format(lane, 2), "fastq_screen", lane) for lane in [1, 2]] + \
+                  [("P001_101_ACGT_L0*{}_.*_screen.txt".format(lane), "fastq_screen", lane) for lane in [1, 2]] + \
+                  [("fastqc/{}_[0-9]+_[0-9A-Za-z]+(_nophix)?(_1)?-*".format(lane), "fastqc", lane) for lane in [1, 2]] + \
+                  [("{}_[0-9]+_[0-9A-Za-z]+(_nophix)?[\._]bc[\._]metrics".format(lane), "bc_metrics", lane) for lane in [1, 2]] + \
+                  [("bcbb_software_versions.txt", "software_versions", None)]
+        for pattern, kind, lane in lookups:
+            files = self.parser.filter_files(pattern)
+            self.assertTrue(len(files) > 0 or lane is None, pattern)
+            self.assertListEqual(files, self.parser.filter_files(pattern, kind=kind, lane=lane))
+        def filter_fn(f):
+            return re.match("[0-9][0-9]_[^\/]+\.txt", os.path.basename(f)) != None
+        self.assertListEqual(["/fc/01_align.txt", "/fc/02_dup.txt.bak"], self.parser.filter_files(None, filter_fn, kind="checkpoint"))
+
+    def test_changed_files(self):
+        """The files are classified again when the file list changes"""
+        pattern = "{}_[0-9]+_[0-9A-Za-z]+(_nophix)?[\._]bc[\._]metrics".format(3)
+        self.assertListEqual([], self.parser.filter_files(pattern, kind="bc_metrics", lane=3))
+        self.parser.files = self.files + ["/fc/3_120924_AC003CCCXX.bc_metrics"]
+        self.assertListEqual(["/fc/3_120924_AC003CCCXX.bc_metrics"], self.parser.filter_files(pattern, kind="bc_metrics", lane=3))
+
+class TestParseCache(unittest.TestCase):
+    """Test for the cache of parsed metrics files"""
+    screen = "Library\t%Unmapped\t%One_hit_one_library\t%Multiple_hits_one_library\nHuman\t{}\t1.5\t0.5\n"
+
+    def setUp(self):
+        # Paths containing 'tmp' are ignored by the parsers
+        self.rootdir = tempfile.mkdtemp(prefix="test_bcbio_qc_", dir=filedir)
+        self.cachedir = os.path.join(self.rootdir, "cache")
+        self.fcdir = os.path.join(self.rootdir, "120924_AC003CCCXX")
+        os.makedirs(os.path.join(self.fcdir, "fastq_screen"))
+        self.screen_file = os.path.join(self.fcdir, "fastq_screen", "1_120924_AC003CCCXX_nophix_1_1_screen.txt")
+        self._write_screen(98.0)
+        self.sample_kw = dict(barcode_name="P001_101", sample_prj="J.Doe_00_01", lane=1, flowcell="AC003CCCXX", barcode_id=1)
+
+    def tearDown(self):
+        shutil.rmtree(self.rootdir)
+
+    def _write_screen(self, unmapped):
+        with open(self.screen_file, "w") as fh:
+            fh.write(self.screen.format(unmapped))
+
+    def test_get(self):
+        """Files are parsed again only if they changed"""
+        cache = ParseCache(self.cachedir)
+        calls = []
+        def parse_fn():
+            calls.append(1)
+            with open(self.screen_file) as fh:
+                return {'lines': fh.read().splitlines()}
+        value = cache.get(self.fcdir, "fastq_screen", [self.screen_file], parse_fn)
+        value['lines'].append("changed")
+        self.assertDictEqual(parse_fn(), cache.get(self.fcdir, "fastq_screen", [self.screen_file], parse_fn))
+        self.assertEqual(2, len(calls))
+        self._write_screen(9.0)
+        self.assertIn("Human\t9.0\t1.5\t0.5", cache.get(self.fcdir, "fastq_screen", [self.screen_file], parse_fn)['lines'])
+        self.assertEqual(3, len(calls))
+        missing = self.screen_file + ".missing"
+        self.assertRaises(IOError, cache.get, self.fcdir, "fastq_screen", [missing], lambda: open(missing))
+
+    def test_parser(self):
+        """Unchanged metrics are read from the cache in later runs"""
+        mtime = int(os.stat(self.screen_file).st_mtime)
+        os.utime(self.screen_file, (mtime, mtime))
+        cache = ParseCache(self.cachedir)
+        data = SampleRunMetricsParser(self.fcdir, cache=cache).parse_fastq_screen(**self.sample_kw)
+        self.assertEqual(98.0, data["Human"]["Unmapped"])
+        cache.flush()
+        self.assertEqual(1, len(os.listdir(self.cachedir)))
+
+        # Same size and modification time: the file is not read again
+        self._write_screen(97.0)
+        os.utime(self.screen_file, (mtime, mtime))
+        parser = SampleRunMetricsParser(self.fcdir, cache=ParseCache(self.cachedir))
+        self.assertDictEqual(data, parser.parse_fastq_screen(**self.sample_kw))
+        self.assertEqual(97.0, SampleRunMetricsParser(self.fcdir).parse_fastq_screen(**self.sample_kw)["Human"]["Unmapped"])
+
+    def test_evict(self):
+        """Old cache files, and the least recently used beyond the maximum size, are removed"""
+        os.makedirs(self.cachedir)
+        for i in range(4):
+            fn = os.path.join(self.cachedir, "{}.pickle".format(i))
+            with open(fn, "w") as fh:
+                fh.write("x" * 1024 * 400)
+            os.utime(fn, (0, os.stat(fn).st_mtime - i * 86400))
+        ParseCache(self.cachedir, max_age=2.5, max_size=1).evict()
+        self.assertListEqual(["0.pickle", "1.pickle"], sorted(os.listdir(self.cachedir)))
+        ParseCache(self.cachedir, max_age=2.5, max_size=0.5).evict()
+        self.assertListEqual(["0.pickle"], os.listdir(self.cachedir))
+
+DEMULTIPLEX_STATS = """<html><link rel="stylesheet" href="css/Reports.css" type="text/css"><body>
+<table><col width="4%"><col><tr><th>Lane</th><th>% of &gt;= Q30 Bases (PF)</th><th>Index</th></tr></table>
+<table><col width="4%"><col>
+<tr><td>1</td><td>90.05</td><td>CAGATC</td></tr>
+<tr><td>2</td><td><b>91.36</b></td><td>A<b>C</b></td></tr>
+<tr><td>3</td><td>&#62;90<br></td><td></td></tr>
+</table><p></p>
+<table><tr><th>Sample<p></p>ID</th><th>Recipe</th></tr></table>
+<table><tr><td>P001_101_index3</td><td>R1</td></tr></table>
+</body></html>"""
+
+class TestDemultiplexStatsParser(unittest.TestCase):
+    """Test for the streaming Demultiplex_Stats.htm parser"""
+    def test_rows(self):
+        """Rows are read in chunks, with the cell text BeautifulSoup gives"""
+        rows = list(DemultiplexStatsParser().rows(StringIO.StringIO(DEMULTIPLEX_STATS), chunk_size=16))
+        self.assertListEqual([((0,), ["Lane", "% of >= Q30 Bases (PF)", "Index"], []),
+                              ((1,), [], ["1", "90.05", "CAGATC"]),
+                              ((1,), [], ["2", "91.36", "None"]),
+                              ((1,), [], ["3", "None", "None"]),
+                              ((2,), ["None", "Recipe"], []),
+                              ((3,), [], ["P001_101_index3", "R1"])], rows)
+
+    def test_parse_demultiplex_stats_htm(self):
+        parser = FlowcellRunMetricsParser(None)
+        bc_rows, smp_rows = parser._read_demultiplex_stats_htm(StringIO.StringIO(DEMULTIPLEX_STATS))
+        self.assertDictEqual({"Lane": "1", "% of >= Q30 Bases (PF)": "90.05", "Index": "CAGATC"}, bc_rows[0])
+        self.assertListEqual([{"Sample ID": "P001_101_index3", "Recipe": "R1"}], smp_rows)
+
+def soup_read_demultiplex_stats_htm(htm_doc):
+    """Read the rows of a Demultiplex_Stats.htm document with BeautifulSoup,
+    as FlowcellRunMetricsParser did before DemultiplexStatsParser
+    """
+    soup = BeautifulSoup(htm_doc, "html.parser")
+    headers = [h for h in (row.findAll("th") for row in soup.findAll("tr")) if h]
+    bc_header = [str(x.string) for x in headers[0]]
+    smp_header = [str(x.string) for x in headers[1]]
+    smp_header[0] = "Sample ID"
+    tables = soup.findAll("table")
+    bc_rows = [{bc_header[i]:str(row[i].string) for i in range(0, len(bc_header)) if row} for row in (r.findAll("td") for r in tables[1].findAll("tr"))]
+    smp_rows = [{smp_header[i]:str(row[i].string) for i in range(0, len(smp_header)) if row} for row in (r.findAll("td") for r in tables[3].findAll("tr"))]
+    rows = [([str(x.string) for x in r.findAll("th")], [str(x.string) for x in r.findAll("td")]) for r in soup.findAll("tr")]
+    return bc_rows, smp_rows, rows
+
+class TestDemultiplexStatsSoup(unittest.TestCase):
+    """Compare DemultiplexStatsParser with BeautifulSoup on a CASAVA Demultiplex_Stats.htm file"""
+    def setUp(self):
+        with open(os.path.join(filedir, os.pardir, "full", "data", "db", "demux_stats.htm")) as fh:
+            self.htm_doc = fh.read()
+
+    def _compare(self, htm_doc):
+        bc_rows, smp_rows, rows = soup_read_demultiplex_stats_htm(htm_doc)
+        self.assertEqual((bc_rows, smp_rows), FlowcellRunMetricsParser(None)._read_demultiplex_stats_htm(StringIO.StringIO(htm_doc)))
+        self.assertListEqual(rows, [(th, td) for tables, th, td in DemultiplexStatsParser().rows(StringIO.StringIO(htm_doc), chunk_size=7)])
+        return bc_rows, smp_rows
+
+    def test_demux_stats(self):
+        """The same rows as BeautifulSoup"""
+        bc_rows, smp_rows = self._compare(self.htm_doc)
+        self.assertEqual(4, len(bc_rows))
+        self.assertEqual("90.05", bc_rows[0]["% of >= Q30 Bases (PF)"])
+        self.assertEqual("P001_101_index3", smp_rows[0]["Sample ID"])
+
+    def test_nested_and_empty_cells(self):
+        """The same text as BeautifulSoup for cells with nested tags and empty cells"""
+        htm_doc = self.htm_doc
+        for old, new in [("<td>hg19</td>", "<td><b>hg19</b></td>"),
+                         ("<td>TGACCA</td>", "<td>TG<i>ACCA</i></td>"),
+                         ("<td>3,942</td>", "<td><span><b>3,942</b></span></td>"),
+                         ("<td>N</td>", "<td></td>"),
+                         ("<td>7.94</td>", "<td><b></b></td>"),
+                         ("<td>92.57</td>", "<td>92.57<br></td>"),
+                         ("<td>R1</td>", "<td> R1 </td>"),
+                         ("<td>NN</td>", "<td>N&amp;N</td>"),
+                         ("<td>unknown</td>", "<td><p>unknown</td>")]:
+            self.assertIn(old, htm_doc)
+            htm_doc = htm_doc.replace(old, new, 1)
+        bc_rows, smp_rows = self._compare(htm_doc)
+        self.assertEqual("hg19", bc_rows[0]["Sample Ref"])
+        self.assertEqual("None", bc_rows[0]["Control"])
+        self.assertEqual("3,942", bc_rows[0]["Yield (Mbases)"])
+        self.assertEqual("None", bc_rows[1]["Control"])
+        self.assertEqual("None", bc_rows[0]["% of raw clusters per lane"])
+        self.assertEqual("unknown", bc_rows[1]["Sample Ref"])
+        self.assertEqual(" R1 ", smp_rows[0]["Recipe"])
+        self.assertEqual("N&N", smp_rows[0]["Operator"])
+
+class TestParseXmlDict(unittest.TestCase):
+    """Test for the incremental xml to dict parser"""
+    xml = """<Run Id="r1" Reads="attr"><Reads><Read Number="1" NumCycles="101"/><Read Number="2" NumCycles="7"/><Read>text</Read><Read>  </Read></Reads>
+<Setup><Only Key="v">content</Only></Setup><Version>1.0</Version><Empty/>
+<Sections><Section><Name>A_1</Name></Section><Section><Name>B_1</Name></Section></Sections>
+<Lanes Lane="attr"><Lane>1</Lane><Tiles/></Lanes></Run>"""
+
+    def test_parse_xml_dict(self):
+        """The same dict as XmlToDict"""
+        data = parse_xml_dict(StringIO.StringIO(self.xml))
+        self.assertDictEqual(XmlToDict(ET.XML(self.xml)), data)
+        self.assertEqual("101", data["Reads"]["Read"][0]["NumCycles"])
+        self.assertEqual("B_1", data["Sections"]["Section"][1]["Name"])
+
+    def test_parse_xml_dict_root(self):
+        """The root is a dict of its attributes and children, as in XmlToDict"""
+        for xml in ["""<Tiles Count="2"><Tile>1_1101</Tile><Tile>1_1102</Tile></Tiles>""",
+                    """<Read Number="1">text</Read>""",
+                    """<Empty>  </Empty>""",
+                    """<Lanes Lane="attr"><Lane>1</Lane><Tiles/></Lanes>""",
+                    """<Run><Read Number="1"/><Read Number="2"/><Lane>1</Lane></Run>"""]:
+            data = parse_xml_dict(StringIO.StringIO(xml))
+            self.assertIsInstance(data, dict)
+            self.assertDictEqual(XmlToDict(ET.XML(xml)), data)
+        self.assertDictEqual({"Count": "2", "Tile": "1_1102"}, parse_xml_dict(StringIO.StringIO(
+            """<Tiles Count="2"><Tile>1_1101</Tile><Tile>1_1102</Tile></Tiles>""")))
@@ -0,0 +1,115 @@
+"""Compare exact and bounded barcode counting in barcodes_extract_count.
+
+Writes CASAVA 1.8 fastq files for a number of lanes, with a few expected 
+and unexpected frequent barcodes among a large number of distinct random 
+barcodes, as on a lane with many sequencing errors. The top barcodes are 
+counted with the full Counter that extract_barcodes used to build, and 
+with BarcodeCounter, one lane at a time and with the lanes in parallel. 
+Reports the time and peak RSS of each method, each run in its own process,
+and checks that the reported barcodes and counts are the same. Run with:
+
+    python -m tests.benchmarks.bench_barcode_counts [-n RECORDS] [-l LANES]
+"""
+import argparse
+import imp
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import tempfile
+import time
+from collections import Counter
+import scilifelab.utils.fastq_utils as fu
+import tests.generate_test_data as td
+
+bec = imp.load_source("barcodes_extract_count", os.path.join(os.path.dirname(__file__), 
+                                                             os.pardir, os.pardir, "scripts", 
+                                                             "barcodes_extract_count.py"))
+
+def write_lane(fname, lane, nrecords, expected, frequent):
+    pool = [td.generate_fastq_record(lane=lane) for n in xrange(100)]
+    fqw = fu.FastQWriter(fname, compresslevel=1)
+    for n in xrange(nrecords):
+        r = random.random()
+        if r < 0.6:
+            bc = random.choice(expected)
+        elif r < 0.8:
+            bc = frequent[int(len(frequent)*(r - 0.6)/0.2)]
+        else:
+            bc = td.generate_barcode(8)
+        record = list(pool[n % len(pool)])
+        record[0] = record[0].rsplit(":",1)[0] + ":" + bc
+        fqw.write(record)
+    fqw.close()
+
+def exact_counts(jobs, nindex):
+    """The counting extract_barcodes did before BarcodeCounter
+    """
+    rows = []
+    for lane, fq1, fq2, expected, bclen in jobs:
+        c = Counter(fu.BarcodeExtractor(fq1))
+        for bc in bec.expected_barcodes(expected, True):
+            del c[bc]
+        rows.extend([(lane, bc, count) for bc, count in c.most_common(nindex)])
+    return rows
+
+def serial_counts(jobs, nindex):
+    rows = []
+    for lane, fq1, fq2, expected, bclen in jobs:
+        header, counts = bec.extract_barcodes(fq1, lane, fq2, nindex, bclen=bclen, expected=expected)
+        rows.extend([(c['lane'], c['sequence'], c['count']) for c in counts])
+    return rows
+
+def parallel_counts(jobs, nindex):
+    header, counts = bec.extract_lanes(jobs, nindex)
+    return [(c['lane'], c['sequence'], c['count']) for c in counts]
+
+def run(queue, fn, args):
+    t0 = time.time()
+    rows = fn(*args)
+    queue.put((rows, time.time() - t0, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare exact and bounded barcode counting")
+    parser.add_argument('-n','--nrecords', type=int, default=200000,
+                        help="the number of records per lane. Default is 200000")
+    parser.add_argument('-l','--lanes', type=int, default=8,
+                        help="the number of lanes. Default is 8")
+    parser.add_argument('-i','--nindex', type=int, default=25,
+                        help="the number of top barcodes to report. Default is 25")
+    args = parser.parse_args()
+    
+    tmpdir = tempfile.mkdtemp(prefix="bench_barcode_counts_")
+    try:
+        jobs = []
+        for lane in xrange(1, args.lanes + 1):
+            expected = [td.generate_barcode(8) for n in xrange(12)]
+            # Frequent barcodes within one mismatch of an expected one would not be reported
+            excluded = set(bec.expected_barcodes(expected, True))
+            frequent = []
+            while len(frequent) < args.nindex:
+                bc = td.generate_barcode(8)
+                if bc not in excluded:
+                    frequent.append(bc)
+            fname = os.path.join(tmpdir, "lane{}.fastq.gz".format(lane))
+            write_lane(fname, lane, args.nrecords, expected, frequent)
+            jobs.append((str(lane), fname, None, expected, 8))
+        
+        results = {}
+        print "{:<10} {:>8} {:>12} {:>12}".format("method","s","records/s","max rss kB")
+        for label, fn in [("exact", exact_counts), ("bounded", serial_counts), ("parallel", parallel_counts)]:
+            queue = multiprocessing.Queue()
+            p = multiprocessing.Process(target=run, args=(queue, fn, (jobs, args.nindex)))
+            p.start()
+            rows, t, rss = queue.get()
+            p.join()
+            results[label] = sorted(rows)
+            print "{:<10} {:>8.2f} {:>12.0f} {:>12}".format(label, t, args.lanes*args.nrecords/t, rss)
+        assert results["exact"] == results["bounded"] == results["parallel"], "The reported barcodes differ"
+        print "The reported barcodes and counts are identical"
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""Benchmark cloning databases between two CouchDB stand-ins.
+
+Fills a source CouchDB stand-in (tests.couchdb_standin) with a number of
+databases of small documents and copies them to an empty destination
+stand-in with DatabaseReplicator, for a few combinations of worker threads
+and batch sizes, and finally copies them again after a fraction of the
+documents were updated, which resumes from the checkpoints. Reports the
+time, the number of requests to both servers and the documents per second.
+Run with:
+
+    python -m tests.benchmarks.bench_couchdb_clone [-d DATABASES] [-n DOCS] [-u UPDATED]
+"""
+import argparse
+import time
+import logbook
+from scilifelab.db.replication import DatabaseReplicator
+from tests.couchdb_standin import CouchDBStandIn
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark cloning databases between two CouchDB servers")
+    parser.add_argument('-d','--ndbs', type=int, default=8,
+                        help="the number of databases. Default is 8")
+    parser.add_argument('-n','--ndocs', type=int, default=2000,
+                        help="the number of documents per database. Default is 2000")
+    parser.add_argument('-u','--updated', type=float, default=0.01,
+                        help="the fraction of documents updated before the resumed copy. Default is 0.01")
+    args = parser.parse_args()
+
+    source = CouchDBStandIn().start()
+    destination = CouchDBStandIn().start()
+    try:
+        dbs = ["db{}".format(i) for i in xrange(args.ndbs)]
+        for name in dbs:
+            db = source.create(name)
+            for n in xrange(args.ndocs):
+                db.save({"_id": "{}_{:06d}".format(name, n), "name": "P{}_{}".format(n % 50, n), "lane": n % 8 + 1})
+
+        print "{:<22} {:>8} {:>9} {:>10}".format("copy","s","requests","docs/s")
+        def run(label, workers, batch_size, restart=True):
+            if restart:
+                for name in dbs:
+                    destination.create(name)
+            source.reset_counts()
+            destination.reset_counts()
+            rep = DatabaseReplicator(source.url, destination.url, batch_size=batch_size, workers=workers)
+            rep.log.level = logbook.WARNING
+            t0 = time.time()
+            stats = rep.copy_all(dbs)
+            t = time.time() - t0
+            ndocs = sum([x['docs'] for x in stats])
+            requests = sum(source.requests.values()) + sum(destination.requests.values())
+            print "{:<22} {:>8.3f} {:>9} {:>10.0f}".format(label, t, requests, ndocs / t)
+            for name in dbs:
+                assert source.databases[name].docs == destination.databases[name].docs, "{} was not copied".format(name)
+        run("workers=1 batch=10", 1, 10)
+        run("workers=1 batch=500", 1, 500)
+        run("workers=4 batch=500", 4, 500)
+        for name in dbs:
+            db = source.databases[name]
+            for n in xrange(int(args.ndocs * args.updated)):
+                db.save(dict(db.docs["{}_{:06d}".format(name, n)], lane=0))
+        run("resume workers=4", 4, 500, restart=False)
+    finally:
+        source.stop()
+        destination.stop()
+
+if __name__ == "__main__":
+    main()
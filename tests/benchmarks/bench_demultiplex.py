@@ -0,0 +1,88 @@
+"""Benchmark demultiplex_fastq on a 96-sample, 8-lane run.
+
+Demultiplexes a generated pair of fastq files with 12 indexes in each of 
+8 lanes, in the calling process and with an increasing number of worker
+processes. See bench_demultiplex_pool for the compression threads. The counts are checked against counting the records with 
+parse_header. Run with:
+
+    python -m tests.benchmarks.bench_demultiplex [-n RECORDS] [-l LEVEL]
+"""
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import time
+import scilifelab.utils.fastq_utils as fu
+import tests.generate_test_data as td
+
+def write_input(rootdir, nrecords, nlanes=8, nsamples=12):
+    """Write a pair of fastq files with records evenly spread over nsamples
+    indexes in each of nlanes lanes and a samplesheet for demultiplexing them
+    """
+    fcid = td.generate_fc_barcode()
+    indexes = list(set([td.generate_barcode(8) for n in xrange(2*nsamples)]))[0:nsamples]
+    lanes = [str(l) for l in xrange(1,nlanes+1)]
+    f1 = os.path.join(rootdir,"input_R1.fastq.gz")
+    f2 = os.path.join(rootdir,"input_R2.fastq.gz")
+    f1h = fu.FastQWriter(f1)
+    f2h = fu.FastQWriter(f2)
+    pool = [td.generate_fastq_record(fcid=fcid, lane=1, pair=True) for n in xrange(1000)]
+    for n in xrange(nrecords):
+        record = pool[n % len(pool)]
+        lane = random.choice(lanes)
+        index = random.choice(indexes)
+        f1h.write([set_lane_index(record[0], lane, index)] + record[1:4])
+        f2h.write([set_lane_index(record[4], lane, index)] + record[5:8])
+    f1h.close()
+    f2h.close()
+    sdata = [[fcid, lane, "Sample_{}_{}".format(lane,n), "hg19", index, "Bench", "N", "R", "O", "BenchProject"]
+             for lane in lanes for n, index in enumerate(indexes)]
+    samplesheet = td._write_samplesheet(sdata, os.path.join(rootdir,"SampleSheet.csv"))
+    return f1, f2, samplesheet
+
+def set_lane_index(header, lane, index):
+    fields = header.split(":")
+    fields[3] = lane
+    fields[-1] = index
+    return ":".join(fields)
+
+def reference_counts(fastq_files):
+    """Count the records per lane and index by parsing every header
+    """
+    counts = {}
+    for fname in fastq_files:
+        for record in fu.FastQParser(fname):
+            header = fu.parse_header(record[0])
+            key = (str(header['lane']), header['index'])
+            counts[key] = counts.get(key, 0) + 1
+    return counts
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark demultiplex_fastq with 96 samples on 8 lanes")
+    parser.add_argument('-n','--nrecords', type=int, default=200000,
+                        help="the number of read pairs in the input. Default is 200000")
+    parser.add_argument('-l','--compresslevel', type=int, default=6,
+                        help="the gzip compression level of the output. Default is 6, below the default of 9 of demultiplex_fastq")
+    args = parser.parse_args()
+    
+    rootdir = tempfile.mkdtemp(prefix="bench_demultiplex_")
+    try:
+        f1, f2, samplesheet = write_input(rootdir, args.nrecords)
+        expected = reference_counts([f1, f2])
+        print "{:<12} {:>8} {:>12}".format("workers","s","pairs/s")
+        for workers in [1, 2, 4, 8]:
+            outdir = tempfile.mkdtemp(dir=rootdir)
+            dmx = fu.FastQDemultiplexer(outdir, samplesheet, workers=workers, compresslevel=args.compresslevel)
+            t0 = time.time()
+            dmx.run(f1, f2)
+            t = time.time() - t0
+            observed = dict([((lane, index), n) for lane, c in dmx.counts.items() for index, n in c.items()])
+            assert observed == expected, "Counts with {} workers differ from the reference counts".format(workers)
+            print "{:<12} {:>8.2f} {:>12.0f}".format(workers, t, args.nrecords/t)
+            shutil.rmtree(outdir)
+    finally:
+        shutil.rmtree(rootdir)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""Benchmark demultiplex_fastq on a 96-sample lane.
+
+Demultiplexes a generated pair of fastq files with 96 indexes in the
+calling process, compressing the output through a FastQWriterPool with an
+increasing number of compression threads. Run with:
+
+    python -m tests.benchmarks.bench_demultiplex_pool [-n RECORDS] [-l LEVEL] [-w WORKERS ...]
+"""
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import time
+import scilifelab.utils.fastq_utils as fu
+import tests.generate_test_data as td
+
+def write_input(rootdir, nrecords, nsamples=96):
+    """Write a pair of fastq files with records evenly spread over nsamples
+    indexes in lane 1 and a samplesheet for demultiplexing them
+    """
+    fcid = td.generate_fc_barcode()
+    indexes = list(set([td.generate_barcode(8) for n in xrange(2*nsamples)]))[0:nsamples]
+    f1 = os.path.join(rootdir,"input_R1.fastq.gz")
+    f2 = os.path.join(rootdir,"input_R2.fastq.gz")
+    f1h = fu.FastQWriter(f1)
+    f2h = fu.FastQWriter(f2)
+    pool = [td.generate_fastq_record(fcid=fcid, lane=1, pair=True) for n in xrange(1000)]
+    for n in xrange(nrecords):
+        record = pool[n % len(pool)]
+        index = random.choice(indexes)
+        f1h.write([record[0].rsplit(":",1)[0] + ":" + index] + record[1:4])
+        f2h.write([record[4].rsplit(":",1)[0] + ":" + index] + record[5:8])
+    f1h.close()
+    f2h.close()
+    sdata = [[fcid, "1", "Sample_{}".format(n), "hg19", index, "Bench", "N", "R", "O", "BenchProject"]
+             for n, index in enumerate(indexes)]
+    samplesheet = td._write_samplesheet(sdata, os.path.join(rootdir,"SampleSheet.csv"))
+    return f1, f2, samplesheet
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark demultiplex_fastq with 96 samples")
+    parser.add_argument('-n','--nrecords', type=int, default=200000,
+                        help="the number of read pairs in the input. Default is 200000")
+    parser.add_argument('-l','--compresslevel', type=int, default=6,
+                        help="the gzip compression level of the output. Default is 6, below the default of 9 of demultiplex_fastq")
+    parser.add_argument('-w','--compress-workers', type=int, nargs="+", default=[1, 2, 4, 8],
+                        help="the numbers of compression threads. Default is 1 2 4 8")
+    args = parser.parse_args()
+    
+    rootdir = tempfile.mkdtemp(prefix="bench_demultiplex_pool_")
+    try:
+        f1, f2, samplesheet = write_input(rootdir, args.nrecords)
+        print "{:<12} {:>8} {:>12}".format("writers","s","pairs/s")
+        for workers in args.compress_workers:
+            outdir = tempfile.mkdtemp(dir=rootdir)
+            t0 = time.time()
+            fu.demultiplex_fastq(outdir, samplesheet, f1, f2, compresslevel=args.compresslevel, compress_workers=workers)
+            t = time.time() - t0
+            print "{:<12} {:>8.2f} {:>12.0f}".format("pool/{}".format(workers), t, args.nrecords/t)
+            shutil.rmtree(outdir)
+    finally:
+        shutil.rmtree(rootdir)
+
+if __name__ == "__main__":
+    main()
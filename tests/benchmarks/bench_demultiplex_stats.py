@@ -0,0 +1,119 @@
+"""Benchmark parsing a large Demultiplex_Stats.htm file.
+
+Generates a CASAVA Demultiplex_Stats.htm file with the barcode lane
+statistics and sample information of a number of samples in each lane
+and parses it with FlowcellRunMetricsParser.parse_demultiplex_stats_htm,
+first by reading the whole file into BeautifulSoup, three times, as
+before, and then with the streaming DemultiplexStatsParser. Each parser
+runs in a separate process, which reports the time and the increase of
+its peak memory use. Run with:
+
+    python -m tests.benchmarks.bench_demultiplex_stats [-l LANES] [-s SAMPLES]
+"""
+import argparse
+import multiprocessing
+import os
+import resource
+import shutil
+import tempfile
+import time
+import logbook
+import scilifelab.bcbio.qc as qc
+from bs4 import BeautifulSoup
+from scilifelab.bcbio.qc import FlowcellRunMetricsParser
+from tests.benchmarks.bench_qc_collect_files import FLOWCELL
+
+BC_HEADER = ['Lane', 'Sample ID', 'Sample Ref', 'Index', 'Description', 'Control', 'Project', 'Yield (Mbases)', '% PF', '# Reads',
+             '% of raw clusters per lane', '% Perfect Index Reads', '% One Mismatch Reads (Index)', '% of &gt;= Q30 Bases (PF)', 'Mean Quality Score (PF)']
+SMP_HEADER = ['Sample<p></p>ID', 'Recipe', 'Operator', 'Directory']
+
+def table(header):
+    """The start of the header and body tables of a Demultiplex_Stats.htm table, and its end"""
+    cols = "".join(["<col width=\"5%\">\n" for x in header]) + "<col>\n"
+    head = "<div ID=\"ScrollableTableHeaderDiv\"><table width=\"100%\">\n{}<tr>\n{}</tr>\n</table></div>\n".format(
+        cols, "".join(["<th>{}</th>\n".format(x) for x in header]))
+    body = "<div ID=\"ScrollableTableBodyDiv\"><table width=\"100%\">\n{}".format(cols)
+    return head, body, "</table></div>\n"
+
+def write_demultiplex_stats(fn, nlanes, nsamples):
+    """Write a Demultiplex_Stats.htm file with nsamples samples in each of nlanes lanes"""
+    with open(fn, "w") as fh:
+        fh.write("<!DOCTYPE html PUBLIC \"-//W3C//DTD HTML 4.01 Transitional//EN\" \"http://www.w3.org/TR/html4/loose.dtd\">\n"
+                 "<html>\n<link rel=\"stylesheet\" href=\"css/Reports.css\" type=\"text/css\">\n<body>\n"
+                 "<h1>Flowcell: {}</h1>\n<h2>Barcode lane statistics</h2>\n".format(FLOWCELL.split("_")[1]))
+        head, body, end = table(BC_HEADER)
+        fh.write(head + body)
+        for lane in xrange(1, nlanes + 1):
+            for n in xrange(nsamples):
+                fh.write("<tr>\n" + "".join(["<td>{}</td>\n".format(x) for x in
+                    [lane, "P001_{}_index{}".format(101 + n, n), "hg19", "ACGTACGT{:04d}".format(n), "J__Doe_00_01", "N", "J__Doe_00_01",
+                     "3,942", "100.00", "{:,}".format(39034396 + n), "7.94", "92.57", "7.43", "90.05", "35.22"]]) + "</tr>\n")
+        fh.write(end + "<p></p>\n<h2>Sample information</h2>\n")
+        head, body, end = table(SMP_HEADER)
+        fh.write(head + body)
+        for n in xrange(nsamples):
+            fh.write("<tr>\n" + "".join(["<td>{}</td>\n".format(x) for x in
+                ["P001_{}_index{}".format(101 + n, n), "R1", "NN", "/srv/illumina/{}/Unaligned/Project_J__Doe_00_01/Sample_P001_{}_index{}".format(FLOWCELL, 101 + n, n)]]) + "</tr>\n")
+        fh.write(end + "<p>bcl2fastq-1.8.3</p>\n</body>\n</html>\n")
+
+class SoupFlowcellRunMetricsParser(FlowcellRunMetricsParser):
+    """Parser reading Demultiplex_Stats.htm files with BeautifulSoup as before"""
+    def _read_demultiplex_stats_htm(self, fh):
+        htm_doc = fh.read()
+        soup = BeautifulSoup(htm_doc, "html.parser")
+        allrows = soup.findAll("tr")
+        column_gen=(row.findAll("th") for row in allrows)
+        headers = [h for h in column_gen if h]
+        bc_header = [str(x.string) for x in headers[0]]
+        smp_header = [str(x.string) for x in headers[1]]
+        smp_header[0] = "Sample ID"
+        soup = BeautifulSoup(htm_doc, "html.parser")
+        table = soup.findAll("table")[1]
+        column_gen = (row.findAll("td") for row in table.findAll("tr"))
+        bc_rows = [{bc_header[i]:str(row[i].string) for i in range(0, len(bc_header)) if row} for row in column_gen]
+        soup = BeautifulSoup(htm_doc, "html.parser")
+        table = soup.findAll("table")[3]
+        column_gen = (row.findAll("td") for row in table.findAll("tr"))
+        smp_rows = [{smp_header[i]:str(row[i].string) for i in range(0, len(smp_header)) if row} for row in column_gen]
+        return bc_rows, smp_rows
+
+def run(parser_class, path, queue):
+    qc.LOG.level = logbook.ERROR
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    t0 = time.time()
+    metrics = parser_class(path).parse_demultiplex_stats_htm(FLOWCELL.split("_")[1])
+    t = time.time() - t0
+    queue.put((t, (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss) / 1024.0, metrics))
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark parsing a large Demultiplex_Stats.htm file")
+    parser.add_argument('-l','--nlanes', type=int, default=8,
+                        help="the number of lanes. Default is 8")
+    parser.add_argument('-s','--nsamples', type=int, default=384,
+                        help="the number of samples per lane. Default is 384")
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix="bench_demultiplex_stats_", dir=os.getcwd())
+    try:
+        path = os.path.join(root, FLOWCELL)
+        stats_dir = os.path.join(path, "Unaligned", "Basecall_Stats_{}".format(FLOWCELL.split("_")[1][1:]))
+        os.makedirs(stats_dir)
+        fn = os.path.join(stats_dir, "Demultiplex_Stats.htm")
+        write_demultiplex_stats(fn, args.nlanes, args.nsamples)
+        print "{} rows, {:.1f} MB".format(args.nlanes * args.nsamples, os.path.getsize(fn) / 1024.0 / 1024)
+        print "{:<16} {:>8} {:>14}".format("parser","s","peak RSS (MB)")
+        results = {}
+        for label, parser_class in [("BeautifulSoup", SoupFlowcellRunMetricsParser), ("streaming", FlowcellRunMetricsParser)]:
+            queue = multiprocessing.Queue()
+            p = multiprocessing.Process(target=run, args=(parser_class, path, queue))
+            p.start()
+            t, rss, results[label] = queue.get()
+            p.join()
+            print "{:<16} {:>8.3f} {:>14.1f}".format(label, t, rss)
+        assert len(results["streaming"]["Barcode_lane_statistics"]) == args.nlanes * args.nsamples, "the rows were not parsed"
+        assert results["BeautifulSoup"] == results["streaming"], "the parsers returned different metrics"
+    finally:
+        shutil.rmtree(root)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""Throughput benchmark for the block-buffered FastQParser.
+
+Compares the line-at-a-time parsing that FastQParser used to do with the 
+block reader, both record-by-record and batch-wise, on plain and gzipped 
+input. Gzipped input is also parsed with each of the decompression 
+backends. Run with:
+
+    python -m tests.benchmarks.bench_fastq_parser [-n RECORDS]
+"""
+import argparse
+import gzip
+import os
+import shutil
+import tempfile
+import time
+import scilifelab.utils.fastq_utils as fu
+import tests.generate_test_data as td
+
+def write_fastq(fname, nrecords):
+    """Write nrecords random records to fname, using a small pool of 
+    pre-generated records to keep the setup time down
+    """
+    pool = [td.generate_fastq_record() for n in xrange(1000)]
+    fqw = fu.FastQWriter(fname)
+    for n in xrange(nrecords):
+        fqw.write(pool[n % len(pool)])
+    fqw.close()
+    return fname
+
+class LegacyFastQParser:
+    """The FastQParser iterator as it was before block reading was 
+    introduced, reading four lines at a time from the file handle
+    """
+    def __init__(self, fname):
+        fh = open(fname,"rb")
+        if fname.endswith(".gz"):
+            fh = gzip.GzipFile(fileobj=fh)
+        self._fh = fh
+        self._records_read = 0
+        
+    def __iter__(self):
+        return self
+    
+    def next(self):
+        self._records_read += 1
+        return [self._fh.next().strip() for n in range(4)]
+
+def legacy_parse(fname):
+    return sum([1 for r in LegacyFastQParser(fname)])
+
+def block_parse(fname, decompress=None):
+    return sum([1 for r in fu.FastQParser(fname,decompress=decompress)])
+
+def batch_parse(fname, decompress=None):
+    return sum([len(b) for b in fu.FastQParser(fname,decompress=decompress).batches()])
+
+def timeit(fn, *args):
+    t0 = time.time()
+    n = fn(*args)
+    return n, time.time() - t0
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark FastQParser throughput")
+    parser.add_argument('-n','--nrecords', type=int, default=500000,
+                        help="the number of records in the benchmark files. Default is 500000")
+    args = parser.parse_args()
+    
+    tmpdir = tempfile.mkdtemp(prefix="bench_fastq_parser_")
+    try:
+        plain = write_fastq(os.path.join(tmpdir,"bench.fastq"), args.nrecords)
+        gzipped = write_fastq(os.path.join(tmpdir,"bench.fastq.gz"), args.nrecords)
+        mb = os.path.getsize(plain)/1024.0/1024.0
+        runs = [("plain","legacy",legacy_parse,[plain]),
+                ("plain","record",block_parse,[plain]),
+                ("plain","batch",batch_parse,[plain]),
+                ("gzip","legacy",legacy_parse,[gzipped])]
+        for decompress in ["gzip","thread","process"]:
+            runs.append(("gzip/{}".format(decompress),"record",block_parse,[gzipped,decompress]))
+            runs.append(("gzip/{}".format(decompress),"batch",batch_parse,[gzipped,decompress]))
+        print "{:<14} {:<10} {:>12} {:>10} {:>8}".format("input","parser","records/s","MB/s","s")
+        for label, name, fn, fargs in runs:
+            n, t = timeit(fn, *fargs)
+            assert n == args.nrecords, "{} parser returned {} records, expected {}".format(name,n,args.nrecords)
+            print "{:<14} {:<10} {:>12.0f} {:>10.1f} {:>8.2f}".format(label,name,n/t,mb/t,t)
+        print "External decompressor: {}".format(fu.find_decompressor() or "none found, 'process' used 'thread'")
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+"""Benchmark for the streaming FastQProfiler.
+
+Profiles generated gzipped fastq files of increasing size, in full and 
+on a 1% subsample, and reports the throughput and the size of the 
+profiler's accumulators, which should stay the same as the number of 
+reads grows. Run with:
+
+    python -m tests.benchmarks.bench_fastq_profiler [-n RECORDS]
+"""
+import argparse
+import resource
+import shutil
+import tempfile
+import time
+import os
+import scilifelab.utils.fastq_utils as fu
+from tests.benchmarks.bench_fastq_parser import write_fastq
+
+def accumulator_bytes(profiler):
+    return sum([a.nbytes for a in (profiler._qualities, profiler._bases, profiler._read_qualities,
+                                   profiler._read_gc, profiler._lengths)])
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the streaming fastq profiler")
+    parser.add_argument('-n','--nrecords', type=int, default=1000000,
+                        help="the number of records in the largest file. Default is 1000000")
+    args = parser.parse_args()
+    
+    tmpdir = tempfile.mkdtemp(prefix="bench_fastq_profiler_")
+    try:
+        print "{:>10} {:>9} {:>8} {:>12} {:>12} {:>10}".format("records","fraction","s","records/s","accum bytes","max rss kB")
+        for n in [args.nrecords//100, args.nrecords//10, args.nrecords]:
+            fname = write_fastq(os.path.join(tmpdir, "{}.fastq.gz".format(n)), n)
+            for fraction in [None, 0.01]:
+                profiler = fu.FastQProfiler(fraction=fraction)
+                t0 = time.time()
+                profiler.profile(fname)
+                t = time.time() - t0
+                print "{:>10} {:>9} {:>8.2f} {:>12.0f} {:>12} {:>10}".format(n, fraction or 1, t, n/t, 
+                                                                            accumulator_bytes(profiler),
+                                                                            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == "__main__":
+    main()
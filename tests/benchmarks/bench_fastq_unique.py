@@ -0,0 +1,110 @@
+"""Benchmark single-pass deduplication against the three-pass scheme.
+
+The three-pass scheme is the one scripts/fastq_unique.py used before 
+deduplicate_fastq: one pass to count the records and size a Bloom filter, 
+one to collect the sequences the filter reports as seen and one to write 
+the output. ScalableBloomFilter, sized to the record count, stands in for 
+the bloomfaster filter it used. It is queried one record at a time, as
+bloomfaster was, which is slower than bloomfaster's C calls, so the timing
+of the three-pass scheme is pessimistic. Each method runs in its own process so that 
+the peak RSS can be reported. Run with:
+
+    python -m tests.benchmarks.bench_fastq_unique [-n RECORDS] [-d DUPLICATION]
+"""
+import argparse
+import collections
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import tempfile
+import time
+import scilifelab.utils.fastq_utils as fu
+import tests.generate_test_data as td
+
+def write_fastq(fname, nrecords, duplication):
+    """Write nrecords records to fname, of which a fraction duplication are 
+    copies of earlier records
+    """
+    fqw = fu.FastQWriter(fname, compresslevel=1)
+    written = []
+    for n in xrange(nrecords):
+        if written and random.random() < duplication:
+            record = random.choice(written)
+        else:
+            record = td.generate_fastq_record()
+            if len(written) < 10000:
+                written.append(record)
+        fqw.write(record)
+    fqw.close()
+    return fname
+
+def three_pass(infile, outfile):
+    fp = fu.FastQParser(infile)
+    for _ in fp:
+        pass
+    bloom = fu.ScalableBloomFilter(capacity=max(1,fp.rread()), error_rate=1e-3)
+    dedup = fu.FastQDeduplicator(exact=False)
+    fp.seek(0)
+    checks = []
+    for batch in fp.batches():
+        h1, h2 = dedup._hashes(batch.sequences)
+        for seq, h1, h2 in zip(batch.sequences, h1, h2):
+            key = (fu.np.array([h1]), fu.np.array([h2]))
+            if bloom.contains(*key)[0]:
+                checks.append(seq)
+            bloom.add(*key)
+    fp.seek(0)
+    checks = frozenset(checks)
+    fw = fu.FastQWriter(outfile)
+    seen = collections.defaultdict(int)
+    for header,seq,plus,qual in fp:
+        if seq in checks:
+            seen[seq] += 1
+            if seen[seq] > 1:
+                continue
+        fw.write([header,seq,plus,qual])
+    fw.close()
+    return 3
+
+def single_pass(infile, outfile, exact=True):
+    fu.deduplicate_fastq(infile, outfile, exact=exact)
+    return 1
+
+def run(queue, fn, args):
+    t0 = time.time()
+    passes = fn(*args)
+    queue.put((passes, time.time() - t0, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark single-pass and three-pass fastq deduplication")
+    parser.add_argument('-n','--nrecords', type=int, default=200000,
+                        help="the number of records. Default is 200000")
+    parser.add_argument('-d','--duplication', type=float, default=0.2,
+                        help="the fraction of duplicated records. Default is 0.2")
+    args = parser.parse_args()
+    
+    tmpdir = tempfile.mkdtemp(prefix="bench_fastq_unique_")
+    try:
+        infile = write_fastq(os.path.join(tmpdir, "in.fastq.gz"), args.nrecords, args.duplication)
+        outputs = {}
+        print "{:<22} {:>6} {:>8} {:>12} {:>12}".format("method","passes","s","records/s","max rss kB")
+        for label, fn, kw in [("three-pass", three_pass, ()), 
+                              ("single-pass exact", single_pass, (True,)), 
+                              ("single-pass bloom only", single_pass, (False,))]:
+            outfile = os.path.join(tmpdir, "{}.fastq.gz".format(fn.__name__ + str(kw)))
+            queue = multiprocessing.Queue()
+            p = multiprocessing.Process(target=run, args=(queue, fn, (infile, outfile) + kw))
+            p.start()
+            passes, t, rss = queue.get()
+            p.join()
+            outputs[label] = sum([1 for r in fu.FastQParser(outfile)])
+            print "{:<22} {:>6} {:>8.2f} {:>12.0f} {:>12}".format(label, passes, t, args.nrecords/t, rss)
+        assert outputs["three-pass"] == outputs["single-pass exact"], "The exact methods wrote a different number of records"
+        print "unique records: {}".format(", ".join(["{} {}".format(k, v) for k, v in sorted(outputs.items())]))
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""Benchmark index resolution in scripts/demultiplex_mctag.py.
+
+Resolves simulated haloplex index reads (index, molecular tag and random
+sequencing errors) against 96 and 384 supplied indexes, comparing the 
+precomputed IndexResolver with comparing every read to every index. The
+results of the two are checked to be identical. Run with:
+
+    python -m tests.benchmarks.bench_index_resolver [-n READS] [-m MISMATCHES]
+"""
+import argparse
+import collections
+import imp
+import os
+import random
+import time
+import tests.generate_test_data as td
+
+mctag = imp.load_source("demultiplex_mctag", os.path.join(os.path.dirname(__file__), 
+                                                          os.pardir, os.pardir, "scripts", "demultiplex_mctag.py"))
+
+def legacy_resolve(read_ind_seq, index_dict, max_mismatches):
+    """Resolve a read the way parse_readset_byindexdict did before IndexResolver
+    """
+    matches_dict = collections.defaultdict(list)
+    for supplied_index in sorted(index_dict.keys(), key=lambda x: (-len(x))):
+        mismatches = mctag.find_dist(supplied_index, read_ind_seq, max_mismatches)
+        matches_dict[mismatches].append(supplied_index)
+        if mismatches == 0:
+            break
+    for x in range(0, max_mismatches+1):
+        if matches_dict.get(x):
+            return matches_dict[x], x
+    return [], None
+
+def simulate_reads(indexes, nreads, error_rate=0.02, unmatched=0.1):
+    reads = []
+    for n in xrange(nreads):
+        if random.random() < unmatched:
+            seq = td.generate_barcode(len(indexes[0]))
+        else:
+            seq = "".join([random.choice("ACGTN") if random.random() < error_rate else c 
+                           for c in random.choice(indexes)])
+        reads.append(seq + td.generate_barcode(10))
+    return reads
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark index resolution with 96 and 384 indexes")
+    parser.add_argument('-n','--nreads', type=int, default=20000,
+                        help="the number of simulated index reads. Default is 20000")
+    parser.add_argument('-m','--mismatches', type=int, default=1,
+                        help="the maximum number of mismatches. Default is 1")
+    args = parser.parse_args()
+    
+    print "{:<10} {:<10} {:>10} {:>12}".format("indexes","resolver","setup s","reads/s")
+    for nindexes in [96, 384]:
+        index_dict = dict([(ix, None) for ix in set([td.generate_barcode(8) for n in xrange(2*nindexes)])][0:nindexes])
+        reads = simulate_reads(index_dict.keys(), args.nreads)
+        
+        t0 = time.time()
+        expected = [legacy_resolve(r, index_dict, args.mismatches) for r in reads]
+        t = time.time() - t0
+        print "{:<10} {:<10} {:>10.2f} {:>12.0f}".format(nindexes, "legacy", 0, len(reads)/t)
+        
+        t0 = time.time()
+        resolver = mctag.IndexResolver(index_dict.keys(), args.mismatches)
+        setup = time.time() - t0
+        t0 = time.time()
+        observed = [resolver.resolve(r) for r in reads]
+        t = time.time() - t0
+        print "{:<10} {:<10} {:>10.2f} {:>12.0f}".format(nindexes, "table", setup, len(reads)/t)
+        assert observed == expected, "IndexResolver results differ from the legacy resolution"
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,43 @@
+"""Benchmark mapping barcode names to project sample names.
+
+Maps the barcode names of the sample runs of a synthetic project to its 
+project sample names, with _match_barcode_name_to_project_sample, which 
+scans all project samples for every barcode name, and with a 
+ProjectSampleMatcher built once for the project, and checks that the 
+results are identical. Run with:
+
+    python -m tests.benchmarks.bench_project_sample_matcher [-n SAMPLES]
+"""
+import argparse
+import random
+import time
+from scilifelab.db.statusdb import _match_barcode_name_to_project_sample, ProjectSampleMatcher
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark barcode name to project sample matching")
+    parser.add_argument('-n','--nsamples', type=int, default=1000,
+                        help="the number of project samples. Default is 1000")
+    args = parser.parse_args()
+
+    random.seed(0)
+    project_samples = {"P123_{}{}".format(101 + n, random.choice(["", "", "B", "F"])):{'customer_name':"S{}".format(n)}
+                       for n in xrange(args.nsamples)}
+    # Sample runs on two flowcells, with index and prep letter suffixes
+    barcodes = ["P123_{}{}_index{}".format(101 + n, random.choice(["", "B", "C"]), n % 24) for n in xrange(int(args.nsamples * 1.1))] * 2
+
+    t0 = time.time()
+    scanned = [_match_barcode_name_to_project_sample(bc, project_samples) for bc in barcodes]
+    t_scan = time.time() - t0
+    t0 = time.time()
+    matcher = ProjectSampleMatcher(project_samples)
+    t_build = time.time() - t0
+    indexed = [matcher.match(bc) for bc in barcodes]
+    t_index = time.time() - t0
+    assert scanned == indexed, "The matcher and the scan mapped barcode names differently"
+    print "{} barcode names, {} project samples, {} matched".format(len(barcodes), len(project_samples), len([x for x in indexed if x]))
+    print "{:<8} {:>8}".format("method", "s")
+    print "{:<8} {:>8.3f}".format("scan", t_scan)
+    print "{:<8} {:>8.3f} (index built in {:.3f}s)".format("indexed", t_index, t_build)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""Benchmark uploading project summaries to statusdb.
+
+Fills a CouchDB stand-in (tests.couchdb_standin) with project summary
+documents and uploads them again, with a fraction modified, first as
+before, looking up each project id by iterating the whole project_name
+view and fetching every stored document to compare it, and then with a
+keyed project_name query and save_couchdb_objs, which reads the stored
+content hashes and only fetches and writes the changed documents. Reports
+the time and the number of requests and bytes transferred. Run with:
+
+    python -m tests.benchmarks.bench_project_summary_upload [-n PROJECTS] [-m MODIFIED]
+"""
+import argparse
+import copy
+import time
+import couchdb
+from scilifelab.db.statusDB_utils import save_couchdb_objs, find_proj_from_view, comp_obj
+from tests.couchdb_standin import CouchDBStandIn
+
+def find_proj_from_full_view(proj_db, project_name):
+    for proj in proj_db.view('project/project_name'):
+        if proj.key == project_name:
+            return proj.value
+    return None
+
+def save_couchdb_obj_get(db, obj):
+    dbobj = db.get(obj['_id'])
+    dbobj.pop("content_hash")
+    dbobj.pop("content_hash_rev")
+    obj["_rev"] = dbobj.get("_rev")
+    obj["modification_time"] = dbobj["modification_time"] = "now"
+    obj["creation_time"] = dbobj["creation_time"]
+    if not comp_obj(obj, dbobj):
+        db.save(obj)
+        return 'uppdated'
+    return 'not uppdated'
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark uploading project summaries")
+    parser.add_argument('-n','--nprojects', type=int, default=1000,
+                        help="the number of projects. Default is 1000")
+    parser.add_argument('-m','--modified', type=float, default=0.02,
+                        help="the fraction of projects that are modified. Default is 0.02")
+    args = parser.parse_args()
+
+    server = CouchDBStandIn().start()
+    try:
+        def project(i, reads=10.0):
+            return {'_id': "id{:05d}".format(i), 'entity_type': 'project_summary', 'project_name': "J.Doe_{:05d}".format(i),
+                    'samples': dict(("P{}_{}".format(i, s), {'m_reads_sequenced': reads, 'status': "Sequenced"}) for s in range(96))}
+        server.create("projects")
+        db = couchdb.Server(server.url)["projects"]
+        save_couchdb_objs(db, [project(i) for i in xrange(args.nprojects)])
+        nmodified = int(args.nprojects * args.modified)
+
+        print "{:<20} {:>8} {:>9} {:>12} {:>9}".format("method","s","requests","bytes","updated")
+        for i, (label, find, save) in enumerate([("get and compare", find_proj_from_full_view, lambda objs: [save_couchdb_obj_get(db, obj) for obj in objs]),
+                                                 ("content hashes", find_proj_from_view, lambda objs: save_couchdb_objs(db, objs))]):
+            objs = [project(n, reads=(11.0 + i if n < nmodified else 10.0)) for n in xrange(args.nprojects)]
+            server.reset_counts()
+            t0 = time.time()
+            # The upload looks up the id of a sample of the projects by name
+            for obj in objs[:50]:
+                assert find(db, obj['project_name']) == obj['_id']
+            info = save(copy.deepcopy(objs))
+            t = time.time() - t0
+            print "{:<20} {:>8.3f} {:>9} {:>12} {:>9}".format(label, t, sum(server.requests.values()),
+                                                              sum(server.bytes_sent.values()), info.count('uppdated'))
+            assert info.count('uppdated') == nmodified, "{} did not update the modified projects".format(label)
+    finally:
+        server.stop()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""Benchmark collecting the files of a flowcell directory for the sample parsers.
+
+Generates a bcbb-style flowcell directory with picard, fastq_screen,
+bc metrics and FastQC output for a number of samples and creates a
+SampleRunMetricsParser for each sample, as upload_qc does, first with
+each parser walking the whole directory as before, and then with the
+parsers sharing one DirectoryIndex. The directory is created in the
+current directory, since the parsers ignore paths containing 'tmp'.
+Run with:
+
+    python -m tests.benchmarks.bench_qc_collect_files [-s SAMPLES] [-i IMAGES]
+"""
+import argparse
+import os
+import re
+import shutil
+import tempfile
+import time
+from scilifelab.bcbio.qc import RunMetricsParser, SampleRunMetricsParser, DirectoryIndex
+
+FLOWCELL = "120924_AC003CCCXX"
+
+def sample_kw(n, nlanes=8):
+    """Sample keywords as _parse_samplesheet passes them to the parsers"""
+    lane = n % nlanes + 1
+    barcode_id = n // nlanes + 1
+    return dict(flowcell="AC003CCCXX", date="120924", lane=lane, barcode_name="P001_{}".format(100 + n),
+                sample_prj="J.Doe_00_01", barcode_id=barcode_id, sequence="ACGT")
+
+def make_flowcell_tree(root, nsamples, nimages=10, nlanes=8):
+    """Generate a bcbb flowcell directory under root with the metrics
+    files of nsamples samples and nimages FastQC images per sample.
+
+    :returns: the flowcell directory
+    """
+    fcdir = os.path.join(root, FLOWCELL)
+    dirs = {x: os.path.join(fcdir, x) for x in ["nophix", "alignments", "fastq_screen", "tx"]}
+    for d in dirs.values():
+        os.makedirs(d)
+    def touch(*path):
+        open(os.path.join(*path), "w").close()
+    for lane in range(1, nlanes + 1):
+        touch(dirs["nophix"], "{}_{}_nophix.bc_metrics".format(lane, FLOWCELL))
+        touch(dirs["nophix"], "{}_{}_nophix.filter_metrics".format(lane, FLOWCELL))
+    for n in xrange(nsamples):
+        kw = sample_kw(n, nlanes)
+        pfx = "{}_{}_nophix_{}".format(kw["lane"], FLOWCELL, kw["barcode_id"])
+        for m in ["align", "hs", "insert", "dup"]:
+            touch(dirs["alignments"], "{}-sort.{}_metrics".format(pfx, m))
+        for r in [1, 2]:
+            touch(dirs["fastq_screen"], "{}_{}_screen.txt".format(pfx, r))
+            touch(dirs["tx"], "{}_{}.fastq".format(pfx, r))
+        fastqc = os.path.join(fcdir, "fastqc", "{}-sort-dup_fastqc".format(pfx))
+        os.makedirs(os.path.join(fastqc, "Images"))
+        for f in ["fastqc_data.txt", "summary.txt", "fastqc_report.html"]:
+            touch(fastqc, f)
+        for i in range(nimages):
+            touch(fastqc, "Images", "image_{}.png".format(i))
+    for i in range(10):
+        touch(fcdir, "{:02d}_checkpoint.txt".format(i))
+    touch(fcdir, "bcbb_software_versions.txt")
+    return fcdir
+
+class WalkingSampleRunMetricsParser(SampleRunMetricsParser):
+    """Parser collecting its files with os.walk as before"""
+    def _collect_files(self):
+        self.files = []
+        for root, dirs, files in os.walk(self.path):
+            if re.search(self.reignore, root):
+                continue
+            self.files = self.files + [os.path.join(root, x) for x in files]
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark collecting flowcell files for the sample parsers")
+    parser.add_argument('-s','--nsamples', type=int, default=96,
+                        help="the number of samples on the flowcell. Default is 96")
+    parser.add_argument('-i','--nimages', type=int, default=10,
+                        help="the number of FastQC images per sample. Default is 10")
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix="bench_qc_collect_files_", dir=os.getcwd())
+    try:
+        fcdir = make_flowcell_tree(root, args.nsamples, args.nimages)
+        print "{} files for {} samples".format(sum([len(f) for _, _, f in os.walk(fcdir)]), args.nsamples)
+        print "{:<16} {:>8}".format("parsers","s")
+        results = {}
+        def shared_index():
+            index = DirectoryIndex(fcdir, ignore=RunMetricsParser.reignore)
+            return [SampleRunMetricsParser(fcdir, index=index) for n in xrange(args.nsamples)]
+        for label, make_parsers in [("walk per sample", lambda: [WalkingSampleRunMetricsParser(fcdir) for n in xrange(args.nsamples)]),
+                                    ("shared index", shared_index)]:
+            t0 = time.time()
+            parsers = make_parsers()
+            t = time.time() - t0
+            results[label] = parsers[0].files
+            print "{:<16} {:>8.3f}".format(label, t)
+        assert results["walk per sample"] == results["shared index"], "the parsers collected different files"
+    finally:
+        shutil.rmtree(root)
+
+if __name__ == "__main__":
+    main()
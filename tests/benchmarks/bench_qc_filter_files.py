@@ -0,0 +1,80 @@
+"""Benchmark looking up the metrics files of the samples of a flowcell.
+
+Generates a bcbb-style flowcell directory (see bench_qc_collect_files)
+with, by default, 96 samples and about 100k files, most of them FastQC
+images, and records the file lookups that the picard, fastq_screen, bc
+metrics, FastQC, checkpoint and software version parsers of each sample
+make. The lookups are then replayed, first searching all files of the
+flowcell with each pattern as before, for the first few samples since
+this is slow, and then with the lookups by kind and lane of the
+FileClassifier, for all samples, after classifying the files once. Run with:
+
+    python -m tests.benchmarks.bench_qc_filter_files [-s SAMPLES] [-i IMAGES] [-n SEARCHED]
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+import logbook
+import scilifelab.bcbio.qc as qc
+from scilifelab.bcbio.qc import RunMetricsParser, SampleRunMetricsParser, DirectoryIndex
+from tests.benchmarks.bench_qc_collect_files import make_flowcell_tree, sample_kw
+
+class RecordingSampleRunMetricsParser(SampleRunMetricsParser):
+    """Parser recording its file lookups, finding no files"""
+    def __init__(self, *args, **kwargs):
+        self.lookups = []
+        SampleRunMetricsParser.__init__(self, *args, **kwargs)
+
+    def filter_files(self, pattern, filter_fn=None, kind=None, lane=None):
+        self.lookups.append((pattern, filter_fn, kind, lane))
+        return []
+
+def record_lookups(fcdir, index, kw):
+    parser = RecordingSampleRunMetricsParser(fcdir, index=index)
+    parser.read_picard_metrics(**kw)
+    parser.parse_fastq_screen(**kw)
+    parser.get_bc_count(**kw)
+    parser.read_fastqc_metrics(**kw)
+    parser.parse_bcbb_checkpoints(**kw)
+    parser.parse_software_versions(**kw)
+    return parser.lookups
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark looking up the metrics files of flowcell samples")
+    parser.add_argument('-s','--nsamples', type=int, default=96,
+                        help="the number of samples on the flowcell. Default is 96")
+    parser.add_argument('-i','--nimages', type=int, default=1030,
+                        help="the number of FastQC images per sample. Default is 1030")
+    parser.add_argument('-n','--nsearched', type=int, default=8,
+                        help="the number of samples whose files are searched for as before. Default is 8")
+    args = parser.parse_args()
+    qc.LOG.level = logbook.ERROR
+
+    root = tempfile.mkdtemp(prefix="bench_qc_filter_files_", dir=os.getcwd())
+    try:
+        fcdir = make_flowcell_tree(root, args.nsamples, args.nimages)
+        index = DirectoryIndex(fcdir, ignore=RunMetricsParser.reignore)
+        lookups = [record_lookups(fcdir, index, sample_kw(n)) for n in xrange(args.nsamples)]
+        print "{} files, {} samples, {} lookups per sample".format(len(index.files()), args.nsamples, len(lookups[0]))
+        print "{:<12} {:>8} {:>8} {:>12}".format("lookup","samples","s","ms/sample")
+        results = {}
+        for label, nsamples, use_kind in [("search", min(args.nsearched, args.nsamples), False), ("classifier", args.nsamples, True)]:
+            t0 = time.time()
+            parser = SampleRunMetricsParser(fcdir, index=index)
+            results[label] = [[parser.filter_files(pattern, filter_fn, **(dict(kind=kind, lane=lane) if use_kind else {}))
+                               for pattern, filter_fn, kind, lane in lookups[n]] for n in xrange(nsamples)]
+            t = time.time() - t0
+            print "{:<12} {:>8} {:>8.3f} {:>12.2f}".format(label, nsamples, t, 1000 * t / nsamples)
+            if label == "search":
+                t0 = time.time()
+                index.classifier(fcdir)
+                print "{:<12} {:>8} {:>8.3f}".format("classify", "", time.time() - t0)
+        assert results["search"] == results["classifier"][:len(results["search"])], "the lookups found different files"
+        assert all([any(r) for r in results["classifier"]]), "no files were found"
+    finally:
+        shutil.rmtree(root)
+
+if __name__ == "__main__":
+    main()
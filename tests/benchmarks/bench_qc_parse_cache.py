@@ -0,0 +1,123 @@
+"""Benchmark reading the picard, fastq_screen and FastQC metrics of a flowcell with a parse cache.
+
+Generates a bcbb-style flowcell directory with picard, fastq_screen and
+FastQC output for a number of samples and parses the metrics of each
+sample, as upload_qc does, first without a cache, then with an empty
+ParseCache, and finally with a new ParseCache reading the cache written
+by the previous run, as when upload_qc is run again on an unchanged
+flowcell. Reports the time and the number of metrics files opened. Run
+with:
+
+    python -m tests.benchmarks.bench_qc_parse_cache [-s SAMPLES] [-r ROWS]
+"""
+import argparse
+import __builtin__
+import os
+import shutil
+import tempfile
+import time
+import logbook
+import scilifelab.bcbio.qc as qc
+from scilifelab.bcbio.qc import RunMetricsParser, SampleRunMetricsParser, DirectoryIndex, ParseCache
+from tests.benchmarks.bench_qc_collect_files import FLOWCELL, sample_kw
+
+FASTQC_SECTIONS = ["Basic Statistics", "Per base sequence quality", "Per sequence quality scores",
+                   "Per base sequence content", "Per base GC content", "Per sequence GC content",
+                   "Per base N content", "Sequence Length Distribution", "Sequence Duplication Levels",
+                   "Overrepresented sequences", "Kmer Content"]
+
+def picard_metrics(command, header, rows, histogram=0):
+    lines = ["## net.sf.picard.metrics.StringHeader", "# {} INPUT=sample.bam".format(command), "",
+             "## METRICS CLASS\tnet.sf.picard.metrics", "\t".join(header)]
+    lines += ["\t".join(row) for row in rows] + [""]
+    if histogram:
+        lines += ["## HISTOGRAM\tjava.lang.Integer", "insert_size\tAll_Reads.fr_count"]
+        lines += ["{}\t{}".format(i, i * 7) for i in xrange(histogram)] + [""]
+    return "\n".join(lines)
+
+def make_flowcell_tree(root, nsamples, nrows=100, nlanes=8):
+    """Generate a bcbb flowcell directory under root with picard,
+    fastq_screen and FastQC metrics of nsamples samples, with nrows
+    rows per FastQC section and picard histogram.
+
+    :returns: the flowcell directory
+    """
+    fcdir = os.path.join(root, FLOWCELL)
+    for d in ["alignments", "fastq_screen"]:
+        os.makedirs(os.path.join(fcdir, d))
+    header = ["METRIC_{}".format(i) for i in xrange(20)]
+    values = [str(i * 1.5) for i in xrange(19)]
+    contents = {'align': picard_metrics("net.sf.picard.analysis.CollectAlignmentSummaryMetrics", ["CATEGORY"] + header[1:],
+                                        [[c] + values for c in ["FIRST_OF_PAIR", "SECOND_OF_PAIR", "PAIR"]]),
+                'hs': picard_metrics("net.sf.picard.analysis.directed.CalculateHsMetrics", header, [values + ["1"]]),
+                'insert': picard_metrics("net.sf.picard.analysis.CollectInsertSizeMetrics", header, [values + ["1"]], nrows),
+                'dup': picard_metrics("net.sf.picard.sam.MarkDuplicates", header, [values + ["1"]], nrows)}
+    screen = "Library\t%Unmapped\t%One_hit_one_library\t%Multiple_hits_one_library\n" + \
+        "".join(["{}\t98.0\t1.5\t0.5\n".format(x) for x in ["Human", "Mouse", "Rat", "Ecoli", "PhiX", "Yeast"]])
+    fastqc = "##FastQC\t0.10.1\n" + "".join([">>{}\tpass\n#Base\tMean\tMedian\tLower Quartile\tUpper Quartile\n".format(s) +
+                                             "".join(["{}\t{}\t38.0\t37.0\t39.0\n".format(i, 36 + i * 0.01) for i in xrange(nrows)]) +
+                                             ">>END_MODULE\n" for s in FASTQC_SECTIONS])
+    def write(content, *path):
+        with open(os.path.join(*path), "w") as fh:
+            fh.write(content)
+    for n in xrange(nsamples):
+        kw = sample_kw(n, nlanes)
+        pfx = "{}_{}_nophix_{}".format(kw["lane"], FLOWCELL, kw["barcode_id"])
+        for m, content in contents.items():
+            write(content, fcdir, "alignments", "{}-sort.{}_metrics".format(pfx, m))
+        for r in [1, 2]:
+            write(screen, fcdir, "fastq_screen", "{}_{}_screen.txt".format(pfx, r))
+        fastqc_dir = os.path.join(fcdir, "fastqc", "{}-sort-dup_fastqc".format(pfx))
+        os.makedirs(fastqc_dir)
+        write(fastqc, fastqc_dir, "fastqc_data.txt")
+    return fcdir
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark parsing flowcell metrics with a parse cache")
+    parser.add_argument('-s','--nsamples', type=int, default=96,
+                        help="the number of samples on the flowcell. Default is 96")
+    parser.add_argument('-r','--nrows', type=int, default=100,
+                        help="the number of rows of each FastQC section and picard histogram. Default is 100")
+    args = parser.parse_args()
+    qc.LOG.level = logbook.ERROR
+
+    root = tempfile.mkdtemp(prefix="bench_qc_parse_cache_", dir=os.getcwd())
+    fcdir = os.path.join(root, FLOWCELL)
+    builtin_open = __builtin__.open
+    opened = []
+    def counting_open(name, *a, **kw):
+        if name.startswith(fcdir):
+            opened.append(name)
+        return builtin_open(name, *a, **kw)
+    try:
+        make_flowcell_tree(root, args.nsamples, args.nrows)
+        cachedir = os.path.join(root, "cache")
+        index = DirectoryIndex(fcdir, ignore=RunMetricsParser.reignore)
+        print "{:<16} {:>8} {:>8} {:>12}".format("parse","s","opened","cache bytes")
+        results = {}
+        __builtin__.open = counting_open
+        for label, cache in [("no cache", lambda: None), ("empty cache", lambda: ParseCache(cachedir)),
+                             ("unchanged", lambda: ParseCache(cachedir))]:
+            del opened[:]
+            t0 = time.time()
+            cache = cache()
+            metrics = []
+            for n in xrange(args.nsamples):
+                kw = sample_kw(n)
+                p = SampleRunMetricsParser(fcdir, index=index, cache=cache)
+                metrics.append([p.read_picard_metrics(**kw), p.parse_fastq_screen(**kw), p.read_fastqc_metrics(**kw)])
+            if cache is not None:
+                cache.flush()
+            t = time.time() - t0
+            results[label] = metrics
+            size = sum([os.path.getsize(os.path.join(cachedir, x)) for x in os.listdir(cachedir)]) if os.path.exists(cachedir) else 0
+            print "{:<16} {:>8.3f} {:>8} {:>12}".format(label, t, len(opened), size)
+        assert all([all(m) for m in results["no cache"]]), "no metrics were parsed"
+        assert results["no cache"] == results["empty cache"] == results["unchanged"], "the cached metrics differ"
+        assert len(opened) == 0, "metrics files were read again"
+    finally:
+        __builtin__.open = builtin_open
+        shutil.rmtree(root)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""Benchmark collecting the qc metrics of the samples of a flowcell with worker threads.
+
+Generates a bcbb-style flowcell directory (see bench_qc_collect_files),
+without the picard metrics, and collects the qc metrics of its samples
+with RunMetricsController._collect_sample_qc, as upload_qc does, with
+an increasing number of workers. Each file opened by the parsers is
+delayed to emulate the latency of network storage. Run with:
+
+    python -m tests.benchmarks.bench_qc_sample_workers [-s SAMPLES] [-l LATENCY] [-w WORKERS ...]
+"""
+import argparse
+import glob
+import os
+import shutil
+import tempfile
+import time
+import logbook
+import scilifelab.bcbio.qc as qc
+from scilifelab.bcbio.qc import RunMetricsParser, DirectoryIndex
+from scilifelab.pm.ext.ext_qc import RunMetricsController
+from tests.benchmarks.bench_qc_collect_files import make_flowcell_tree, sample_kw
+
+class App(object):
+    """The parts of the pm application used by _collect_sample_qc"""
+    log = qc.LOG
+
+class Pargs(object):
+    def __init__(self, workers):
+        self.workers = workers
+        self.parse_cache = None
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark collecting sample qc metrics with worker threads")
+    parser.add_argument('-s','--nsamples', type=int, default=96,
+                        help="the number of samples on the flowcell. Default is 96")
+    parser.add_argument('-l','--latency', type=float, default=0.005,
+                        help="the delay of opening a file, in seconds. Default is 0.005")
+    parser.add_argument('-w','--workers', type=int, nargs="+", default=[1, 2, 4, 8],
+                        help="the numbers of workers. Default is 1 2 4 8")
+    args = parser.parse_args()
+    qc.LOG.level = logbook.ERROR
+
+    def slow_open(*a, **kw):
+        time.sleep(args.latency)
+        return open(*a, **kw)
+    qc.open = slow_open
+
+    root = tempfile.mkdtemp(prefix="bench_qc_sample_workers_", dir=os.getcwd())
+    try:
+        fcdir = make_flowcell_tree(root, args.nsamples, nimages=1)
+        for f in glob.glob(os.path.join(fcdir, "alignments", "*_metrics")):
+            os.unlink(f)
+        index = DirectoryIndex(fcdir, ignore=RunMetricsParser.reignore)
+        samples = [(fcdir, index, sample_kw(n), dict(run_setup=None)) for n in xrange(args.nsamples)]
+
+        print "{:<8} {:>8} {:>10}".format("workers","s","samples/s")
+        results = {}
+        for workers in args.workers:
+            ctrl = RunMetricsController()
+            ctrl.app, ctrl.pargs = App(), Pargs(workers)
+            t0 = time.time()
+            objs = ctrl._collect_sample_qc(samples)
+            t = time.time() - t0
+            results[workers] = [dict((k, v) for k, v in obj.items() if k not in ["_id", "creation_time", "modification_time"]) for obj in objs]
+            print "{:<8} {:>8.3f} {:>10.1f}".format(workers, t, args.nsamples / t)
+        assert all([results[w] == results[args.workers[0]] for w in args.workers]), "the workers collected different metrics"
+    finally:
+        del qc.open
+        shutil.rmtree(root)
+
+if __name__ == "__main__":
+    main()
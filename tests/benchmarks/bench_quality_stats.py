@@ -0,0 +1,49 @@
+"""Benchmark per-record and batched read quality statistics.
+
+Computes the average quality and the percentage of bases >= Q30 for a 
+generated set of quality strings with avgQ and gtQ30, one record at a time,
+and with avgQ_batch, gtQ30_batch and quality_stats on blocks of records, 
+checking that the per-read values are identical. Run with:
+
+    python -m tests.benchmarks.bench_quality_stats [-n RECORDS] [-b BATCH]
+"""
+import argparse
+import time
+import scilifelab.utils.fastq_utils as fu
+import tests.generate_test_data as td
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark per-record and batched quality statistics")
+    parser.add_argument('-n','--nrecords', type=int, default=200000,
+                        help="the number of records. Default is 200000")
+    parser.add_argument('-b','--batch-size', dest='batch_size', type=int, default=20000,
+                        help="the number of records in each batch. Default is 20000")
+    args = parser.parse_args()
+    
+    pool = [td.generate_fastq_record(qlow=2, qhigh=41) for n in xrange(1000)]
+    records = [pool[n % len(pool)] for n in xrange(args.nrecords)]
+    qualities = [r[3] for r in records]
+    batches = [qualities[i:i+args.batch_size] for i in xrange(0, len(qualities), args.batch_size)]
+    
+    t0 = time.time()
+    expected = [(fu.avgQ(r), fu.gtQ30(r)) for r in records]
+    t_record = time.time() - t0
+    
+    t0 = time.time()
+    observed = []
+    for batch in batches:
+        observed.extend(zip(fu.avgQ_batch(batch), fu.gtQ30_batch(batch)))
+    t_batch = time.time() - t0
+    assert observed == expected, "Batched statistics differ from the per-record statistics"
+    
+    t0 = time.time()
+    for batch in batches:
+        fu.quality_stats(batch)
+    t_stats = time.time() - t0
+    
+    print "{:<24} {:>8} {:>12}".format("method","s","records/s")
+    for label, t in [("avgQ + gtQ30",t_record),("avgQ_batch + gtQ30_batch",t_batch),("quality_stats",t_stats)]:
+        print "{:<24} {:>8.2f} {:>12.0f}".format(label, t, args.nrecords/t)
+
+if __name__ == "__main__":
+    main()
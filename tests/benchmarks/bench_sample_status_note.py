@@ -0,0 +1,75 @@
+"""Benchmark the database requests of sample_status_note.
+
+Fills a CouchDB stand-in (tests.couchdb_standin) with a project, a 
+flowcell and the sample runs of the project on the flowcell, and makes 
+the sample status note for the flowcell, first with the project and 
+flowcell documents fetched on every lookup, as before Couch.prefetch, and 
+then with the documents prefetched once per report. Reports the time and 
+the number of requests. The notes are written to a temporary directory. 
+Run with:
+
+    python -m tests.benchmarks.bench_sample_status_note [-n SAMPLES]
+"""
+import os
+import argparse
+import shutil
+import tempfile
+import time
+import logbook
+import scilifelab.db
+import scilifelab.report
+import scilifelab.report.delivery_notes
+from scilifelab.db.statusdb import SampleRunMetricsDocument, FlowcellRunMetricsDocument, ProjectSummaryDocument
+from tests.couchdb_standin import CouchDBStandIn
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the requests of sample_status_note")
+    parser.add_argument('-n','--nsamples', type=int, default=96,
+                        help="the number of samples on the flowcell. Default is 96")
+    args = parser.parse_args()
+
+    project_name = "J.Doe_00_01"
+    server = CouchDBStandIn().start()
+    workdir = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    try:
+        fc = FlowcellRunMetricsDocument("120924", "AC003CCCXX")
+        fc["RunInfo"] = {"Instrument": "SN0001", "Reads": [{"IsIndexedRead": "N"}, {"IsIndexedRead": "Y"}, {"IsIndexedRead": "N"}]}
+        fc["RunParameters"] = {"RunMode": "High Output", "RTAVersion": "1.13.48", "ApplicationName": "HiSeq Control Software", "ApplicationVersion": "1.5.15.1"}
+        read = {str(lane): {"ErrRatePhiX": "0.5"} for lane in xrange(1, 9)}
+        read["ReadType"] = ""
+        fc["illumina"] = {"Summary": {"read1": read}, "Demultiplex_Stats": {"Barcode_lane_statistics": []}}
+        server.create("flowcells").save(fc)
+        project = ProjectSummaryDocument(project_name=project_name, source="lims", customer_reference="ref", uppnex_id="b2013000")
+        project["samples"] = {"P001_{}".format(101 + n): {"customer_name": "S{}".format(n), "details": {"reads_min": 10},
+                                                          "library_prep": {"A": {"sample_run_metrics": {}}}} for n in xrange(args.nsamples)}
+        server.create("projects").save(project)
+        db = server.create("samples")
+        for n in xrange(args.nsamples):
+            db.save(SampleRunMetricsDocument(flowcell="AC003CCCXX", date="120924", lane=str(n % 8 + 1), sample_prj=project_name,
+                                             sequence="ACGTAC", barcode_name="P001_{}".format(101 + n),
+                                             project_sample_name="P001_{}".format(101 + n), bc_count=20000000))
+        kw = {'username':'u', 'password':'p', 'url':'127.0.0.1', 'port':server.port}
+        os.chdir(workdir)
+
+        print "{:<12} {:>8} {:>9}".format("documents","s","requests")
+        prefetch = scilifelab.db.Couch.prefetch
+        # The synthetic documents lack many fields, silence the warnings about them
+        scilifelab.report.LOG.level = scilifelab.report.delivery_notes.LOG.level = logbook.ERROR
+        for label in ["per lookup", "prefetched"]:
+            if label == "per lookup":
+                scilifelab.db.Couch.prefetch = lambda self, names: None
+            server.reset_counts()
+            t0 = time.time()
+            try:
+                scilifelab.report.delivery_notes.sample_status_note(project_name=project_name, flowcell="AC003CCCXX", force=True, **kw)
+            finally:
+                scilifelab.db.Couch.prefetch = prefetch
+            print "{:<12} {:>8.3f} {:>9}".format(label, time.time() - t0, sum(server.requests.values()))
+    finally:
+        os.chdir(cwd)
+        server.stop()
+        shutil.rmtree(workdir)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""Benchmark filtering flowcells locally and with keyed view queries.
+
+Fills a CouchDB stand-in (tests.couchdb_standin) with flowcell documents 
+and compares looking up the flowcells with a storage status and the 
+flowcells of a project, by reading the info/storage_status and 
+names/project_ids_list views in full and filtering them, as 
+get_storage_status and samples_to_copy used to, with the keyed queries 
+of info/status_name and names/project_date_name. Reports the time and 
+the bytes transferred per lookup. Run with:
+
+    python -m tests.benchmarks.bench_statusdb_queries [-n FLOWCELLS]
+"""
+import argparse
+import time
+import logbook
+from datetime import date, timedelta
+from scilifelab.db.statusdb import FlowcellRunMetricsConnection, FlowcellRunMetricsDocument
+from tests.couchdb_standin import CouchDBStandIn
+
+def measure(server, fn):
+    server.reset_counts()
+    t0 = time.time()
+    result = fn()
+    return result, time.time() - t0, sum(server.requests.values()), sum(server.bytes_sent.values())
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark keyed flowcell queries")
+    parser.add_argument('-n','--nflowcells', type=int, default=10000,
+                        help="the number of flowcell documents. Default is 10000")
+    args = parser.parse_args()
+
+    server = CouchDBStandIn().start()
+    try:
+        db = server.create("flowcells")
+        start = date(2012, 1, 1)
+        for n in xrange(args.nflowcells):
+            doc = FlowcellRunMetricsDocument((start + timedelta(days=n // 10)).strftime("%y%m%d"), "AC{:05d}XX".format(n))
+            doc["storage_status"] = "swestore_archived" if n < args.nflowcells - 20 else "NAS_nosync"
+            doc["project_ids"] = ["P{}".format(n % 500), "P{}".format((n + 1) % 500)]
+            db.save(doc)
+        for view in server.views["flowcells"]:
+            db.view_rows(view)
+        kw = {'username':'u', 'password':'p', 'url':'127.0.0.1', 'port':server.port}
+        fc_con = FlowcellRunMetricsConnection(dbname="flowcells", **kw)
+        fc_con.log.level = logbook.WARNING
+        open_date = (start + timedelta(days=args.nflowcells // 20)).strftime("%Y-%m-%d")
+
+        def local_status():
+            view = {k.key:k.value for k in fc_con.db.view("info/storage_status")}
+            return sorted([run for run, info in view.iteritems() if info.get("storage_status") == "NAS_nosync"])
+        def local_project():
+            proj_list = {k.key:k.value for k in fc_con.db.view("names/project_ids_list", reduce=False) if k.key}
+            return sorted([fc for fc in proj_list if "P42" in proj_list[fc] and fc.split("_")[0] >= open_date.replace("-", "")[2:]], reverse=True)
+
+        print "{:<16} {:<8} {:>8} {:>9} {:>12}".format("lookup","method","s","requests","bytes")
+        for label, local, keyed in [("storage status", local_status, lambda: sorted(fc_con.get_storage_status("NAS_nosync").keys())),
+                                    ("project", local_project, lambda: fc_con.get_project_flowcells("P42", open_date))]:
+            results = []
+            for method, fn in [("local", local), ("keyed", keyed)]:
+                result, t, requests, nbytes = measure(server, fn)
+                print "{:<16} {:<8} {:>8.3f} {:>9} {:>12}".format(label, method, t, requests, nbytes)
+                results.append(result)
+            assert results[0] == results[1], "Local and keyed {} lookups differ".format(label)
+    finally:
+        server.stop()
+
+if __name__ == "__main__":
+    main()
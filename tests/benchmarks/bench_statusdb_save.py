@@ -0,0 +1,65 @@
+"""Benchmark saving sample run metrics one by one and in bulk.
+
+Fills a CouchDB stand-in (tests.couchdb_standin) with sample run metrics 
+documents and saves a flowcell's worth of regenerated documents, of which 
+a fraction is modified, first with Couch.save, which reads the whole 
+id_to_name view and the stored document for every object, and then with 
+Couch.save_all, which resolves the ids with one keyed view query, fetches 
+the stored documents through _all_docs and writes the modified documents 
+with _bulk_docs. Reports the time and the number of requests and bytes 
+transferred. Run with:
+
+    python -m tests.benchmarks.bench_statusdb_save [-n SAMPLES] [-s SAVE] [-m MODIFIED]
+"""
+import argparse
+import time
+import logbook
+from scilifelab.db.statusdb import SampleRunMetricsConnection, SampleRunMetricsDocument
+from tests.couchdb_standin import CouchDBStandIn
+
+def measure(server, fn):
+    server.reset_counts()
+    t0 = time.time()
+    result = fn()
+    return result, time.time() - t0, sum(server.requests.values()), sum(server.bytes_sent.values())
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark saving statusdb documents one by one and in bulk")
+    parser.add_argument('-n','--nsamples', type=int, default=5000,
+                        help="the number of sample run documents in the database. Default is 5000")
+    parser.add_argument('-s','--nsave', type=int, default=200,
+                        help="the number of documents to save. Default is 200")
+    parser.add_argument('-m','--modified', type=float, default=0.25,
+                        help="the fraction of saved documents that are modified. Default is 0.25")
+    args = parser.parse_args()
+
+    server = CouchDBStandIn().start()
+    try:
+        def sample(n, **kw):
+            return SampleRunMetricsDocument(flowcell="FC{:04d}XX".format(n // 64), date="130101", lane=n % 8 + 1,
+                                            sample_prj="J.Doe_{:03d}".format(n % 50),
+                                            sequence="ACGT{}".format(n), barcode_name="P{}_{}".format(n % 50, n), **kw)
+        db = server.create("samples")
+        for n in xrange(args.nsamples):
+            db.save(sample(n))
+        for view in server.views["samples"]:
+            db.view_rows(view)
+        kw = {'username':'u', 'password':'p', 'url':'127.0.0.1', 'port':server.port}
+        s_con = SampleRunMetricsConnection(dbname="samples", **kw)
+        s_con.log.level = logbook.WARNING
+        nmodified = int(args.nsave * args.modified)
+
+        print "{:<10} {:>8} {:>9} {:>12}".format("method","s","requests","bytes")
+        for i, (label, save) in enumerate([("save", lambda objs: [s_con.save(obj) for obj in objs]),
+                                           ("save_all", s_con.save_all)]):
+            # Modify a different set of documents in each round
+            objs = [sample(n, lane_yield=(i + 1 if n < nmodified else None)) for n in xrange(args.nsave)]
+            _, t, requests, nbytes = measure(server, lambda: save(objs))
+            print "{:<10} {:>8.3f} {:>9} {:>12}".format(label, t, requests, nbytes)
+            assert all(db.docs[s_con.name_view[obj["name"]]].get("lane_yield") == (i + 1 if n < nmodified else None)
+                       for n, obj in enumerate(objs)), "{} did not save the modified documents".format(label)
+    finally:
+        server.stop()
+
+if __name__ == "__main__":
+    main()
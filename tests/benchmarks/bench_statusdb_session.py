@@ -0,0 +1,79 @@
+"""Benchmark connecting to statusdb with and without a shared session.
+
+Opens sample, flowcell and project connections to a CouchDB stand-in 
+(tests.couchdb_standin), as sample_status_note and raw_data do, and 
+fetches a number of documents, first the way Couch used to connect, 
+probing the server with check_url and creating a separate couchdb.Server 
+with its own connection pool for every connection, and then with the 
+session shared per server url. Reports the time, the number of requests 
+and the number of TCP connections opened. Run with:
+
+    python -m tests.benchmarks.bench_statusdb_session [-r ROUNDS] [-n DOCS]
+"""
+import argparse
+import time
+import couchdb
+import scilifelab.db
+from scilifelab.utils.http import check_url
+from scilifelab.db import get_session
+from scilifelab.db.statusdb import SampleRunMetricsConnection, FlowcellRunMetricsConnection, ProjectSummaryConnection, SampleRunMetricsDocument
+from tests.couchdb_standin import CouchDBStandIn
+
+def unshared_connect(self, username=None, password=None, url="localhost", port=5984, **kw):
+    """Couch.connect as it was before the shared session"""
+    if not check_url(self.url_string):
+        return None
+    self.con = couchdb.Server(url=self.url_string)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark shared statusdb sessions")
+    parser.add_argument('-r','--rounds', type=int, default=20,
+                        help="the number of times to connect. Default is 20")
+    parser.add_argument('-n','--ndocs', type=int, default=10,
+                        help="the number of documents to fetch per round. Default is 10")
+    args = parser.parse_args()
+
+    server = CouchDBStandIn().start()
+    opened = [0]
+    process_request = server._server.process_request
+    def count_connections(request, client_address):
+        opened[0] += 1
+        process_request(request, client_address)
+    server._server.process_request = count_connections
+    try:
+        db = server.create("samples")
+        for n in xrange(args.ndocs):
+            db.save(SampleRunMetricsDocument(flowcell="AC003CCCXX", date="130101", lane=1, sample_prj="J.Doe_00_01",
+                                             sequence="ACGT", barcode_name="P1_{}".format(n)))
+        server.create("flowcells")
+        server.create("projects")
+        kw = {'username':'u', 'password':'p', 'url':'127.0.0.1', 'port':server.port}
+
+        def run():
+            for _ in xrange(args.rounds):
+                s_con = SampleRunMetricsConnection(dbname="samples", **kw)
+                FlowcellRunMetricsConnection(dbname="flowcells", **kw)
+                ProjectSummaryConnection(dbname="projects", **kw)
+                for name in sorted(db.docs.values()[i]["name"] for i in xrange(args.ndocs)):
+                    s_con.get_entry(name)
+
+        print "{:<10} {:>8} {:>9} {:>12}".format("session","s","requests","connections")
+        for label in ["unshared", "shared"]:
+            connect = scilifelab.db.Couch.connect
+            if label == "unshared":
+                scilifelab.db.Couch.connect = unshared_connect
+            server.reset_counts()
+            opened[0] = 0
+            t0 = time.time()
+            try:
+                run()
+            finally:
+                scilifelab.db.Couch.connect = connect
+            print "{:<10} {:>8.3f} {:>9} {:>12}".format(label, time.time() - t0, sum(server.requests.values()), opened[0])
+        stats = get_session(server.url).stats()['total']
+        print "shared session: {} requests, mean latency {:.2f}ms".format(stats['requests'], 1000 * stats['mean_latency'])
+    finally:
+        server.stop()
+
+if __name__ == "__main__":
+    main()
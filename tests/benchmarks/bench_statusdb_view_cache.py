@@ -0,0 +1,70 @@
+"""Benchmark connecting to the flowcell database with and without the view cache.
+
+Fills a CouchDB stand-in (tests.couchdb_standin) with flowcell run metrics 
+documents carrying barcode lane statistics, and connects with 
+FlowcellRunMetricsConnection, which reads five views up front: without the 
+cache, with a cold cache, with a warm cache and after a few flowcells were 
+modified. Reports the time and the number of requests and bytes 
+transferred. Run with:
+
+    python -m tests.benchmarks.bench_statusdb_view_cache [-n FLOWCELLS] [-m MODIFIED]
+"""
+import argparse
+import shutil
+import tempfile
+import time
+from scilifelab.db.statusdb import FlowcellRunMetricsConnection, FlowcellRunMetricsDocument
+from tests.couchdb_standin import CouchDBStandIn
+
+def measure(server, fn):
+    server.reset_counts()
+    t0 = time.time()
+    result = fn()
+    return result, time.time() - t0, sum(server.requests.values()), sum(server.bytes_sent.values())
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the statusdb view cache")
+    parser.add_argument('-n','--nflowcells', type=int, default=2000,
+                        help="the number of flowcell documents. Default is 2000")
+    parser.add_argument('-m','--modified', type=int, default=10,
+                        help="the number of flowcells modified between runs. Default is 10")
+    args = parser.parse_args()
+
+    server = CouchDBStandIn().start()
+    cache_dir = tempfile.mkdtemp()
+    try:
+        db = server.create("flowcells")
+        ids = []
+        for n in xrange(args.nflowcells):
+            doc = FlowcellRunMetricsDocument("1{:05d}".format(n), "AC{:04d}CXX".format(n))
+            doc["storage_status"] = "On disk"
+            doc["project_ids"] = ["P{}".format(n % 100)]
+            doc["illumina"] = {"Demultiplex_Stats": {"Barcode_lane_statistics":
+                                                    [{"Lane": str(lane), "Project": "J__Doe_00_{:02d}".format(n % 100), "Sample ID": "P{}_{}".format(n % 100, s),
+                                                      "Mean Quality Score (PF)": "35.5", "% of >= Q30 Bases (PF)": "90.1"}
+                                                     for lane in xrange(1, 9) for s in xrange(4)]}}
+            db.save(doc)
+            ids.append(doc["_id"])
+        for view in server.views["flowcells"]:
+            db.view_rows(view)
+        kw = {'username':'u', 'password':'p', 'url':'127.0.0.1', 'port':server.port}
+
+        print "{:<10} {:>8} {:>9} {:>12}".format("cache","s","requests","bytes")
+        views = {}
+        for label in ["none", "cold", "warm", "modified"]:
+            if label == "modified":
+                for docid in ids[:args.modified]:
+                    db.save(dict(db.docs[docid], storage_status="Archived"))
+            fc_con, t, requests, nbytes = measure(server, lambda: FlowcellRunMetricsConnection(dbname="flowcells", view_cache=(None if label == "none" else cache_dir), **kw))
+            print "{:<10} {:>8.3f} {:>9} {:>12}".format(label, t, requests, nbytes)
+            views[label] = (fc_con.storage_status_view, fc_con.id_view, fc_con.stat_view, fc_con.proj_list)
+        assert views["none"] == views["cold"] == views["warm"], "The cached views differ from the database views"
+        uncached = FlowcellRunMetricsConnection(dbname="flowcells", **kw)
+        assert views["modified"] == (uncached.storage_status_view, uncached.id_view, uncached.stat_view, uncached.proj_list), \
+            "The refreshed views differ from the database views"
+    finally:
+        server.stop()
+        shutil.rmtree(cache_dir)
+
+if __name__ == "__main__":
+    main()
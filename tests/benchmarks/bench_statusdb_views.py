@@ -0,0 +1,74 @@
+"""Benchmark eager and lazy view access in SampleRunMetricsConnection.
+
+Fills a CouchDB stand-in (tests.couchdb_standin) with sample run metrics 
+documents and compares building the four name views into dicts when 
+connecting, and fetching each sample with a separate request, as 
+SampleRunMetricsConnection used to, with the lazy views that query the 
+project view on demand and the bulk fetch through _all_docs. Reports the time and the number of 
+requests and bytes transferred for connecting and for fetching the samples 
+of one project. Run with:
+
+    python -m tests.benchmarks.bench_statusdb_views [-n SAMPLES] [-p PROJECTS]
+"""
+import argparse
+import time
+from scilifelab.db.statusdb import SampleRunMetricsConnection, SampleRunMetricsDocument
+from tests.couchdb_standin import CouchDBStandIn
+
+class EagerSampleRunMetricsConnection(SampleRunMetricsConnection):
+    """SampleRunMetricsConnection as it was before the lazy views"""
+    def __init__(self, dbname="samples", **kwargs):
+        super(EagerSampleRunMetricsConnection, self).__init__(dbname=dbname, **kwargs)
+        self.name_view = {k.key:k.id for k in self.db.view("names/name", reduce=False)}
+        self.name_fc_view = {k.key:k for k in self.db.view("names/name_fc", reduce=False)}
+        self.name_proj_view = {k.key:k for k in self.db.view("names/name_proj", reduce=False)}
+        self.name_fc_proj_view = {k.key:k for k in self.db.view("names/name_fc_proj", reduce=False)}
+
+    def get_sample_ids(self, fc_id=None, sample_prj=None):
+        return [self.name_proj_view[k].id for k in self.name_proj_view.keys() if self.name_proj_view[k].value == sample_prj]
+
+    def get_samples(self, fc_id=None, sample_prj=None):
+        inv_view = {v:k for k,v in self.name_view.iteritems()}
+        return [self.get_entry(inv_view[x]) for x in self.get_sample_ids(fc_id, sample_prj)]
+
+def measure(server, fn):
+    server.reset_counts()
+    t0 = time.time()
+    result = fn()
+    return result, time.time() - t0, sum(server.requests.values()), sum(server.bytes_sent.values())
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark eager and lazy statusdb views")
+    parser.add_argument('-n','--nsamples', type=int, default=20000,
+                        help="the number of sample run documents. Default is 20000")
+    parser.add_argument('-p','--nprojects', type=int, default=200,
+                        help="the number of projects. Default is 200")
+    args = parser.parse_args()
+    
+    server = CouchDBStandIn().start()
+    try:
+        db = server.create("samples")
+        for n in xrange(args.nsamples):
+            db.save(SampleRunMetricsDocument(flowcell="FC{:04d}XX".format(n // 64), date="130101", lane=n % 8 + 1,
+                                             sample_prj="J.Doe_{:03d}".format(n % args.nprojects),
+                                             sequence="ACGT{}".format(n), barcode_name="P{}_{}".format(n % args.nprojects, n)))
+        # Compute the views up front, as the server would have indexed them already
+        for view in server.views["samples"]:
+            db.view_rows(view)
+        kw = {'username':'u', 'password':'p', 'url':'127.0.0.1', 'port':server.port}
+        project = "J.Doe_001"
+        
+        print "{:<8} {:<12} {:>8} {:>9} {:>12}".format("views","step","s","requests","bytes")
+        results = {}
+        for label, cls in [("eager", EagerSampleRunMetricsConnection), ("lazy", SampleRunMetricsConnection)]:
+            s_con, t, requests, nbytes = measure(server, lambda: cls(dbname="samples", **kw))
+            print "{:<8} {:<12} {:>8.3f} {:>9} {:>12}".format(label, "connect", t, requests, nbytes)
+            samples, t, requests, nbytes = measure(server, lambda: s_con.get_samples(sample_prj=project))
+            print "{:<8} {:<12} {:>8.3f} {:>9} {:>12}".format(label, "get_samples", t, requests, nbytes)
+            results[label] = sorted([s["_id"] for s in samples])
+        assert results["eager"] == results["lazy"], "The eager and lazy views returned different samples"
+    finally:
+        server.stop()
+
+if __name__ == "__main__":
+    main()
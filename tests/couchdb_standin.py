@@ -0,0 +1,378 @@
+"""A small in-process stand-in for a CouchDB server.
+
+Implements the parts of the CouchDB HTTP API that the statusdb connections
+and the replication use: databases, documents, views (with key, keys,
+startkey/endkey, include_docs, limit and skip), _all_dbs, _all_docs,
+_bulk_docs (also with new_edits=false), _changes (with since, limit and
+include_docs), _local documents and _security. Views are given as Python
+map functions yielding (key, value) pairs, see VIEWS. The server counts the
+requests and the bytes sent for each path so that tests and benchmarks can
+see how much a piece of code transfers. Usage:
+
+    server = CouchDBStandIn(VIEWS)
+    server.start()
+    couch = couchdb.Server(server.url)
+    ...
+    server.stop()
+"""
+import re
+import json
+import socket
+import threading
+import urlparse
+import collections
+from uuid import uuid4
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+def _sample_name(doc):
+    return doc.get("name") is not None and not re.search("_[0-9]+$", doc["name"])
+
+def _content_hash(doc):
+    if doc.get("content_hash") and doc.get("content_hash_rev") == int(doc["_rev"].split("-")[0]):
+        return [(doc["_id"], doc["content_hash"])]
+    return []
+
+def _project_date_name(doc):
+    return [([pid, doc["name"].split("_")[0]], doc["name"]) for pid in doc.get("project_ids") or []]
+
+# Python versions of the views in scilifelab.db.statusdb.VIEWS and of those
+# the connections expect to be present on the server
+VIEWS = {'samples' : {'names/name' : lambda doc: [(doc["name"], None)] if _sample_name(doc) else [],
+                      'names/name_fc' : lambda doc: [(doc["name"], doc.get("flowcell"))] if _sample_name(doc) else [],
+                      'names/name_proj' : lambda doc: [(doc["name"], doc.get("sample_prj"))] if _sample_name(doc) else [],
+                      'names/name_fc_proj' : lambda doc: [(doc["name"], [doc.get("flowcell"), doc.get("sample_prj")])] if _sample_name(doc) else [],
+                      'names/fc_name' : lambda doc: [(doc.get("flowcell"), doc["name"])] if _sample_name(doc) else [],
+                      'names/proj_name' : lambda doc: [(doc.get("sample_prj"), doc["name"])] if _sample_name(doc) else [],
+                      'names/id_to_name' : lambda doc: [(doc["_id"], doc.get("name"))],
+                      'names/name_to_id' : lambda doc: [(doc.get("name"), doc["_id"])],
+                      'names/id_to_proj' : lambda doc: [(doc["_id"], [doc.get("sample_prj"), doc.get("name"), doc.get("barcode_name")])],
+                      'names/proj_to_id' : lambda doc: [(doc.get("sample_prj"), [doc.get("sample_prj"), doc.get("name"), doc.get("barcode_name")])]},
+         'flowcells' : {'names/name' : lambda doc: [(doc.get("name"), None)],
+                        'names/id_to_name' : lambda doc: [(doc["_id"], doc.get("name"))],
+                        'names/fcid_to_id' : lambda doc: [((doc["name"].split("_") + [None])[1], doc["_id"])] if doc.get("name") else [],
+                        'names/Barcode_lane_stat' : lambda doc: [(doc.get("name"), doc.get("illumina", {}).get("Demultiplex_Stats", {}).get("Barcode_lane_statistics"))],
+                        'names/project_ids_list' : lambda doc: [(doc.get("name"), doc.get("project_ids", []))],
+                        'info/id' : lambda doc: [(doc.get("name"), doc["_id"])],
+                        'info/storage_status' : lambda doc: [(doc.get("name"), {"storage_status": doc.get("storage_status"), "_id": doc["_id"]})],
+                        'info/status_name' : lambda doc: [(doc.get("storage_status"), doc.get("name"))],
+                        'names/project_date_name' : _project_date_name,
+                        'names/content_hash' : _content_hash},
+         'x_flowcells' : {'info/name' : lambda doc: [(doc.get("name"), None)],
+                          'names/project_ids_list' : lambda doc: [(doc.get("name"), doc.get("project_ids", []))],
+                          'names/project_date_name' : _project_date_name},
+         'projects' : {'project/project_id' : lambda doc: [(doc.get("project_id"), doc["_id"])],
+                       'project/project_name' : lambda doc: [(doc.get("project_name"), doc["_id"])],
+                       'names/id_to_name' : lambda doc: [(doc["_id"], doc.get("project_name"))],
+                       'names/name' : lambda doc: [(doc.get("project_name"), None)],
+                       'names/content_hash' : _content_hash},
+         }
+
+class _Database(object):
+    def __init__(self, views):
+        self.docs = {}
+        self.deleted = {}
+        self.local = {}
+        self.security = {}
+        self.views = views
+        self.update_seq = 0
+        self.changes = collections.OrderedDict()
+        self._view_rows = {}
+        # Like a validate_doc_update function: returns the reason for
+        # rejecting a document written with _bulk_docs, or None
+        self.validate = None
+
+    def save(self, doc):
+        """Save, or delete if _deleted is set, a document, returning the
+        new revision or None on a conflict
+        """
+        doc = dict(doc)
+        doc.setdefault("_id", uuid4().hex)
+        old = self.docs.get(doc["_id"])
+        if old is not None and old["_rev"] != doc.get("_rev"):
+            return None
+        if old is None and doc.get("_rev") is not None:
+            return None
+        old = old or self.deleted.get(doc["_id"])
+        n = int(old["_rev"].split("-")[0]) + 1 if old else 1
+        doc["_rev"] = "{}-{}".format(n, uuid4().hex)
+        self._store(doc)
+        return doc["_rev"]
+
+    def replicate(self, doc):
+        """Store a document with its revision, as _bulk_docs with new_edits=false
+        """
+        self._store(dict(doc))
+
+    def _store(self, doc):
+        if doc.get("_deleted"):
+            self.docs.pop(doc["_id"], None)
+            self.deleted[doc["_id"]] = {"_id": doc["_id"], "_rev": doc["_rev"], "_deleted": True}
+        else:
+            self.deleted.pop(doc["_id"], None)
+            self.docs[doc["_id"]] = doc
+        self.update_seq += 1
+        self.changes.pop(doc["_id"], None)
+        self.changes[doc["_id"]] = self.update_seq
+
+    def view_rows(self, name):
+        """Return the sorted rows of a view, computed once per update sequence
+        """
+        if self._view_rows.get(name, (None,))[0] != self.update_seq:
+            self._view_rows[name] = (self.update_seq, self._map(name))
+        return self._view_rows[name][1]
+
+    def _map(self, name):
+        rows = []
+        for doc in self.docs.itervalues():
+            for key, value in self.views[name](doc):
+                rows.append({"id": doc["_id"], "key": key, "value": value})
+        rows.sort(key=lambda r: (r["key"], r["id"]))
+        return rows
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Send headers and body in one write, small separate writes are delayed on keep-alive connections
+    wbufsize = -1
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self._dispatch("HEAD")
+
+    def do_GET(self):
+        self._dispatch("GET")
+
+    def do_POST(self):
+        self._dispatch("POST")
+
+    def do_PUT(self):
+        self._dispatch("PUT")
+
+    def do_DELETE(self):
+        self._dispatch("DELETE")
+
+    def _respond(self, status, data, body=True):
+        content = json.dumps(data)
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        if body:
+            self.wfile.write(content)
+        self.server.standin._count(self.path, len(content))
+
+    def _dispatch(self, method):
+        standin = self.server.standin
+        url = urlparse.urlparse(self.path)
+        query = {k: json.loads(v[0]) if k in ["key", "keys", "startkey", "endkey", "include_docs", "limit", "skip", "descending"] else v[0]
+                 for k, v in urlparse.parse_qs(url.query).items()}
+        body = None
+        length = int(self.headers.get("Content-Length", 0) or 0)
+        if length:
+            body = json.loads(self.rfile.read(length))
+        parts = [urlparse.unquote(p) for p in url.path.strip("/").split("/") if p]
+        with standin.lock:
+            status, data = standin.handle(method, parts, query, body)
+        self._respond(status, data, body=method != "HEAD")
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, *args):
+        HTTPServer.__init__(self, *args)
+        self.connections = {}
+        self.closing = False
+
+    def process_request(self, request, client_address):
+        t = threading.Thread(target=self.process_request_thread, args=(request, client_address))
+        t.daemon = True
+        self.connections[request] = t
+        t.start()
+
+    def shutdown_request(self, request):
+        self.connections.pop(request, None)
+        HTTPServer.shutdown_request(self, request)
+
+    def handle_error(self, request, client_address):
+        if not self.closing:
+            HTTPServer.handle_error(self, request, client_address)
+
+    def close_connections(self):
+        """Close the open keep-alive connections and wait for their threads to finish"""
+        self.closing = True
+        for request, t in self.connections.items():
+            try:
+                request.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            t.join(1)
+
+class CouchDBStandIn(object):
+    """An in-process CouchDB stand-in listening on a free local port. views
+    maps database names to dicts of view name -> map function, databases
+    are matched to them by name, ignoring any '-test' suffix"""
+
+    def __init__(self, views=VIEWS):
+        self.views = views
+        self.databases = {}
+        self.lock = threading.Lock()
+        self.requests = collections.Counter()
+        self.bytes_sent = collections.Counter()
+        self._server = _Server(("127.0.0.1", 0), _Handler)
+        self._server.standin = self
+        self.port = self._server.server_address[1]
+        self.url = "http://127.0.0.1:{}".format(self.port)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.close_connections()
+        self._server.server_close()
+
+    def create(self, dbname):
+        self.databases[dbname] = _Database(self.views.get(dbname.replace("-test", ""), {}))
+        return self.databases[dbname]
+
+    def reset_counts(self):
+        self.requests.clear()
+        self.bytes_sent.clear()
+
+    def _count(self, path, nbytes):
+        path = urlparse.urlparse(path).path
+        self.requests[path] += 1
+        self.bytes_sent[path] += nbytes
+
+    def handle(self, method, parts, query, body):
+        if not parts:
+            return 200, {"couchdb": "Welcome", "version": "1.6.1"}
+        if parts == ["_all_dbs"]:
+            return 200, sorted(self.databases)
+        db = self.databases.get(parts[0])
+        if len(parts) == 1 and method == "PUT":
+            if db is not None:
+                return 412, {"error": "file_exists", "reason": "The database could not be created, the file already exists."}
+            self.create(parts[0])
+            return 201, {"ok": True}
+        if db is None:
+            return 404, {"error": "not_found", "reason": "no_db_file"}
+        if len(parts) == 1:
+            if method == "POST":
+                return self._save(db, body)
+            if method == "DELETE":
+                del self.databases[parts[0]]
+                return 200, {"ok": True}
+            return 200, {"db_name": parts[0], "doc_count": len(db.docs), "update_seq": db.update_seq}
+        if parts[1] == "_security":
+            if method == "PUT":
+                db.security = body
+                return 200, {"ok": True}
+            return 200, db.security
+        if parts[1] == "_local":
+            docid = "/".join(parts[1:])
+            if method == "PUT":
+                old = db.local.get(docid)
+                if old is not None and old["_rev"] != body.get("_rev"):
+                    return 409, {"error": "conflict", "reason": "Document update conflict."}
+                body.update(_id=docid, _rev="0-{}".format(int(old["_rev"].split("-")[1]) + 1 if old else 1))
+                db.local[docid] = body
+                return 201, {"ok": True, "id": docid, "rev": body["_rev"]}
+            if docid not in db.local:
+                return 404, {"error": "not_found", "reason": "missing"}
+            return 200, db.local[docid]
+        if parts[1] == "_design" and len(parts) == 5 and parts[3] == "_view":
+            name = "{}/{}".format(parts[2], parts[4])
+            if name not in db.views:
+                return 404, {"error": "not_found", "reason": "missing_named_view"}
+            return 200, self._query(db, db.view_rows(name), query, body)
+        if parts[1] == "_all_docs":
+            keys = (body or {}).get("keys", query.get("keys"))
+            ids = sorted(db.docs) if keys is None else [k for k in keys if k in db.docs]
+            rows = [{"id": i, "key": i, "value": {"rev": db.docs[i]["_rev"]}} for i in ids]
+            return 200, self._query(db, rows, query, body, all_docs=True)
+        if parts[1] == "_bulk_docs":
+            if body.get("new_edits") is False:
+                # Only the rejected documents are reported, as by CouchDB
+                results = []
+                for doc in body["docs"]:
+                    reason = db.validate(doc) if db.validate else None
+                    if reason:
+                        results.append({"id": doc.get("_id"), "error": "forbidden", "reason": reason})
+                    else:
+                        db.replicate(doc)
+                return 201, results
+            results = []
+            for doc in body["docs"]:
+                reason = db.validate(doc) if db.validate else None
+                if reason:
+                    results.append({"id": doc.get("_id"), "error": "forbidden", "reason": reason})
+                    continue
+                rev = db.save(doc)
+                if rev is None:
+                    results.append({"id": doc.get("_id"), "error": "conflict", "reason": "Document update conflict."})
+                else:
+                    results.append({"id": db.changes.keys()[-1], "rev": rev})
+            return 201, results
+        if parts[1] == "_changes":
+            since = int(query.get("since", 0))
+            results = []
+            for i, seq in db.changes.iteritems():
+                if seq > since:
+                    doc = db.docs.get(i) or db.deleted[i]
+                    results.append({"seq": seq, "id": i, "changes": [{"rev": doc["_rev"]}]})
+                    if i in db.deleted:
+                        results[-1]["deleted"] = True
+            if "limit" in query:
+                results = results[:query["limit"]]
+            if query.get("include_docs"):
+                for r in results:
+                    r["doc"] = db.docs.get(r["id"]) or db.deleted[r["id"]]
+            return 200, {"results": results, "last_seq": results[-1]["seq"] if results else db.update_seq}
+        docid = "/".join(parts[1:])
+        if method == "PUT":
+            body["_id"] = docid
+            return self._save(db, body)
+        if method == "DELETE":
+            return self._save(db, {"_id": docid, "_rev": query.get("rev"), "_deleted": True})
+        if docid not in db.docs:
+            return 404, {"error": "not_found", "reason": "missing"}
+        return 200, db.docs[docid]
+
+    def _save(self, db, doc):
+        rev = db.save(doc)
+        if rev is None:
+            return 409, {"error": "conflict", "reason": "Document update conflict."}
+        return 201, {"ok": True, "id": db.changes.keys()[-1], "rev": rev}
+
+    def _query(self, db, rows, query, body, all_docs=False):
+        keys = (body or {}).get("keys", query.get("keys"))
+        if keys is not None:
+            index = collections.defaultdict(list)
+            for r in rows:
+                index[json.dumps(r["key"])].append(r)
+            selected = []
+            for k in keys:
+                if all_docs and json.dumps(k) not in index:
+                    selected.append({"key": k, "error": "not_found"})
+                selected.extend(index.get(json.dumps(k), []))
+            rows = selected
+        else:
+            if "key" in query:
+                rows = [r for r in rows if r["key"] == query["key"]]
+            if "startkey" in query:
+                rows = [r for r in rows if r["key"] >= query["startkey"]]
+            if "endkey" in query:
+                rows = [r for r in rows if r["key"] <= query["endkey"]]
+        total = len(rows)
+        rows = rows[query.get("skip", 0):]
+        if "limit" in query:
+            rows = rows[:query["limit"]]
+        if query.get("include_docs"):
+            rows = [dict(r, doc=db.docs.get(r["id"])) if "id" in r else r for r in rows]
+        return {"total_rows": total, "offset": query.get("skip", 0), "rows": rows}
@@ -0,0 +1,299 @@
+"""Tests for the statusdb connections against a CouchDB stand-in"""
+import os
+import shutil
+import tempfile
+import unittest
+import logbook
+from scilifelab.db import get_session
+from scilifelab.db.statusdb import SampleRunMetricsConnection, FlowcellRunMetricsConnection, ProjectSummaryConnection, SampleRunMetricsDocument, FlowcellRunMetricsDocument
+
+from ..couchdb_standin import CouchDBStandIn, VIEWS
+
+LOG = logbook.Logger(__name__)
+
+flowcells = ["120924_AC003CCCXX", "121015_BB002BBBXX"]
+projects = ["J.Doe_00_01", "J.Doe_00_02", "J.Doe_00_03"]
+
+def sample_docs():
+    """Generate sample run metrics documents for each project, flowcell and lane"""
+    docs = []
+    for i, prj in enumerate(projects):
+        for fc in flowcells:
+            date, fcid = fc.split("_")
+            for lane in [1, 2]:
+                docs.append(SampleRunMetricsDocument(flowcell=fcid, date=date, lane=lane, sample_prj=prj,
+                                                     sequence="ACGTA{}".format(i),
+                                                     barcode_name="P00{}_10{}".format(i, lane)))
+    return docs
+
+class TestSampleRunMetricsConnection(unittest.TestCase):
+    def setUp(self):
+        self.server = CouchDBStandIn().start()
+        db = self.server.create("samples-test")
+        self.docs = sample_docs()
+        for doc in self.docs:
+            db.save(doc)
+        self.kw = {'username':'u', 'password':'p', 'url':'127.0.0.1', 'port':self.server.port}
+
+    def tearDown(self):
+        self.server.stop()
+
+    def _names(self, docs):
+        return sorted([d["name"] for d in docs])
+
+    def test_get_samples(self):
+        """Retrieve the samples of a project and/or flowcell"""
+        s_con = SampleRunMetricsConnection(dbname="samples-test", **self.kw)
+        self.assertListEqual(self._names([d for d in self.docs if d["sample_prj"] == projects[0]]),
+                             self._names(s_con.get_samples(sample_prj=projects[0])))
+        self.assertListEqual(self._names([d for d in self.docs if d["flowcell"] == "BB002BBBXX"]),
+                             self._names(s_con.get_samples(fc_id="BB002BBBXX")))
+        self.assertListEqual(self._names([d for d in self.docs if d["flowcell"] == "BB002BBBXX" and d["sample_prj"] == projects[1]]),
+                             self._names(s_con.get_samples(fc_id="BB002BBBXX", sample_prj=projects[1])))
+        self.assertListEqual([], s_con.get_samples(fc_id="BB002BBBXX", sample_prj="J.Doe_00_04"))
+
+    def test_lazy_views(self):
+        """Only query the views for the requested keys"""
+        self.server.reset_counts()
+        s_con = SampleRunMetricsConnection(dbname="samples-test", **self.kw)
+        self.assertEqual(0, sum([n for path, n in self.server.requests.items() if "_view" in path]),
+                         "Views were queried when connecting")
+        s_con.get_samples(sample_prj=projects[0])
+        self.assertEqual(["/samples-test/_design/names/_view/proj_name"],
+                         [path for path in self.server.requests if "_view" in path])
+        name = self.docs[0]["name"]
+        self.assertEqual(self.docs[0]["_id"], s_con.get_entry(name)["_id"])
+        self.assertEqual(self.docs[0]["_id"], s_con.get_entry(name)["_id"])
+        self.assertEqual(1, self.server.requests["/samples-test/_design/names/_view/name"],
+                         "A cached view row was queried again")
+        self.assertIsNone(s_con.get_entry("no_such_sample"))
+        self.assertEqual(sorted([d["name"] for d in self.docs]), sorted(s_con.name_view.keys()))
+
+    def test_get_entries(self):
+        """Fetch documents in batches, in the order requested"""
+        s_con = SampleRunMetricsConnection(dbname="samples-test", batch_size=5, **self.kw)
+        ids = [d["_id"] for d in reversed(self.docs)]
+        ids.insert(3, "no_such_id")
+        self.server.reset_counts()
+        docs = s_con.get_entries(ids)
+        self.assertEqual([None if i == "no_such_id" else i for i in ids], [d["_id"] if d else None for d in docs])
+        self.assertEqual(3, sum(self.server.requests.values()), "Documents were not fetched in batches")
+
+        self.server.reset_counts()
+        samples = s_con.get_samples(sample_prj=projects[0], batch_size=100)
+        self.assertEqual(s_con.get_sample_ids(sample_prj=projects[0]), [s["_id"] for s in samples])
+        self.assertEqual(1, self.server.requests["/samples-test/_all_docs"], "Samples were not fetched in one request")
+
+    def test_missing_view(self):
+        """Fall back to the views keyed on sample name if the server lacks the project and flowcell views"""
+        views = dict(VIEWS)
+        views['samples'] = {k:v for k, v in VIEWS['samples'].items() if k not in ["names/fc_name", "names/proj_name"]}
+        self.server.views = views
+        db = self.server.create("samples-test")
+        for doc in self.docs:
+            db.save(doc)
+        s_con = SampleRunMetricsConnection(dbname="samples-test", **self.kw)
+        self.assertListEqual(self._names([d for d in self.docs if d["sample_prj"] == projects[2]]),
+                             self._names(s_con.get_samples(sample_prj=projects[2])))
+
+    def test_save_all(self):
+        """Save new and modified samples in bulk, leaving unchanged samples alone"""
+        s_con = SampleRunMetricsConnection(dbname="samples-test", **self.kw)
+        docs = sample_docs()
+        docs[0]["sequence"] = "TTTTTT"
+        new = SampleRunMetricsDocument(flowcell="AC003CCCXX", date="120924", lane=3, sample_prj=projects[0],
+                                       sequence="ACGTAC", barcode_name="P000_103")
+        self.server.reset_counts()
+        self.assertEqual(2, s_con.save_all(docs + [new]))
+        self.assertEqual(1, self.server.requests["/samples-test/_bulk_docs"])
+        self.assertEqual(1, self.server.requests["/samples-test/_design/names/_view/name_to_id"])
+        db = self.server.databases["samples-test"]
+        self.assertEqual(len(self.docs) + 1, len(db.docs))
+        saved = db.docs[self.docs[0]["_id"]]
+        self.assertEqual("TTTTTT", saved["sequence"])
+        self.assertTrue(saved["_rev"].startswith("2-"))
+        self.assertEqual(self.docs[0]["creation_time"], saved["creation_time"])
+        self.assertIsNotNone(saved["modification_time"])
+        self.assertTrue(all(d["_rev"].startswith("1-") for i, d in db.docs.iteritems() if i != self.docs[0]["_id"]))
+        self.assertEqual(0, s_con.save_all(sample_docs()[1:] + [new]))
+
+    def test_save_all_missing_view(self):
+        """Look up the ids of the saved samples by name if the server lacks the names/name_to_id view"""
+        views = dict(VIEWS)
+        views['samples'] = {k:v for k, v in VIEWS['samples'].items() if k != "names/name_to_id"}
+        self.server.views = views
+        db = self.server.create("samples-test")
+        for doc in self.docs:
+            db.save(doc)
+        s_con = SampleRunMetricsConnection(dbname="samples-test", **self.kw)
+        docs = sample_docs()
+        docs[0]["sequence"] = "TTTTTT"
+        self.assertEqual(1, s_con.save_all(docs))
+        self.assertEqual(len(self.docs), len(db.docs))
+        self.assertEqual("TTTTTT", db.docs[self.docs[0]["_id"]]["sequence"])
+
+    def test_save_all_conflict(self):
+        """Compare and save again samples updated concurrently"""
+        s_con = SampleRunMetricsConnection(dbname="samples-test", **self.kw)
+        db = self.server.databases["samples-test"]
+        bulk_update_fn = s_con._bulk_update_fn
+        def concurrent_update_fn(db_, objs, **kwargs):
+            updated = bulk_update_fn(db_, objs, **kwargs)
+            if concurrent_update_fn.first:
+                concurrent_update_fn.first = False
+                doc = dict(db.docs[self.docs[0]["_id"]], lane_yield=100)
+                db.save(doc)
+            return updated
+        concurrent_update_fn.first = True
+        s_con._bulk_update_fn = concurrent_update_fn
+        docs = sample_docs()
+        docs[0]["sequence"] = "TTTTTT"
+        self.server.reset_counts()
+        self.assertEqual(1, s_con.save_all(docs))
+        self.assertEqual(2, self.server.requests["/samples-test/_bulk_docs"])
+        saved = db.docs[self.docs[0]["_id"]]
+        self.assertEqual("TTTTTT", saved["sequence"])
+        self.assertEqual(100, saved["lane_yield"])
+        self.assertTrue(saved["_rev"].startswith("3-"))
+
+def flowcell_docs():
+    """Generate flowcell run metrics documents"""
+    docs = []
+    for i in xrange(10):
+        doc = FlowcellRunMetricsDocument("1301{:02d}".format(i + 1), "AC{:03d}CCCXX".format(i))
+        doc["storage_status"] = "On disk"
+        doc["project_ids"] = [projects[i % len(projects)]]
+        docs.append(doc)
+    return docs
+
+class TestFlowcellRunMetricsConnection(unittest.TestCase):
+    def setUp(self):
+        self.server = CouchDBStandIn().start()
+        self.db = self.server.create("flowcells-test")
+        self.docs = flowcell_docs()
+        for doc in self.docs:
+            self.db.save(doc)
+        self.cache_dir = tempfile.mkdtemp()
+        self.kw = {'username':'u', 'password':'p', 'url':'127.0.0.1', 'port':self.server.port, 'view_cache':self.cache_dir}
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.cache_dir)
+
+    def _view_requests(self):
+        return sum([n for path, n in self.server.requests.items() if path.startswith("/flowcells-test/")])
+
+    def _views(self, fc_con):
+        return (fc_con.storage_status_view, fc_con.id_view, fc_con.stat_view, fc_con.proj_list)
+
+    def test_view_cache(self):
+        """Read the flowcell views from the cache, refreshing them with the changes since the last run"""
+        fc_con = FlowcellRunMetricsConnection(dbname="flowcells-test", **self.kw)
+        uncached = FlowcellRunMetricsConnection(dbname="flowcells-test", **dict(self.kw, view_cache=None))
+        self.assertEqual(self._views(uncached), self._views(fc_con))
+        self.assertTrue(os.path.exists(os.path.join(self.cache_dir, "127.0.0.1_{}".format(self.server.port), "flowcells-test.pickle")))
+
+        self.server.reset_counts()
+        fc_con = FlowcellRunMetricsConnection(dbname="flowcells-test", **self.kw)
+        self.assertEqual(1, self._view_requests(), "Warm start made more than one request for the views")
+        self.assertEqual(1, self.server.requests["/flowcells-test/_changes"])
+        self.assertEqual(self._views(uncached), self._views(fc_con))
+
+        # Modify, rename and add flowcells
+        doc = dict(self.db.docs[self.docs[0]["_id"]], storage_status="Archived")
+        self.db.save(doc)
+        doc = dict(self.db.docs[self.docs[1]["_id"]], name="130102_AC999CCCXX")
+        self.db.save(doc)
+        new = FlowcellRunMetricsDocument("130111", "AC011CCCXX")
+        self.db.save(new)
+        self.server.reset_counts()
+        fc_con = FlowcellRunMetricsConnection(dbname="flowcells-test", **self.kw)
+        self.assertEqual(5, self._view_requests())
+        uncached = FlowcellRunMetricsConnection(dbname="flowcells-test", **dict(self.kw, view_cache=None))
+        self.assertEqual(self._views(uncached), self._views(fc_con))
+        self.assertEqual("Archived", fc_con.storage_status_view[self.docs[0]["name"]]["storage_status"])
+        self.assertNotIn(self.docs[1]["name"], fc_con.id_view)
+        self.assertIn(new["name"], fc_con.id_view)
+
+    def test_view_cache_max_changes(self):
+        """Fetch the views in full when many documents changed"""
+        fc_con = FlowcellRunMetricsConnection(dbname="flowcells-test", **self.kw)
+        for doc in self.docs:
+            self.db.save(dict(self.db.docs[doc["_id"]], storage_status="Archived"))
+        self.server.reset_counts()
+        views = fc_con.get_view_cache(max_changes=5)
+        self.assertEqual(["Archived"] * len(self.docs), [row.value["storage_status"] for row in views.view("info/storage_status")])
+        self.assertEqual(1, self.server.requests["/flowcells-test/_design/info/_view/storage_status"])
+        self.assertEqual(1, self.server.requests["/flowcells-test"])
+
+    def test_get_storage_status(self):
+        """Get the flowcells with a storage status, with and without the info/status_name view"""
+        self.db.save(dict(self.db.docs[self.docs[2]["_id"]], storage_status="Archived"))
+        views = dict(VIEWS)
+        views['flowcells'] = {k:v for k, v in VIEWS['flowcells'].items() if k != "info/status_name"}
+        for db_views in [VIEWS['flowcells'], views['flowcells']]:
+            self.db.views = db_views
+            fc_con = FlowcellRunMetricsConnection(dbname="flowcells-test", **self.kw)
+            self.server.reset_counts()
+            self.assertEqual({self.docs[2]["name"]: {"storage_status": "Archived", "_id": self.docs[2]["_id"]}},
+                             fc_con.get_storage_status("Archived"))
+            self.assertEqual(sorted([doc["name"] for doc in self.docs if doc is not self.docs[2]]),
+                             sorted(fc_con.get_storage_status("On disk").keys()))
+            self.assertEqual({}, fc_con.get_storage_status("swestore_archived"))
+            self.assertEqual(3, self.server.requests["/flowcells-test/_design/info/_view/status_name"])
+
+    def test_get_project_flowcells(self):
+        """Get the flowcells of a project opened at a date, with and without the names/project_date_name view"""
+        views = dict(VIEWS)
+        views['flowcells'] = {k:v for k, v in VIEWS['flowcells'].items() if k != "names/project_date_name"}
+        for db_views in [VIEWS['flowcells'], views['flowcells']]:
+            self.db.views = db_views
+            fc_con = FlowcellRunMetricsConnection(dbname="flowcells-test", **self.kw)
+            self.assertEqual(["130110_AC009CCCXX", "130107_AC006CCCXX", "130104_AC003CCCXX", "130101_AC000CCCXX"],
+                             fc_con.get_project_flowcells(projects[0]))
+            self.assertEqual(["130110_AC009CCCXX", "130107_AC006CCCXX"], fc_con.get_project_flowcells(projects[0], "2013-01-07"))
+            self.assertEqual([], fc_con.get_project_flowcells(projects[0], "2013-01-11"))
+            self.assertEqual([], fc_con.get_project_flowcells("J.Doe_00_04"))
+
+    def test_prefetch(self):
+        """Serve prefetched flowcell documents from memory"""
+        fc_con = FlowcellRunMetricsConnection(dbname="flowcells-test", **self.kw)
+        names = [doc["name"] for doc in self.docs[:5]]
+        self.server.reset_counts()
+        fc_con.prefetch(names + names + ["no_such_flowcell"])
+        self.assertEqual(2, self._view_requests(), "Names were not resolved and documents fetched in bulk")
+        self.server.reset_counts()
+        for name in names:
+            self.assertEqual(name, fc_con.get_entry(name)["name"])
+            self.assertTrue(fc_con.is_paired_end(name) is not None)
+            self.assertEqual(-1, fc_con.get_phix_error_rate(name, "1"))
+        self.assertIsNone(fc_con.get_entry("no_such_flowcell"))
+        self.assertEqual(0, self._view_requests())
+        self.assertEqual(self.docs[5]["name"], fc_con.get_entry(self.docs[5]["name"])["name"])
+
+class TestSession(unittest.TestCase):
+    def setUp(self):
+        self.server = CouchDBStandIn().start()
+        self.server.create("samples-test")
+        self.server.create("flowcells-test")
+        self.server.create("projects-test")
+        self.kw = {'username':'u', 'password':'p', 'url':'127.0.0.1', 'port':self.server.port}
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_shared_session(self):
+        """Connections to the same server share a session and probe the server once"""
+        self.server.reset_counts()
+        s_con = SampleRunMetricsConnection(dbname="samples-test", **self.kw)
+        fc_con = FlowcellRunMetricsConnection(dbname="flowcells-test", **self.kw)
+        p_con = ProjectSummaryConnection(dbname="projects-test", **self.kw)
+        session = get_session(self.server.url)
+        self.assertIs(session, s_con.con.resource.session)
+        self.assertIs(session, fc_con.con.resource.session)
+        self.assertIs(session, p_con.con.resource.session)
+        self.assertEqual(1, self.server.requests["/"])
+        self.assertEqual(1, len(self.server._server.connections), "Connections were not kept alive and reused")
+        stats = session.stats()
+        self.assertGreaterEqual(stats['total']['requests'], sum(self.server.requests.values()))
+        self.assertGreater(stats['total']['latency'], 0)
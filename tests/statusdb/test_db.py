@@ -1,8 +1,9 @@
 import os
 import unittest
+import collections
 import ConfigParser
 import logbook
-from scilifelab.db.statusdb import  _match_barcode_name_to_project_sample
+from scilifelab.db.statusdb import  _match_barcode_name_to_project_sample, ProjectSampleMatcher
 
 from ..classes import has_couchdb_installation
 
@@ -75,4 +76,21 @@ class TestStatusdbFunctions(unittest.TestCase):
         res = _match_barcode_name_to_project_sample(bc, self.project_samples, True, force=True)
         self.assertEqual(None, res)
 
-
+    def test_project_sample_matcher(self):
+        """Test that the indexed matcher maps barcode names as _match_barcode_name_to_project_sample"""
+        generated = collections.OrderedDict()
+        for name in ["P123_101", "P123_101B", "P123_102F", "P123_103FF", "P123_1", "P123_10", "P124_101",
+                     "101", "10", "103", "SAMPLE_6", "E", "B", ""]:
+            generated[name] = {'customer_name':"{}_index1".format(name.split("_")[-1])}
+        barcodes = set()
+        for project_samples in [self.project_samples, generated]:
+            for name in project_samples.keys() + ["P001_1", "P005_5", "P123_104", "X_101"]:
+                for suffix in ["", "_index1", "_index12", "B", "F", "C", "BB", "B_index3", "F_index4", "_2", "1", "_L001"]:
+                    barcodes.update([name + suffix, "P123_" + name + suffix, "P1_" + name + suffix, "P001_P001_" + name + suffix])
+        for project_samples in [self.project_samples, generated, {}]:
+            matcher = ProjectSampleMatcher(project_samples)
+            for bc in sorted(barcodes):
+                for extensive_matching in [False, True]:
+                    self.assertEqual(_match_barcode_name_to_project_sample(bc, project_samples, extensive_matching, force=True),
+                                     matcher.match(bc, extensive_matching, force=True),
+                                     "barcode name {} matched differently".format(bc))
@@ -0,0 +1,106 @@
+"""Tests for copying databases between two CouchDB stand-ins"""
+import unittest
+import logbook
+import couchdb
+from scilifelab.db.replication import DatabaseReplicator
+
+from ..couchdb_standin import CouchDBStandIn
+
+class _Interrupted(Exception):
+    pass
+
+class InterruptedReplicator(DatabaseReplicator):
+    """Replicator that fails after copying <ndocs> documents"""
+    def __init__(self, ndocs, *args, **kwargs):
+        super(InterruptedReplicator, self).__init__(*args, **kwargs)
+        self.ndocs = ndocs
+
+    def _full_doc(self, s_db, doc):
+        if self.ndocs == 0:
+            raise _Interrupted("interrupted")
+        self.ndocs -= 1
+        return doc
+
+class TestDatabaseReplicator(unittest.TestCase):
+    def setUp(self):
+        self.source = CouchDBStandIn().start()
+        self.destination = CouchDBStandIn().start()
+        for name in ["db1", "db2", "db3"]:
+            db = self.source.create(name)
+            for i in range(25):
+                db.save({"_id": "{}_{:02d}".format(name, i), "value": i})
+            db.security = {"members": {"names": [], "roles": [name]}}
+            self.destination.create(name)
+        self.kw = {'batch_size': 10, 'workers': 3}
+
+    def tearDown(self):
+        self.source.stop()
+        self.destination.stop()
+
+    def _replicator(self, cls=DatabaseReplicator, *args):
+        rep = cls(*(args + (self.source.url, self.destination.url)), **self.kw)
+        rep.log.level = logbook.WARNING
+        return rep
+
+    def _assert_copied(self, name):
+        s_db = self.source.databases[name]
+        d_db = self.destination.databases[name]
+        self.assertDictEqual(s_db.docs, d_db.docs)
+        self.assertDictEqual(s_db.deleted, d_db.deleted)
+
+    def test_copy(self):
+        """Copy documents with their revisions, deletions and security object"""
+        s_db = self.source.databases["db1"]
+        s_db.save(dict(s_db.docs["db1_00"], value="updated"))
+        s_db.save(dict(s_db.docs["db1_01"], _deleted=True))
+        stats = self._replicator().copy("db1")
+        self._assert_copied("db1")
+        self.assertEqual(24, len(self.destination.databases["db1"].docs))
+        self.assertEqual(25, stats["docs"])
+        self.assertDictEqual(s_db.security, self.destination.databases["db1"].security)
+        self.assertEqual(0, self._replicator().copy("db1")["docs"])
+
+    def test_resume(self):
+        """Resume an interrupted copy from its checkpoint"""
+        self.assertRaises(_Interrupted, self._replicator(InterruptedReplicator, 15).copy, "db1")
+        self.assertEqual(10, len(self.destination.databases["db1"].docs))
+        rep = self._replicator()
+        self.assertEqual(10, rep.checkpoint("db1"))
+        self.assertEqual(15, rep.copy("db1")["docs"])
+        self._assert_copied("db1")
+        s_db = self.source.databases["db1"]
+        s_db.save({"_id": "new", "value": 0})
+        s_db.save(dict(s_db.docs["db1_02"], _deleted=True))
+        self.assertEqual(2, rep.copy("db1")["docs"])
+        self._assert_copied("db1")
+
+    def test_copy_all(self):
+        """Copy several databases concurrently, reporting failures per database"""
+        del self.destination.databases["db3"]
+        stats = self._replicator().copy_all(["db1", "db2", "db3"])
+        self.assertListEqual(["db1", "db2", "db3"], [x["db"] for x in stats])
+        self.assertListEqual([25, 25, 0], [x["docs"] for x in stats])
+        self.assertIn("error", stats[2])
+        self._assert_copied("db1")
+        self._assert_copied("db2")
+
+    def test_rejected_documents(self):
+        """Stop before the checkpoint when the destination rejects documents"""
+        d_db = self.destination.databases["db1"]
+        d_db.validate = lambda doc: "rejected" if doc["_id"] == "db1_12" else None
+        rep = self._replicator()
+        with self.assertRaises(couchdb.ServerError) as ctx:
+            rep.copy("db1")
+        self.assertIn("db1_12 (rejected)", str(ctx.exception))
+        self.assertEqual(10, rep.checkpoint("db1"))
+        d_db.validate = None
+        self.assertEqual(15, rep.copy("db1")["docs"])
+        self._assert_copied("db1")
+
+    def test_conflicts(self):
+        """Copy the winning revision of documents in conflict and count them"""
+        s_db = self.source.databases["db1"]
+        s_db.replicate(dict(s_db.docs["db1_03"], _conflicts=["1-abc"]))
+        stats = self._replicator().copy("db1")
+        self.assertEqual(1, stats["conflicts"])
+        self.assertNotIn("_conflicts", self.destination.databases["db1"].docs["db1_03"])
@@ -0,0 +1,167 @@
+"""Tests for saving project summaries with the statusDB_utils functions"""
+import copy
+import unittest
+import couchdb
+from scilifelab.db.statusDB_utils import save_couchdb_obj, save_couchdb_objs, find_proj_from_view, find_samp_from_view, \
+    find_flowcell_from_view, content_hash
+
+from ..couchdb_standin import CouchDBStandIn, VIEWS
+
+def project_objs(n):
+    """Generate project summary objects as from LIMS"""
+    return [{'_id': "id{:03d}".format(i), 'entity_type': 'project_summary', 'project_name': "J.Doe_00_{:02d}".format(i),
+             'samples': {"P{}_101".format(i): {'status': "doc_not_found", 'm_reads_sequenced': 10.0}}}
+            for i in range(n)]
+
+class TestSaveCouchdbObjs(unittest.TestCase):
+    def setUp(self):
+        self.server = CouchDBStandIn().start()
+        self.db = self.server.create("projects")
+        self.proj_db = couchdb.Server(self.server.url)["projects"]
+
+    def tearDown(self):
+        self.server.stop()
+
+    def _doc_requests(self):
+        """Number of documents and view rows read from the server"""
+        return sum([n for path, n in self.server.requests.items() if "_all_docs" in path])
+
+    def test_content_hash(self):
+        """Ids, revisions and time stamps do not change the content hash"""
+        obj = project_objs(1)[0]
+        h = content_hash(obj)
+        self.assertEqual(h, content_hash(dict(obj, _rev="1-a", creation_time="x", modification_time="y", content_hash=h)))
+        self.assertNotEqual(h, content_hash(dict(obj, project_name="J.Doe_00_99")))
+
+    def test_save_couchdb_objs(self):
+        """Only fetch and write the objects whose content changed"""
+        objs = project_objs(20)
+        self.assertListEqual(['created'] * 20, save_couchdb_objs(self.proj_db, copy.deepcopy(objs), batch_size=8))
+        self.assertEqual(20, len(self.db.docs))
+        creation_time = self.db.docs["id000"]["creation_time"]
+        seq = self.db.update_seq
+
+        self.server.reset_counts()
+        self.assertListEqual(['not uppdated'] * 20, save_couchdb_objs(self.proj_db, copy.deepcopy(objs), batch_size=8))
+        self.assertEqual(seq, self.db.update_seq)
+        self.assertEqual(0, self._doc_requests())
+        self.assertEqual(3, sum(self.server.requests.values()))
+
+        objs[3]['samples']["P3_101"]['m_reads_sequenced'] = 12.0
+        info = save_couchdb_objs(self.proj_db, copy.deepcopy(objs), batch_size=8)
+        self.assertListEqual(['uppdated'], [x for x in info if x != 'not uppdated'])
+        self.assertEqual(seq + 1, self.db.update_seq)
+        self.assertEqual(12.0, self.db.docs["id003"]['samples']["P3_101"]['m_reads_sequenced'])
+        self.assertEqual(creation_time, self.db.docs["id000"]["creation_time"])
+
+    def test_keep_stored_status(self):
+        """Statuses not found when generating a project summary are kept"""
+        obj = project_objs(1)[0]
+        save_couchdb_obj(self.proj_db, copy.deepcopy(obj))
+        doc = self.db.docs["id000"]
+        doc['samples']["P0_101"]['status'] = "Sequenced"
+        self.db.save(doc)
+        obj['samples']["P0_101"]['m_reads_sequenced'] = 12.0
+        self.assertEqual('uppdated', save_couchdb_obj(self.proj_db, copy.deepcopy(obj)))
+        self.assertDictEqual({'status': "Sequenced", 'm_reads_sequenced': 12.0}, self.db.docs["id000"]['samples']["P0_101"])
+
+    def test_without_hashes(self):
+        """Documents stored without a content hash are compared in full"""
+        obj = project_objs(1)[0]
+        self.db.save(dict(obj, creation_time="2014-01-01T00:00:00Z"))
+        self.assertEqual('uppdated', save_couchdb_obj(self.proj_db, copy.deepcopy(obj)))
+        self.assertEqual("2014-01-01T00:00:00Z", self.db.docs["id000"]["creation_time"])
+        self.assertEqual(content_hash(obj), self.db.docs["id000"]["content_hash"])
+        self.assertEqual('not uppdated', save_couchdb_obj(self.proj_db, copy.deepcopy(obj)))
+
+    def test_other_writers(self):
+        """Documents changed by other writers are compared in full"""
+        obj = project_objs(1)[0]
+        save_couchdb_obj(self.proj_db, copy.deepcopy(obj))
+        self.db.save(dict(self.db.docs["id000"], project_name="J.Doe_00_99"))
+        self.assertEqual('uppdated', save_couchdb_obj(self.proj_db, copy.deepcopy(obj)))
+        self.assertEqual("J.Doe_00_00", self.db.docs["id000"]['project_name'])
+        self.assertEqual('not uppdated', save_couchdb_obj(self.proj_db, copy.deepcopy(obj)))
+        # A write that keeps the content leaves nothing to update
+        self.db.save(self.db.docs["id000"])
+        seq = self.db.update_seq
+        self.assertEqual('not uppdated', save_couchdb_obj(self.proj_db, copy.deepcopy(obj)))
+        self.assertEqual(seq, self.db.update_seq)
+
+    def test_retry_conflicts(self):
+        """Objects whose write conflicts are saved again"""
+        objs = project_objs(3)
+        save_couchdb_objs(self.proj_db, copy.deepcopy(objs))
+        for obj in objs:
+            obj['samples'].values()[0]['m_reads_sequenced'] = 12.0
+        # Another client updates a document between the read and the write
+        update = self.proj_db.update
+        def concurrent_update(docs, **kw):
+            self.proj_db.update = update
+            self.db.save(dict(self.db.docs["id001"], project_name="J.Doe_00_99"))
+            return update(docs, **kw)
+        self.proj_db.update = concurrent_update
+        self.server.reset_counts()
+        self.assertListEqual(['uppdated'] * 3, save_couchdb_objs(self.proj_db, copy.deepcopy(objs)))
+        self.assertEqual(2, sum([n for path, n in self.server.requests.items() if "_bulk_docs" in path]))
+        self.assertEqual("J.Doe_00_01", self.db.docs["id001"]['project_name'])
+        self.assertEqual(12.0, self.db.docs["id001"]['samples']["P1_101"]['m_reads_sequenced'])
+
+    def test_raise_other_errors(self):
+        """Writes rejected for other reasons than a conflict are not retried"""
+        self.db.validate = lambda doc: "Project names may not end in 01" if doc.get('project_name', "").endswith("01") else None
+        with self.assertRaises(couchdb.ServerError) as ctx:
+            save_couchdb_objs(self.proj_db, project_objs(3))
+        self.assertIn("may not end in 01", str(ctx.exception))
+        self.assertEqual(1, sum([n for path, n in self.server.requests.items() if "_bulk_docs" in path]))
+        self.assertListEqual(["id000", "id002"], sorted(self.db.docs.keys()))
+
+    def test_find_proj_from_view(self):
+        save_couchdb_objs(self.proj_db, project_objs(5))
+        self.assertEqual("id003", find_proj_from_view(self.proj_db, "J.Doe_00_03"))
+        self.assertIsNone(find_proj_from_view(self.proj_db, "J.Doe_00_05"))
+
+class TestFindFromView(unittest.TestCase):
+    def setUp(self):
+        self.server = CouchDBStandIn().start()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def _create(self, dbname, docs, without=None):
+        """Create the database dbname with docs, without the view without"""
+        views = dict(VIEWS)
+        views[dbname] = {k:v for k, v in VIEWS[dbname].items() if k != without}
+        self.server.views = views
+        db = self.server.create(dbname)
+        for doc in docs:
+            db.save(doc)
+        self.server.reset_counts()
+        return couchdb.Server(self.server.url)[dbname]
+
+    def _view_requests(self, view):
+        return sum([n for path, n in self.server.requests.items() if view in path])
+
+    def test_find_samp_from_view(self):
+        """Samples are looked up by project name, also in lower case"""
+        docs = [{'_id': "s{}".format(i), 'sample_prj': prj, 'name': "P1_10{}_index1".format(i), 'barcode_name': "index1"}
+                for i, prj in enumerate(["J.Doe_00_01", "j.doe_00_01", "J.Doe_00_02"])]
+        expected = {"s0": ["P1_100_index1", "index1"], "s1": ["P1_101_index1", "index1"]}
+        samp_db = self._create("samples", docs)
+        self.assertDictEqual(expected, find_samp_from_view(samp_db, "J.Doe_00_01"))
+        self.assertDictEqual({}, find_samp_from_view(samp_db, "J.Doe_00_03"))
+        self.assertEqual(0, self._view_requests("id_to_proj"))
+        samp_db = self._create("samples", docs, without="names/proj_to_id")
+        self.assertDictEqual(expected, find_samp_from_view(samp_db, "J.Doe_00_01"))
+        self.assertEqual(1, self._view_requests("id_to_proj"))
+
+    def test_find_flowcell_from_view(self):
+        """Flowcells are looked up by position and flowcell id"""
+        docs = [{'_id': "fc{}".format(i), 'name': name} for i, name in enumerate(["120924_AC003CCCXX", "120925_BB002ABCXX"])]
+        fc_db = self._create("flowcells", docs)
+        self.assertEqual("fc1", find_flowcell_from_view(fc_db, "BB002ABCXX"))
+        self.assertIsNone(find_flowcell_from_view(fc_db, "AB002ABCXX"))
+        self.assertEqual(0, self._view_requests("id_to_name"))
+        fc_db = self._create("flowcells", docs, without="names/fcid_to_id")
+        self.assertEqual("fc1", find_flowcell_from_view(fc_db, "BB002ABCXX"))
+        self.assertEqual(1, self._view_requests("id_to_name"))
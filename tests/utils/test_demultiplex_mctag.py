@@ -0,0 +1,114 @@
+"""Tests for scripts/demultiplex_mctag.py"""
+import collections
+import imp
+import os
+import random
+import shutil
+import tempfile
+import unittest
+import tests.generate_test_data as td
+
+mctag = imp.load_source("demultiplex_mctag", os.path.join(os.path.dirname(__file__),
+                                                          os.pardir, os.pardir, "scripts", "demultiplex_mctag.py"))
+
+def find_dist_resolve(read_ind_seq, indexes, max_mismatches):
+    """Resolve a read by comparing it to every index with find_dist, as
+    parse_readset_byindexdict did before IndexResolver
+    """
+    matches_dict = collections.defaultdict(list)
+    for supplied_index in sorted(indexes, key=lambda x: (-len(x))):
+        mismatches = mctag.find_dist(supplied_index, read_ind_seq, max_mismatches)
+        matches_dict[mismatches].append(supplied_index)
+        if mismatches == 0:
+            break
+    for x in range(0, max_mismatches+1):
+        if matches_dict.get(x):
+            return matches_dict[x], x
+    return [], None
+
+class TestIndexResolver(unittest.TestCase):
+    def setUp(self):
+        self.indexes = ["ACGTACGT", "ACGTACGA", "TTTTGGGG", "CCAACC"]
+
+    def _check(self, read, expected, max_mismatches=1):
+        resolver = mctag.IndexResolver(self.indexes, max_mismatches)
+        self.assertEqual(find_dist_resolve(read, self.indexes, max_mismatches), expected,
+                         "The reference did not give the expected result for {}".format(read))
+        self.assertEqual(expected, resolver.resolve(read),
+                         "IndexResolver and find_dist disagree for {}".format(read))
+
+    def test_exact_match(self):
+        """Reads starting with an index match it without mismatches"""
+        self._check("TTTTGGGGAACCTT", (["TTTTGGGG"], 0))
+        self._check("ACGTACGAGGGG", (["ACGTACGA"], 0))
+        # The longer index is preferred when a shorter one matches too
+        self.indexes.append("ACGTAC")
+        self._check("ACGTACGTAAAA", (["ACGTACGT"], 0))
+        self._check("ACGTACCCAAAA", (["ACGTAC"], 0))
+
+    def test_one_mismatch(self):
+        """Reads with one mismatch are corrected to the closest index"""
+        self._check("TTTAGGGGAACCTT", (["TTTTGGGG"], 1))
+        self._check("CCAGCCTTTTTTTT", (["CCAACC"], 1))
+        self._check("TTTNGGGGAACCTT", (["TTTTGGGG"], 1))
+        self._check("TTTAGGGCAACCTT", ([], None))
+        self._check("TTTAGGGCAACCTT", (["TTTTGGGG"], 2), max_mismatches=2)
+
+    def test_ambiguous(self):
+        """Reads equally close to several indexes match all of them"""
+        self._check("ACGTACGCTTTT", (["ACGTACGT", "ACGTACGA"], 1))
+        self._check("ACGTACGCTTTT", (["ACGTACGT", "ACGTACGA"], 1), max_mismatches=3)
+        resolver = mctag.IndexResolver(self.indexes, 1)
+        self.assertListEqual(["ACGTACGA", "ACGTACGT"], sorted(resolver.collisions["ACGTACGC"]))
+
+    def test_no_match(self):
+        """Reads too far from every index, or too short, do not match"""
+        self._check("GGGGGGGGGGGG", ([], None))
+        self._check("GGGGGGGGGGGG", ([], None), max_mismatches=0)
+        self._check("TTTAGGGGAACCTT", ([], None), max_mismatches=0)
+        self._check("GGGG", ([], None))
+
+    def test_random_reads(self):
+        """IndexResolver gives the same results as find_dist for random reads"""
+        indexes = list(set([td.generate_barcode(8) for n in xrange(24)] + [td.generate_barcode(6) for n in xrange(4)]))
+        for max_mismatches in [0, 1, 2, 3]:
+            resolver = mctag.IndexResolver(indexes, max_mismatches, cache_size=10)
+            for n in xrange(500):
+                read = list(random.choice(indexes) + td.generate_barcode(6))
+                for pos in random.sample(xrange(len(read)), random.randint(0, 3)):
+                    read[pos] = random.choice("ACGTN.")
+                read = "".join(read)[:random.choice([5, 10, 14])]
+                self.assertEqual(find_dist_resolve(read, indexes, max_mismatches), resolver.resolve(read),
+                                 "IndexResolver and find_dist disagree for {} with {} mismatches".format(read, max_mismatches))
+
+class TestOutputHandleManager(unittest.TestCase):
+    def setUp(self):
+        self.outdir = tempfile.mkdtemp(prefix="test_demultiplex_mctag_")
+
+    def tearDown(self):
+        shutil.rmtree(self.outdir)
+
+    def test_evicted_handles(self):
+        """Files closed to open others are reopened in append mode without losing records"""
+        manager = mctag.OutputHandleManager(max_open=2, buffer_size=200)
+        samples = ["Sample_{}".format(n) for n in xrange(5)]
+        expected = collections.defaultdict(list)
+        for n in xrange(1000):
+            sample = random.choice(samples)
+            record = td.generate_fastq_record(lane=1, index="ACGTAC", pair=True)
+            reads = [record[0:4], record[4:8]]
+            for r, read in enumerate(reads):
+                expected["{}_R{}.fastq".format(sample, r+1)].append("\n".join(read))
+            mctag.data_write_loop(reads[0], reads[1], sample, self.outdir, manager)
+            self.assertTrue(len(manager._handles) <= 2, "More files than max_open were open")
+            self.assertTrue(all([fh.mode == "ab" for fh in manager._handles.values()]),
+                            "Files were not opened in append mode")
+        manager.close()
+        metrics = manager.metrics()
+        self.assertEqual(10, metrics["outputs"])
+        self.assertTrue(metrics["reopens"] > 0, "No files were closed and reopened")
+        self.assertListEqual(sorted(expected.keys()), sorted(os.listdir(self.outdir)))
+        for fname, records in expected.items():
+            with open(os.path.join(self.outdir, fname)) as fh:
+                self.assertEqual("\n".join(records) + "\n", fh.read(),
+                                 "The records written to {} were not all kept in order".format(fname))
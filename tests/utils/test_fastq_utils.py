@@ -3,15 +3,45 @@
 
 import tempfile
 import os
+import sys
+import threading
 import shutil
 import random
 import unittest
 import copy
+import numpy as np
 import scilifelab.utils.fastq_utils as fu
 import tests.generate_test_data as td
 import scilifelab.illumina.hiseq as hi
 from collections import Counter
 
+def call_with_timeout(fn, timeout=30):
+    """Call fn in a separate thread and return its result or the exception
+    it raised, or None if it did not return within timeout seconds
+    """
+    result = []
+    def target():
+        try:
+            result.append(fn())
+        except Exception as e:
+            result.append(e)
+    thread = threading.Thread(target=target)
+    thread.daemon = True
+    thread.start()
+    thread.join(timeout)
+    return result[0] if result else None
+
+class FailingFile:
+    """A file that returns one block and then fails"""
+    def __init__(self):
+        self._blocks = ["@header\n"]
+    def read(self, size=-1):
+        if self._blocks:
+            return self._blocks.pop()
+        raise IOError("the disk is on fire")
+    def close(self):
+        pass
+
 class TestFastQParser(unittest.TestCase):
     """Test the FastQParser functionality
     """
@@ -70,7 +100,130 @@ class TestFastQParser(unittest.TestCase):
             pass
         self.assertEqual(expected,fqr.rread(),
                          "The returned number of filtered reads based on lanes did not match expected number")
-        
+
+    def test_block_boundaries(self):
+        """Parse records split across block boundaries
+        """
+
+        expected = [r for r in fu.FastQParser(self.example_fq)]
+        self.assertEqual(sum([sum(ixc.values()) for ixc in self.example_counts.values()]),
+                         len(expected),
+                         "The number of parsed records did not match expected number")
+
+        # Use block sizes that will split headers, sequences and line endings
+        for block_size in [7, 37, 1000]:
+            fqr = fu.FastQParser(self.example_fq, block_size=block_size)
+            self.assertListEqual(expected,[r for r in fqr],
+                                 "Parsing with block size {} did not give the expected records".format(block_size))
+            self.assertEqual(len(expected),fqr.rread(),
+                             "The number of records read with block size {} did not match expected".format(block_size))
+
+        # Write an uncompressed file without a trailing newline and parse it
+        fqfile = os.path.join(self.rootdir,"no_newline.fastq")
+        with open(fqfile,"w") as fh:
+            fh.write("\n".join(["\n".join(r) for r in expected[0:10]]))
+        self.assertListEqual(expected[0:10],[r for r in fu.FastQParser(fqfile, block_size=100)],
+                             "Parsing a file without trailing newline did not give the expected records")
+
+    def test_strip_lines(self):
+        """Strip leading and trailing whitespace from each line, as when reading line by line
+        """
+
+        expected = [r for r in fu.FastQParser(self.example_fq)][0:10]
+        fqfile = os.path.join(self.rootdir,"whitespace.fastq")
+        with open(fqfile,"w") as fh:
+            for r in expected:
+                fh.write("{} \r\n\t{}\t\n+ \n {}\n".format(*[r[0],r[1],r[3]]))
+        with open(fqfile) as fh:
+            lines = [l.strip() for l in fh]
+        self.assertListEqual([lines[i:i+4] for i in xrange(0, len(lines), 4)],
+                             [r for r in fu.FastQParser(fqfile, block_size=13)],
+                             "Parsing lines with surrounding whitespace did not give the stripped records")
+        self.assertListEqual([[r[0],r[1],"+",r[3]] for r in expected],
+                             [r for r in fu.FastQParser(fqfile, block_size=4096)],
+                             "Parsing lines with surrounding whitespace did not give the expected records")
+        with open(fqfile,"w") as fh:
+            fh.write("\n".join(["\n".join(r) for r in expected[0:2]]) + " \r\n\t")
+        self.assertListEqual(expected[0:2],[r for r in fu.FastQParser(fqfile, block_size=100)],
+                             "Parsing a file ending in whitespace did not give the expected records")
+
+    def test_batches(self):
+        """Iterate over batches of records
+        """
+
+        expected = [r for r in fu.FastQParser(self.example_fq)]
+        fqr = fu.FastQParser(self.example_fq, block_size=4096)
+        observed = []
+        for batch in fqr.batches():
+            self.assertEqual(len(batch.headers),len(batch.qualities),
+                             "The columns of a batch have different lengths")
+            observed.extend([r for r in batch])
+        self.assertListEqual(expected,observed,
+                             "Records from batches did not match the expected records")
+        self.assertEqual(len(expected),fqr.rread(),
+                         "The number of records read in batches did not match expected")
+
+        # Filtering should be applied to batches as well
+        fltr = {'lane': [1,2]}
+        expected = [r for r in fu.FastQParser(self.example_fq,filter=fltr)]
+        observed = []
+        for batch in fu.FastQParser(self.example_fq,filter=fltr,block_size=4096).batches():
+            observed.extend([r for r in batch])
+        self.assertListEqual(expected,observed,
+                             "Filtered records from batches did not match the expected records")
+
+    def test_decompress_backends(self):
+        """Parse records using the different decompression backends
+        """
+
+        expected = [r for r in fu.FastQParser(self.example_fq)]
+        for decompress in ["thread", "process"]:
+            fqr = fu.FastQParser(self.example_fq, block_size=4096, decompress=decompress)
+            self.assertListEqual(expected,[r for r in fqr],
+                                 "Parsing with the {} backend did not give the expected records".format(decompress))
+            # Rewinding should restart the decompression
+            fqr.seek(0)
+            self.assertListEqual(expected,[r for r in fqr],
+                                 "Parsing with the {} backend after seek did not give the expected records".format(decompress))
+            fqr.close()
+
+        # Use gzip as an external decompressor, in case pigz or igzip are not available
+        decompressors = fu.DECOMPRESSORS
+        try:
+            fu.DECOMPRESSORS = ["gzip"]
+            fqr = fu.FastQParser(self.example_fq, decompress="process")
+            self.assertListEqual(expected,[r for r in fqr],
+                                 "Parsing with an external decompressor did not give the expected records")
+        finally:
+            fu.DECOMPRESSORS = decompressors
+
+        # Closing a parser before it is exhausted should stop the background reader
+        fqr = fu.FastQParser(self.example_fq, block_size=64, decompress="thread")
+        fqr.next()
+        fqr.close()
+        self.assertRaises(ValueError, fu.FastQParser, self.example_fq, decompress="unknown")
+
+    def test_reader_errors(self):
+        """Errors in the background readers are raised and do not block
+        """
+
+        # Every read after the background thread failed raises its error
+        reader = fu.ThreadedReader(FailingFile, block_size=8)
+        for n in xrange(3):
+            error = call_with_timeout(lambda: reader.read(100))
+            self.assertIsInstance(error, IOError, "Read {} did not raise the error of the background thread".format(n + 1))
+            self.assertIn("the disk is on fire", str(error))
+        reader.close()
+
+        # A command writing more to its standard error than fits in a pipe does not block
+        cmd = [sys.executable, "-c", "import sys; sys.stderr.write('x' * 500000 + 'failed'); sys.stdout.write('data'); sys.exit(1)"]
+        reader = fu.ProcessReader(cmd)
+        self.assertEqual("data", call_with_timeout(lambda: reader.read(4)))
+        error = call_with_timeout(lambda: reader.read(4))
+        self.assertIsInstance(error, IOError, "A failed command did not raise an IOError")
+        self.assertTrue(str(error).endswith("failed"), "The error did not include the standard error of the command")
+        reader.close()
+
 class TestFastQWriter(unittest.TestCase):
     """Test the FastQWriter functionality
     """
@@ -84,7 +237,51 @@ class TestFastQWriter(unittest.TestCase):
     def test_write_fastq(self):
         """Write a fastq file
         """
-        
+
+    def test_writer_pool(self):
+        """Write fastq files through a writer pool
+        """
+
+        records = {}
+        pool = fu.FastQWriterPool(workers=2, block_size=1000, max_pending=2)
+        writers = []
+        for n in xrange(5):
+            fname = os.path.join(self.rootdir,"pool_{}.fastq{}".format(n,".gz" if n > 0 else ""))
+            writers.append(pool.writer(fname))
+            records[fname] = [td.generate_fastq_record() for i in xrange(random.randint(10,50))]
+        # Interleave the writes to the different outputs
+        for i in xrange(50):
+            for w in writers:
+                if i < len(records[w.name()]):
+                    w.write(records[w.name()][i])
+        empty = pool.writer(os.path.join(self.rootdir,"pool_empty.fastq.gz"))
+        pool.close()
+
+        for w in writers:
+            self.assertEqual(len(records[w.name()]),w.rwritten(),
+                             "The number of written records did not match the expected")
+            self.assertListEqual(records[w.name()],[r for r in fu.FastQParser(w.name())],
+                                 "The records parsed from {} did not match the written records".format(w.name()))
+        self.assertListEqual([],[r for r in fu.FastQParser(empty.name())],
+                             "An empty output did not parse as an empty gzip file")
+
+    def test_write_batch(self):
+        """Write batches of records
+        """
+        fqfile = os.path.join(self.rootdir,"batch.fastq.gz")
+        records = [td.generate_fastq_record() for i in xrange(100)]
+        batch = fu.FastQBatch(*[list(column) for column in zip(*records)])
+        pool = fu.FastQWriterPool(workers=1, block_size=5000)
+        for fqw in [fu.FastQWriter(fqfile), pool.writer(fqfile.replace("batch","pooled_batch"))]:
+            fqw.write_batch(batch.slice(0,50))
+            fqw.write_batch(batch.slice(50,100))
+            fqw.close()
+            self.assertEqual(100,fqw.rwritten(),
+                             "The number of records written in batches did not match the expected")
+            self.assertListEqual(records,[r for r in fu.FastQParser(fqw.name())],
+                                 "The records written in batches did not match the expected")
+        pool.close()
+
 
 class TestFastQUtils(unittest.TestCase):
     
@@ -189,7 +386,191 @@ class TestFastQUtils(unittest.TestCase):
                              "The number of demultiplexed reads in file does not match expected")
             self.assertListEqual(sorted(headers),sorted(self.indexes[index]),
                                  "The parsed headers from demultiplexed fastq file do not match the expected")
-            
+
+    def test_demultiplex_fastq_workers(self):
+        """Demultiplex a test fastq file in small blocks with worker processes and compression threads
+        """
+
+        results = []
+        for workers, compress_workers in [(1, 1), (2, 2)]:
+            outdir = tempfile.mkdtemp(dir=self.rootdir)
+            dmx = fu.FastQDemultiplexer(outdir, self.samplesheet, workers=workers, block_size=2048, compress_workers=compress_workers)
+            outfiles = dmx.run(self.fastq_1, self.fastq_2)
+            records = {}
+            for index, files in outfiles["1"].items():
+                records[index] = [[r for r in fu.FastQParser(f)] for f in files]
+                self.assertEqual(2*len(self.indexes[index]),dmx.counts["1"][index],
+                                 "The number of demultiplexed records did not match the expected")
+                self.assertListEqual(self.indexes[index],[r[0] for r in records[index][0]],
+                                     "The demultiplexed records were not written in input order")
+            results.append(records)
+        self.assertDictEqual(results[0],results[1],
+                             "Demultiplexing with worker processes did not give the same output")
+
+        # The counts for the non-matching samplesheet entry should be zero
+        self.assertEqual([0],dmx.counts["2"].values(),
+                         "Non-matching samplesheet entries did not get zero counts")
+
+    def test_header_lane_index(self):
+        """Extract the lane and index from a header
+        """
+        header = td.generate_fastq_header(lane=3, index="ACGTAC")
+        parsed = fu.parse_header(header)
+        self.assertEqual((str(parsed['lane']), parsed['index']),fu.header_lane_index(header),
+                         "The lane and index did not match those from parse_header")
+
+    def test_quality_stats(self):
+        """Compute quality statistics for a batch of records
+        """
+        records = [td.generate_fastq_record(sequence_length=random.randint(1,120)) for n in xrange(500)]
+        qualities = [r[3] for r in records]
+
+        # The batched averages should be identical to the per-record ones
+        self.assertListEqual([fu.avgQ(r) for r in records],list(fu.avgQ_batch(qualities)),
+                             "Batched average qualities did not match avgQ")
+        self.assertListEqual([fu.gtQ30(r) for r in records],list(fu.gtQ30_batch(qualities)),
+                             "Batched percentages >= Q30 did not match gtQ30")
+
+        stats = fu.quality_stats(qualities)
+        self.assertListEqual(list(fu.avgQ_batch(qualities)),list(stats['avgQ']),
+                             "The average qualities from quality_stats did not match avgQ_batch")
+        histogram = Counter([ord(c)-33 for q in qualities for c in q])
+        self.assertListEqual([histogram[n] for n in xrange(len(stats['histogram']))],list(stats['histogram']),
+                             "The quality histogram did not match the expected")
+        for cycle in [0, 50, 119]:
+            values = [ord(q[cycle])-33 for q in qualities if len(q) > cycle]
+            self.assertAlmostEqual(float(sum(values))/len(values),stats['cycle_mean'][cycle],
+                                   msg="The average quality in cycle {} did not match the expected".format(cycle))
+
+        # Rounding should follow the built-in round
+        values = [0.05, 0.15, 0.25, 2.675, 30.45, 30.5, -0.5]
+        self.assertListEqual([round(v,1) for v in values],list(fu.round_array(np.array(values),1)),
+                             "round_array did not round as the built-in round")
+
+    def test_fastq_profiler(self):
+        """Profile a fastq file with FastQProfiler
+        """
+        fd, fqfile = tempfile.mkstemp(suffix=".fastq.gz", dir=self.rootdir)
+        os.close(fd)
+        records = [td.generate_fastq_record(sequence_length=random.choice([50,75,76])) for n in xrange(500)]
+        fqw = fu.FastQWriter(fqfile)
+        for r in records:
+            fqw.write(r)
+        fqw.close()
+
+        stats = fu.profile_fastq(fqfile)['stats']
+        basic = dict(zip(stats["Basic Statistics"]["Measure"],stats["Basic Statistics"]["Value"]))
+        self.assertEqual("500",basic["Total Sequences"],"The total number of sequences was not correct")
+        self.assertEqual("50-76",basic["Sequence length"],"The sequence length range was not correct")
+
+        lengths = Counter([len(r[1]) for r in records])
+        self.assertListEqual([float(lengths[n]) for n in xrange(50,77)],
+                             [float(c) for c in stats["Sequence Length Distribution"]["Count"]],
+                             "The sequence length distribution was not correct")
+        averages = Counter([sum([ord(c)-33 for c in r[3]])//len(r[3]) for r in records])
+        self.assertDictEqual(dict(averages),
+                             {int(q): float(c) for q, c in zip(stats["Per sequence quality scores"]["Quality"],
+                                                               stats["Per sequence quality scores"]["Count"]) if float(c) > 0},
+                             "The per sequence quality scores were not correct")
+        for cycle in [0, 75]:
+            values = sorted([ord(r[3][cycle])-33 for r in records if len(r[3]) > cycle])
+            self.assertAlmostEqual(float(sum(values))/len(values),float(stats["Per base sequence quality"]["Mean"][cycle]),
+                                   msg="The mean quality in cycle {} was not correct".format(cycle+1))
+            bases = Counter([r[1][cycle] for r in records if len(r[1]) > cycle])
+            self.assertAlmostEqual(100.0*bases["G"]/sum([bases[b] for b in "GATC"]),
+                                   float(stats["Per base sequence content"]["G"][cycle]),
+                                   msg="The G content in cycle {} was not correct".format(cycle+1))
+
+        # A subsample should be reproducible and respect max_reads
+        subsample = fu.profile_fastq(fqfile, fraction=0.2, seed=1)['stats']
+        self.assertDictEqual(subsample, fu.FastQProfiler(fraction=0.2, seed=1).profile(fqfile, block_size=1000),
+                             "The same subsample was not drawn with a different block size")
+        total = int(subsample["Basic Statistics"]["Value"][3])
+        self.assertTrue(0 < total < 500, "The subsample did not contain a fraction of the reads")
+        limited = fu.profile_fastq(fqfile, max_reads=100)['stats']
+        self.assertEqual("100",limited["Basic Statistics"]["Value"][3],"max_reads was not respected")
+
+    def test_deduplicate_fastq(self):
+        """Remove duplicate reads and read pairs in a single pass
+        """
+        pool = [td.generate_fastq_record(sequence_length=20) for n in xrange(300)]
+        records1 = [copy.copy(random.choice(pool)) for n in xrange(2000)]
+        records2 = [copy.copy(random.choice(pool[0:2])) for n in xrange(2000)]
+        infiles = []
+        for records in [records1, records2]:
+            fd, fqfile = tempfile.mkstemp(suffix=".fastq.gz", dir=self.rootdir)
+            os.close(fd)
+            fqw = fu.FastQWriter(fqfile)
+            for r in records:
+                fqw.write(r)
+            fqw.close()
+            infiles.append(fqfile)
+        outfiles = [os.path.join(self.rootdir, "unique_{}.fastq.gz".format(n)) for n in [1,2]]
+
+        # A small capacity and a high error rate make the Bloom filter grow and give false positives
+        expected = []
+        for r in records1:
+            if r[1] not in [e[1] for e in expected]:
+                expected.append(r)
+        dedup = fu.deduplicate_fastq(infiles[0], outfiles[0], capacity=10, error_rate=0.1)
+        self.assertListEqual(expected,[r for r in fu.FastQParser(outfiles[0])],
+                             "The first occurrence of each sequence was not written in order")
+        self.assertEqual(len(records1) - len(expected),dedup.duplicates,"The number of duplicates was not correct")
+        self.assertTrue(len(dedup.bloom.filters) > 1,"The Bloom filter did not grow")
+
+        # Pairs are only duplicates if both sequences are
+        expected = []
+        for r1, r2 in zip(records1, records2):
+            if (r1[1],r2[1]) not in expected:
+                expected.append((r1[1],r2[1]))
+        dedup = fu.deduplicate_fastq(infiles[0], outfiles[0], infiles[1], outfiles[1])
+        self.assertListEqual(expected,[(r1[1],r2[1]) for r1, r2 in zip(fu.FastQParser(outfiles[0]),fu.FastQParser(outfiles[1]))],
+                             "The first occurrence of each sequence pair was not written")
+
+        # Without confirmation, no more than the unique sequences are written
+        dedup = fu.deduplicate_fastq(infiles[0], outfiles[0], exact=False)
+        self.assertTrue(0 < len([r for r in fu.FastQParser(outfiles[0])]) <= len(set([r[1] for r in records1])),
+                        "Probabilistic deduplication wrote too many records")
+
+    def test_barcode_counter(self):
+        """Count the most common barcodes in bounded memory
+        """
+        # A few frequent barcodes among many rare ones
+        frequent = []
+        while len(frequent) < 10:
+            bc = td.generate_barcode()
+            if bc not in frequent:
+                frequent.append(bc)
+        barcodes = [random.choice(frequent) if random.random() < 0.5 else td.generate_barcode() for n in xrange(20000)]
+        expected = frequent[0:2]
+        exact = Counter(barcodes)
+
+        counter = fu.BarcodeCounter(capacity=100, exact=expected, chunk_size=1000)
+        counter.update(barcodes)
+        self.assertTrue(len(counter.counts) <= 100,"More barcodes than the capacity were tracked")
+        self.assertEqual(len(barcodes),counter.total,"The total number of barcodes was not correct")
+        self.assertDictEqual({bc: exact[bc] for bc in expected},counter.exact,
+                             "The expected barcodes were not counted exactly")
+        for bc, count in counter.most_common(8):
+            self.assertIn(bc,frequent[2:],"A rare or expected barcode was among the most common")
+            self.assertTrue(exact[bc] <= count <= exact[bc] + counter.errors[bc],
+                            "The count of {} was not within its error bound".format(bc))
+        for bc in exact:
+            if bc not in counter.counts and bc not in expected:
+                self.assertTrue(exact[bc] <= counter.floor(),"A barcode that was not tracked was counted more than the floor")
+
+        # Counters for parts of the data can be merged
+        parts = [fu.BarcodeCounter(capacity=100, exact=expected) for n in xrange(2)]
+        parts[0].update(barcodes[0:5000])
+        parts[1].update(barcodes[5000:])
+        parts[0].merge(parts[1])
+        self.assertEqual(len(barcodes),parts[0].total,"The merged total was not correct")
+        self.assertListEqual(sorted(frequent[2:]),sorted([bc for bc, count in parts[0].most_common(8)]),
+                             "The merged counter did not find the most common barcodes")
+        for bc, count in parts[0].most_common(8):
+            self.assertTrue(exact[bc] <= count <= exact[bc] + parts[0].errors[bc],
+                            "The merged count of {} was not within its error bound".format(bc))
+
 
 class TestBarcodeExtractor(unittest.TestCase):
     """Test class for the functionality
@@ -258,5 +639,10 @@ class TestBarcodeExtractor(unittest.TestCase):
         # Assert the observerd and expected barcode counts are the same
         self.assertListEqual(sorted(obs_cnt), sorted(exp_cnt),
                               "Extracted and expected barcode counts don't match")
-         
+
+        # Extract the barcodes with decompression in a background thread
+        bcx = fu.BarcodeExtractor(self.fastq_file, decompress="thread")
+        self.assertListEqual(sorted(Counter(bcx).most_common()), sorted(exp_cnt),
+                              "Barcode counts extracted with threaded decompression don't match")
+
         